@@ -59,7 +59,7 @@ async def generate_test_data():
     if not user_ids:
         user_ids = ['admin@hubblindtests.com']
     
-    # Période de 12 mois
+    # Période de 12 mois (dates BSON, comme les écritures de l'API)
     now = datetime.now(timezone.utc)
     
     tests_site_generated = 0
@@ -90,11 +90,11 @@ async def generate_test_data():
                     
                     test_site = {
                         "id": str(uuid4()),
-                        "date_test": date_test.isoformat(),
+                        "date_test": date_test,
                         "programme_id": prog_id,
                         "partenaire_id": part_id,
                         "type_commande": random.choice(["web", "tel", "web"]),
-                        "date_commande": date_test.isoformat(),
+                        "date_commande": date_test,
                         "montant_commande": prix_public,
                         "prix_public": prix_public,
                         "prix_remise": prix_remise,
@@ -109,8 +109,8 @@ async def generate_test_data():
                             ""
                         ]),
                         "user_id": random.choice(user_ids),
-                        "created_at": created_at.isoformat(),
-                        "updated_at": created_at.isoformat()
+                        "created_at": created_at,
+                        "updated_at": created_at
                     }
                     await db.tests_site.insert_one(test_site)
                     tests_site_generated += 1
@@ -119,7 +119,7 @@ async def generate_test_data():
                 if prog_assoc['test_ligne_requis'] and random.random() > 0.05:
                     test_ligne = {
                         "id": str(uuid4()),
-                        "date_test": date_test.isoformat(),
+                        "date_test": date_test,
                         "programme_id": prog_id,
                         "partenaire_id": part_id,
                         "numero_telephone": f"0{random.randint(1, 9)}{random.randint(10000000, 99999999)}",
@@ -137,8 +137,8 @@ async def generate_test_data():
                             None
                         ]),
                         "user_id": random.choice(user_ids),
-                        "created_at": created_at.isoformat(),
-                        "updated_at": created_at.isoformat()
+                        "created_at": created_at,
+                        "updated_at": created_at
                     }
                     await db.tests_ligne.insert_one(test_ligne)
                     tests_ligne_generated += 1
@@ -179,7 +179,7 @@ async def generate_test_data():
                 "description": "Remise non appliquée lors du test",
                 "statut": random.choice(["ouvert", "resolu"]),
                 "created_at": test['created_at'],
-                "updated_at": datetime.now(timezone.utc).isoformat()
+                "updated_at": datetime.now(timezone.utc)
             }
             await db.alertes.insert_one(alerte)
             alertes_generated += 1
@@ -195,7 +195,7 @@ async def generate_test_data():
                 "description": "Offre non appliquée lors du test",
                 "statut": random.choice(["ouvert", "resolu"]),
                 "created_at": test['created_at'],
-                "updated_at": datetime.now(timezone.utc).isoformat()
+                "updated_at": datetime.now(timezone.utc)
             }
             await db.alertes.insert_one(alerte)
             alertes_generated += 1
@@ -1,5 +1,5 @@
 from fastapi import FastAPI, APIRouter, HTTPException, Query, UploadFile, File, Depends, Request
-from fastapi.responses import StreamingResponse, FileResponse
+from fastapi.responses import StreamingResponse, FileResponse, Response
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi.staticfiles import StaticFiles
 from dotenv import load_dotenv
@@ -7,10 +7,14 @@ from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
 import os
 import logging
+import asyncio
 import csv
 import io
 import shutil
 import smtplib
+import tempfile
+import queue
+import threading
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from pathlib import Path
@@ -20,7 +24,8 @@ import uuid
 from datetime import datetime, timezone, time
 from enum import Enum
 from openpyxl import Workbook
-from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
+from openpyxl.styles import Font, Alignment, PatternFill, Border, Side, NamedStyle
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.utils import get_column_letter
 from pptx import Presentation
 from pptx.util import Inches, Pt
@@ -42,8 +47,21 @@ from reportlab.lib.enums import TA_CENTER, TA_LEFT
 import base64
 import gridfs
 from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, CollectionInvalid, DuplicateKeyError, OperationFailure
 from PyPDF2 import PdfReader, PdfWriter
 import math
+from time import monotonic, perf_counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import hashlib
+import json
+import pickle
+import re
+from functools import lru_cache
+from collections import deque
+from cachetools import TTLCache
 
 # Generic type for pagination
 T = TypeVar('T')
@@ -60,7 +78,19 @@ SECRET_KEY = os.getenv('SECRET_KEY', 'your-secret-key-change-in-production-pleas
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7  # 7 days
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Coût bcrypt configurable : min = max = défaut, donc tout hash d'un autre coût
+# est signalé par verify_and_update et recalculé au login suivant
+BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', '12'))
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS,
+)
+# bcrypt libère le GIL : un pool de threads borné suffit à sortir le hachage de la boucle asyncio
+AUTH_HASH_WORKERS = int(os.getenv('AUTH_HASH_WORKERS', '4'))
+auth_hash_executor = ThreadPoolExecutor(max_workers=AUTH_HASH_WORKERS, thread_name_prefix="bcrypt")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/login", auto_error=False)
 
 # MongoDB connection with robust error handling for Atlas SRV URIs
@@ -76,6 +106,8 @@ client = AsyncIOMotorClient(
     socketTimeoutMS=30000,  # 30 seconds socket timeout
     retryWrites=True,
     retryReads=True,
+    tz_aware=True,  # Dates BSON relues en datetime UTC aware (sérialisées avec +00:00)
+    tzinfo=timezone.utc,
 )
 db = client[os.environ.get('DB_NAME', 'qwertys_hub')]
 
@@ -101,6 +133,31 @@ async def startup_db_client():
         logging.error(f"Failed to connect to MongoDB: {e}")
         # Don't raise - let the app start and fail on actual requests if needed
         # This prevents immediate crash on transient network issues
+        return
+    
+    try:
+        # Index unique avant le backfill : les doublons à la casse près sont refusés
+        # par email_lower_unique au lieu d'être renseignés puis de dégrader l'index
+        await ensure_indexes()
+        await backfill_email_lower()
+    except Exception as e:
+        logging.error(f"Failed to ensure MongoDB indexes: {e}")
+    
+    # Migration des dates en BSON (reprenable, en tâche de fond)
+    background_tasks.add(asyncio.create_task(date_migration_worker()))
+    # Worker de la file d'envoi des emails
+    background_tasks.add(asyncio.create_task(email_outbox_worker()))
+    # Notifications temps réel partagées entre workers
+    if NOTIFICATIONS_CHANGE_STREAM:
+        background_tasks.add(asyncio.create_task(notification_change_stream_worker()))
+    # Réconciliation périodique des compteurs de notifications non lues
+    background_tasks.add(asyncio.create_task(notification_counters_reconciler()))
+    # Archivage des notifications et logs de connexion anciens
+    background_tasks.add(asyncio.create_task(retention_worker()))
+    # Exports longs planifiés via /api/export-jobs, puis purge des exports expirés
+    for _ in range(EXPORT_JOBS_WORKERS):
+        background_tasks.add(asyncio.create_task(export_jobs_worker()))
+    background_tasks.add(asyncio.create_task(export_jobs_cleanup_worker()))
 
 # Enums
 class StatutAlerte(str, Enum):
@@ -370,6 +427,7 @@ class UserSignature(UserSignatureBase):
 # Models - Email Draft
 class EmailDraftStatus(str, Enum):
     draft = "draft"
+    queued = "queued"  # En file d'envoi (email_outbox)
     sent = "sent"
 
 class EmailDraftBase(BaseModel):
@@ -507,6 +565,13 @@ class PaginatedResponse(BaseModel):
     limit: int
     pages: int
 
+# Modèle de réponse paginée par curseur (keyset)
+class CursorPaginatedResponse(BaseModel):
+    items: List
+    limit: int
+    next_cursor: Optional[str] = None
+    total: Optional[int] = None  # Estimation mise en cache, seulement si include_total=true
+
 # Modèle Settings pour les paramètres globaux
 class Settings(BaseModel):
     id: str = "global_settings"
@@ -525,158 +590,1407 @@ async def get_settings():
         return default_settings
     return settings
 
+# =====================
+# Cache mémoire des données de référence (programmes, partenaires, users)
+# =====================
+
+REFERENCE_CACHE_TTL = float(os.getenv('REFERENCE_CACHE_TTL', '60'))  # secondes
+
+class ReferenceCache:
+    """
+    Cache versionné d'une petite collection de référence, chargée en entier
+    en une requête et indexée par id.
+    - invalidate() incrémente la version : le prochain accès recharge la collection
+    - le TTL borne la fraîcheur quand plusieurs workers écrivent en parallèle
+    Les documents retournés sont partagés : les appelants ne doivent pas les modifier
+    (get_all() et get() renvoient des copies pour les routes qui les transforment).
+    """
+
+    def __init__(self, collection_name: str, projection: Optional[dict] = None, ttl: float = REFERENCE_CACHE_TTL):
+        self.collection_name = collection_name
+        self.projection = projection or {"_id": 0}
+        self.ttl = ttl
+        self.version = 0
+        self._loaded_version = -1
+        self._loaded_at = 0.0
+        self._docs = {}
+        self._absents = set()
+        self._lock = asyncio.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+
+    def invalidate(self):
+        """À appeler après toute écriture sur la collection"""
+        self.version += 1
+
+    def _is_fresh(self) -> bool:
+        return self._loaded_version == self.version and (monotonic() - self._loaded_at) < self.ttl
+
+    async def _ensure_loaded(self):
+        if self._is_fresh():
+            self.hits += 1
+            return
+        async with self._lock:
+            if self._is_fresh():
+                self.hits += 1
+                return
+            self.misses += 1
+            self.reloads += 1
+            version = self.version
+            docs = await db[self.collection_name].find({}, self.projection).to_list(length=None)
+            self._docs = {d['id']: d for d in docs if d.get('id')}
+            self._absents = set()
+            self._loaded_version = version
+            self._loaded_at = monotonic()
+
+    async def get_map(self) -> dict:
+        """Map id -> document (lecture seule)"""
+        await self._ensure_loaded()
+        return self._docs
+
+    async def get_all(self) -> List[dict]:
+        await self._ensure_loaded()
+        return [dict(d) for d in self._docs.values()]
+
+    async def get(self, doc_id: Optional[str]) -> Optional[dict]:
+        """Document par id ; un id inconnu du cache est vérifié une fois en base"""
+        if not doc_id:
+            return None
+        await self._ensure_loaded()
+        doc = self._docs.get(doc_id)
+        if doc is None and doc_id not in self._absents:
+            # Document créé par un autre worker depuis le dernier chargement
+            self.misses += 1
+            doc = await db[self.collection_name].find_one({"id": doc_id}, self.projection)
+            if doc:
+                self._docs[doc_id] = doc
+            else:
+                self._absents.add(doc_id)
+        return dict(doc) if doc else None
+
+    async def get_many(self, doc_ids) -> dict:
+        """Map id -> document pour un lot d'ids ; les ids inconnus du cache sont
+        résolus en une seule requête $in (lecture seule)"""
+        doc_ids = {doc_id for doc_id in doc_ids if doc_id}
+        await self._ensure_loaded()
+        manquants = [doc_id for doc_id in doc_ids if doc_id not in self._docs and doc_id not in self._absents]
+        if manquants:
+            self.misses += 1
+            docs = await db[self.collection_name].find({"id": {"$in": manquants}}, self.projection).to_list(length=None)
+            for d in docs:
+                self._docs[d['id']] = d
+            self._absents.update(set(manquants) - {d['id'] for d in docs})
+        return {doc_id: self._docs[doc_id] for doc_id in doc_ids if doc_id in self._docs}
+
+    async def noms(self) -> dict:
+        """Map id -> nom"""
+        docs = await self.get_map()
+        return {doc_id: d.get('nom') for doc_id, d in docs.items()}
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "collection": self.collection_name,
+            "version": self.version,
+            "documents": len(self._docs),
+            "hits": self.hits,
+            "misses": self.misses,
+            "reloads": self.reloads,
+            "hit_rate": round(self.hits / total, 4) if total else None,
+            "ttl_seconds": self.ttl
+        }
+
+programmes_cache = ReferenceCache("programmes")
+partenaires_cache = ReferenceCache("partenaires")
+users_cache = ReferenceCache("users", projection={"_id": 0, "password_hash": 0})
+
+REFERENCE_CACHES = [programmes_cache, partenaires_cache, users_cache]
+
+async def enrich_alertes_noms(alertes: List[dict], defaut: Optional[str] = None, avec_contact: bool = False) -> List[dict]:
+    """
+    Ajoute programme_nom / partenaire_nom (et partenaire_contact_email si demandé)
+    à une liste d'alertes, en place. Les noms viennent du cache de référence :
+    au plus une requête $in par collection, quel que soit le nombre d'alertes.
+    """
+    programmes = await programmes_cache.get_many(a.get('programme_id') for a in alertes)
+    partenaires = await partenaires_cache.get_many(a.get('partenaire_id') for a in alertes)
+    for alerte in alertes:
+        programme = programmes.get(alerte.get('programme_id'))
+        partenaire = partenaires.get(alerte.get('partenaire_id'))
+        alerte['programme_nom'] = programme['nom'] if programme else defaut
+        alerte['partenaire_nom'] = partenaire['nom'] if partenaire else defaut
+        if avec_contact:
+            alerte['partenaire_contact_email'] = partenaire.get('contact_email') if partenaire else None
+    return alertes
+
+# =====================
+# DATES - Stockage en dates BSON natives
+# =====================
+# Les champs date des collections ci-dessous étaient stockés en chaînes ISO (fuseaux
+# hétérogènes). Les écritures utilisent désormais des datetime et une migration en tâche
+# de fond convertit l'existant par lots. Tant qu'une collection n'est pas entièrement
+# migrée, add_date_range() filtre sur les deux formes ; ensuite une seule plage BSON.
+
+DATE_FIELDS = {
+    "tests_site": ["date_test", "created_at"],
+    "tests_ligne": ["date_test", "created_at"],
+    "alertes": ["created_at", "resolved_at"],
+    "connection_logs": ["login_time", "logout_time"],
+    "notifications": ["created_at"],
+}
+DATE_MIGRATION_ID = "bson_dates"
+DATE_MIGRATION_BATCH_SIZE = int(os.getenv('DATE_MIGRATION_BATCH_SIZE', '500'))
+DATE_MIGRATION_PAUSE = float(os.getenv('DATE_MIGRATION_PAUSE', '0.05'))  # secondes entre deux lots
+DATE_MIGRATION_LEASE = timedelta(minutes=2)
+WORKER_ID = str(uuid.uuid4())
+
+# Collections dont tous les champs date sont en BSON
+collections_dates_migrees = set()
+# status : pending, running, done, ou partial (chaînes non convertibles dans "incomplete")
+date_migration_state = {"status": "pending", "collections": {}, "incomplete": []}
+
+# Références des tâches asyncio lancées au démarrage (évite leur collecte par le GC)
+background_tasks = set()
+
+_OPERATEURS_PLAGE = {"gte": "$gte", "gt": "$gt", "lte": "$lte", "lt": "$lt"}
+
+def parse_date(value) -> Optional[datetime]:
+    """Datetime UTC aware depuis une date BSON ou une chaîne ISO ; None si vide ou invalide"""
+    if isinstance(value, datetime):
+        dt = value
+    elif isinstance(value, str) and value.strip():
+        try:
+            dt = datetime.fromisoformat(value.strip().replace('Z', '+00:00'))
+        except ValueError:
+            return None
+    else:
+        return None
+    if dt.tzinfo is None:
+        return dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc)
+
+def date_iso(value) -> str:
+    """Représentation ISO d'une date quel que soit son stockage"""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value or ''
+
+def add_date_range(query: dict, collection_name: str, champ: str, **bornes) -> dict:
+    """
+    Ajoute à query un filtre de plage sur un champ date (bornes gte/gt/lte/lt,
+    en datetime ou chaîne ISO). Pendant la migration, $or entre la plage BSON et la
+    plage historique en chaînes ; une fois la collection migrée, une seule plage BSON.
+    """
+    bornes = {op: v for op, v in bornes.items() if v is not None}
+    if not bornes:
+        return query
+    plage_date = {}
+    for op, valeur in bornes.items():
+        date = parse_date(valeur)
+        if date is None:
+            raise HTTPException(status_code=400, detail=f"Date invalide : {valeur}")
+        plage_date[_OPERATEURS_PLAGE[op]] = date
+    
+    if collection_name in collections_dates_migrees:
+        condition = {champ: plage_date}
+    else:
+        plage_iso = {_OPERATEURS_PLAGE[op]: date_iso(v) for op, v in bornes.items()}
+        condition = {"$or": [{champ: plage_date}, {champ: plage_iso}]}
+    
+    if "$or" not in condition and champ not in query:
+        query[champ] = plage_date
+    else:
+        query.setdefault("$and", []).append(condition)
+    return query
+
+async def load_date_migration_state():
+    doc = await db.migrations.find_one({"id": DATE_MIGRATION_ID}, {"_id": 0})
+    if doc:
+        date_migration_state["status"] = doc.get("status", "pending")
+        date_migration_state["collections"] = doc.get("collections", {})
+        date_migration_state["incomplete"] = doc.get("incomplete", [])
+    for collection_name, etat in date_migration_state["collections"].items():
+        if etat.get("done"):
+            collections_dates_migrees.add(collection_name)
+    # Collection ajoutée à DATE_FIELDS après une migration terminée : nouvelle passe
+    if any(collection_name not in date_migration_state["collections"] for collection_name in DATE_FIELDS):
+        date_migration_state["status"] = "pending"
+
+async def _save_date_migration_state():
+    await db.migrations.update_one(
+        {"id": DATE_MIGRATION_ID},
+        {"$set": {
+            "status": date_migration_state["status"],
+            "collections": date_migration_state["collections"],
+            "incomplete": date_migration_state["incomplete"],
+            "updated_at": datetime.now(timezone.utc),
+            "lease_until": datetime.now(timezone.utc) + DATE_MIGRATION_LEASE
+        }}
+    )
+
+async def _acquire_date_migration_lease() -> bool:
+    """Un seul worker exécute la migration ; le bail expire si ce worker s'arrête"""
+    now = datetime.now(timezone.utc)
+    await db.migrations.update_one(
+        {"id": DATE_MIGRATION_ID},
+        {"$setOnInsert": {"id": DATE_MIGRATION_ID, "status": "pending", "collections": {}}},
+        upsert=True
+    )
+    result = await db.migrations.update_one(
+        {"id": DATE_MIGRATION_ID, "$or": [
+            {"lease_until": None},
+            {"lease_until": {"$lt": now}},
+            {"lease_owner": WORKER_ID}
+        ]},
+        {"$set": {"lease_owner": WORKER_ID, "lease_until": now + DATE_MIGRATION_LEASE}}
+    )
+    return result.matched_count == 1
+
+async def migrate_collection_dates(collection_name: str, champs: List[str]):
+    """Convertit les champs date d'une collection par lots, en reprenant au dernier _id traité"""
+    etat = date_migration_state["collections"].setdefault(
+        collection_name, {"done": False, "converted": 0, "invalid": 0, "last_id": None}
+    )
+    collection = db[collection_name]
+    filtre_chaines = {"$or": [{champ: {"$type": "string"}} for champ in champs]}
+    if etat.get("last_id") is None:
+        etat["invalid"] = 0
+    
+    while True:
+        filtre = dict(filtre_chaines)
+        if etat.get("last_id") is not None:
+            filtre["_id"] = {"$gt": etat["last_id"]}
+        projection = {"_id": 1, **{champ: 1 for champ in champs}}
+        docs = await collection.find(filtre, projection).sort("_id", 1).limit(DATE_MIGRATION_BATCH_SIZE).to_list(DATE_MIGRATION_BATCH_SIZE)
+        if not docs:
+            break
+        
+        operations = []
+        for doc in docs:
+            maj = {}
+            for champ in champs:
+                valeur = doc.get(champ)
+                if not isinstance(valeur, str):
+                    continue
+                date = parse_date(valeur)
+                if date is not None or not valeur.strip():
+                    maj[champ] = date
+                else:
+                    etat["invalid"] += 1
+            if maj:
+                # Garde sur les valeurs lues : une écriture concurrente n'est pas écrasée
+                filtre_doc = {"_id": doc["_id"], **{champ: doc[champ] for champ in maj}}
+                operations.append(UpdateOne(filtre_doc, {"$set": maj}))
+        if operations:
+            result = await collection.bulk_write(operations, ordered=False)
+            etat["converted"] += result.modified_count
+        
+        etat["last_id"] = docs[-1]["_id"]
+        await _save_date_migration_state()
+        await asyncio.sleep(DATE_MIGRATION_PAUSE)
+    
+    # Passe terminée : la collection est migrée s'il ne reste aucune chaîne
+    restantes = await collection.count_documents(filtre_chaines)
+    etat["done"] = restantes == 0
+    etat["remaining"] = restantes
+    etat["last_id"] = None
+    if etat["done"]:
+        collections_dates_migrees.add(collection_name)
+        logger.info(f"Migration dates {collection_name} terminée ({etat['converted']} document(s) converti(s))")
+    else:
+        logger.warning(f"Migration dates {collection_name} : {restantes} document(s) avec date non convertible")
+    await _save_date_migration_state()
+
+async def run_date_migration():
+    date_migration_state["status"] = "running"
+    for collection_name, champs in DATE_FIELDS.items():
+        if date_migration_state["collections"].get(collection_name, {}).get("done"):
+            continue
+        await migrate_collection_dates(collection_name, champs)
+    # Collections avec des dates non convertibles : elles gardent la branche chaîne de
+    # leurs requêtes (add_date_range) tant que ces documents ne sont pas corrigés
+    incompletes = [nom for nom in DATE_FIELDS if not date_migration_state["collections"].get(nom, {}).get("done")]
+    date_migration_state["incomplete"] = incompletes
+    date_migration_state["status"] = "partial" if incompletes else "done"
+    if incompletes:
+        logger.warning(f"Migration dates partielle, collections non migrées : {incompletes}")
+    await _save_date_migration_state()
+
+async def date_migration_worker():
+    """Tâche de fond : exécute la migration si ce worker obtient le bail, sinon suit sa progression"""
+    while True:
+        try:
+            await load_date_migration_state()
+            # partial : dates non convertibles, signalées dans /monitoring/metrics ; pas de
+            # nouvelle passe automatique (nouvelle collection dans DATE_FIELDS : pending)
+            if date_migration_state["status"] in ("done", "partial"):
+                return
+            if await _acquire_date_migration_lease():
+                await run_date_migration()
+                continue
+        except Exception as e:
+            logger.error(f"Erreur migration des dates : {e}")
+        await asyncio.sleep(60)
+
+# =====================
+# PAGINATION PAR CURSEUR (keyset)
+# =====================
+# Le curseur encode la clé de tri (champ date, id) du dernier élément de la page :
+# la page suivante est une plage d'index au lieu d'un skip qui relit tout l'historique.
+
+COUNT_CACHE_TTL = float(os.getenv('COUNT_CACHE_TTL', '30'))  # secondes
+_count_cache = TTLCache(maxsize=512, ttl=COUNT_CACHE_TTL)
+
+def encode_cursor(valeur, doc_id: str) -> str:
+    """Encode (valeur de tri, id) en curseur opaque"""
+    if isinstance(valeur, datetime):
+        valeur = {"$date": valeur.isoformat()}
+    payload = json.dumps([valeur, doc_id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor: str):
+    """Décode un curseur opaque en (valeur de tri, id)"""
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        valeur, doc_id = json.loads(base64.urlsafe_b64decode(cursor + padding))
+        if isinstance(valeur, dict):
+            valeur = datetime.fromisoformat(valeur["$date"])
+        return valeur, str(doc_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Curseur de pagination invalide")
+
+async def fetch_page_curseur(collection, query: dict, champ: str, cursor: Optional[str], limit: int):
+    """
+    Page triée par (champ desc, id desc) à partir d'un curseur.
+    Retourne (documents, next_cursor) ; next_cursor vaut None sur la dernière page.
+    """
+    if cursor:
+        valeur, doc_id = decode_cursor(cursor)
+        apres_curseur = {"$or": [
+            {champ: {"$lt": valeur}},
+            {champ: valeur, "id": {"$lt": doc_id}}
+        ]}
+        if isinstance(valeur, datetime) and collection.name not in collections_dates_migrees:
+            # Tri décroissant : les chaînes ISO pas encore migrées suivent les dates BSON
+            apres_curseur["$or"].append({champ: {"$type": "string"}})
+        query = {"$and": [query, apres_curseur]} if query else apres_curseur
+    
+    docs = await collection.find(query, {"_id": 0}).sort([(champ, -1), ("id", -1)]).limit(limit + 1).to_list(limit + 1)
+    next_cursor = None
+    if len(docs) > limit:
+        docs = docs[:limit]
+        next_cursor = encode_cursor(docs[-1].get(champ), docs[-1]['id'])
+    return docs, next_cursor
+
+async def count_estime(collection, query: dict) -> int:
+    """count_documents mis en cache quelques secondes (total indicatif des listes paginées)"""
+    key = (collection.name, json.dumps(query, sort_keys=True, default=str))
+    total = _count_cache.get(key)
+    if total is None:
+        total = await collection.count_documents(query)
+        _count_cache[key] = total
+    return total
+
+# =====================
+# INDEX MANAGER - Index déclarés par forme de requête
+# =====================
+# Chaque collection reçoit un index unique sur `id` puis les index composés
+# correspondant aux filtres + tris des routes. ensure_indexes() est idempotent :
+# il est rejoué à chaque démarrage et ne crée que les index absents.
+
+def _id_unique() -> IndexModel:
+    return IndexModel([("id", ASCENDING)], name="id_unique", unique=True)
+
+def _tests_indexes() -> List[IndexModel]:
+    return [
+        _id_unique(),
+        # Doublons (check_duplicate_test / création), agrégats par couple et bilans Excel
+        # par partenaire (une feuille par programme, triée par date puis id)
+        IndexModel([("partenaire_id", ASCENDING), ("programme_id", ASCENDING), ("date_test", ASCENDING), ("id", ASCENDING)], name="couple_date"),
+        # Listes triées par date (pagination page et curseur)
+        IndexModel([("date_test", DESCENDING), ("id", DESCENDING)], name="date_test_keyset"),
+        # Bilan partenaire : tests d'un partenaire triés par date
+        IndexModel([("partenaire_id", ASCENDING), ("date_test", ASCENDING), ("id", ASCENDING)], name="partenaire_date"),
+        # Bilans Excel par programme : une feuille par partenaire, triée par date puis id
+        IndexModel([("programme_id", ASCENDING), ("partenaire_id", ASCENDING), ("date_test", ASCENDING), ("id", ASCENDING)], name="programme_partenaire_date"),
+        IndexModel([("programme_id", ASCENDING), ("date_test", DESCENDING), ("id", DESCENDING)], name="programme_date_keyset"),
+        IndexModel([("user_id", ASCENDING)], name="user_id"),
+    ]
+
+INDEX_REGISTRY = {
+    "programmes": [_id_unique()],
+    "partenaires": [
+        _id_unique(),
+        IndexModel([("nom", ASCENDING)], name="nom"),
+    ],
+    "users": [
+        _id_unique(),
+        # Point lookup de l'authentification (email normalisé, insensible à la casse)
+        IndexModel([("email_lower", ASCENDING)], name="email_lower_unique", unique=True,
+                   partialFilterExpression={"email_lower": {"$type": "string"}}),
+        IndexModel([("email", ASCENDING)], name="email"),
+        IndexModel([("role", ASCENDING)], name="role"),
+        # Chefs de projet d'un programme (notifications d'alerte)
+        IndexModel([("role", ASCENDING), ("programme_ids", ASCENDING)], name="role_programme_ids"),
+    ],
+    "tests_site": _tests_indexes(),
+    "tests_ligne": _tests_indexes(),
+    "alertes": [
+        _id_unique(),
+        IndexModel([("statut", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)], name="statut_created_keyset"),
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)], name="created_keyset"),
+        IndexModel([("partenaire_id", ASCENDING), ("created_at", DESCENDING)], name="partenaire_created"),
+        IndexModel([("programme_id", ASCENDING), ("created_at", DESCENDING)], name="programme_created"),
+        IndexModel([("test_id", ASCENDING)], name="test_id"),
+        IndexModel([("user_id", ASCENDING)], name="user_id"),
+    ],
+    "job_leases": [_id_unique()],
+    "notification_counters": [
+        IndexModel([("user_id", ASCENDING)], name="user_id_unique", unique=True),
+    ],
+    "notifications": [
+        _id_unique(),
+        IndexModel([("user_id", ASCENDING), ("read", ASCENDING)], name="user_read"),
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING)], name="user_created"),
+        IndexModel([("alerte_id", ASCENDING), ("user_id", ASCENDING)], name="alerte_user_unique", unique=True),
+    ],
+    "connection_logs": [
+        _id_unique(),
+        IndexModel([("login_time", DESCENDING), ("id", DESCENDING)], name="login_keyset"),
+        IndexModel([("user_id", ASCENDING), ("logout_time", ASCENDING), ("login_time", DESCENDING)], name="user_session"),
+    ],
+    "email_templates": [
+        _id_unique(),
+        IndexModel([("is_default", ASCENDING)], name="is_default"),
+    ],
+    "email_drafts": [
+        _id_unique(),
+        IndexModel([("status", ASCENDING)], name="status"),
+        IndexModel([("alerte_id", ASCENDING), ("status", ASCENDING)], name="alerte_status"),
+        # Un seul brouillon par alerte
+        IndexModel([("alerte_id", ASCENDING)], name="alerte_id_unique", unique=True,
+                   partialFilterExpression={"alerte_id": {"$type": "string"}}),
+        IndexModel([("outbox_batch_id", ASCENDING)], name="outbox_batch_id", sparse=True),
+    ],
+    "email_outbox": [
+        _id_unique(),
+        IndexModel([("status", ASCENDING), ("next_attempt_at", ASCENDING)], name="status_next_attempt"),
+        IndexModel([("status", ASCENDING), ("locked_until", ASCENDING)], name="status_locked_until"),
+        IndexModel([("claim_id", ASCENDING)], name="claim_id", sparse=True),
+        IndexModel([("batch_id", ASCENDING)], name="batch_id"),
+        # Un seul message actif (pending/sending) par brouillon : mise en file idempotente
+        IndexModel([("active_draft_id", ASCENDING)], name="active_draft_id_unique", unique=True, sparse=True),
+        IndexModel([("draft_id", ASCENDING), ("status", ASCENDING)], name="draft_status"),
+    ],
+    "export_jobs": [
+        _id_unique(),
+        IndexModel([("status", ASCENDING), ("created_at", ASCENDING)], name="status_created"),
+        IndexModel([("user_id", ASCENDING), ("status", ASCENDING)], name="user_status"),
+        IndexModel([("expires_at", ASCENDING)], name="expires_at"),
+        # Créneaux des jobs en attente ou en cours (limite par utilisateur)
+        IndexModel([("active_slot", ASCENDING)], name="active_slot_unique", unique=True, sparse=True),
+    ],
+    "report_cache": [
+        IndexModel([("key", ASCENDING)], name="key_unique", unique=True),
+        IndexModel([("last_access", DESCENDING)], name="last_access"),
+        IndexModel([("file_id", ASCENDING)], name="file_id"),
+    ],
+    "email_history": [
+        IndexModel([("alerte_id", ASCENDING), ("sent_at", DESCENDING)], name="alerte_sent"),
+        IndexModel([("sent_at", DESCENDING)], name="sent_at"),
+    ],
+    "signatures": [_id_unique()],
+    "identifiants_mystere": [
+        _id_unique(),
+        IndexModel([("programme_id", ASCENDING)], name="programme_id"),
+    ],
+    "settings": [_id_unique()],
+}
+
+# Formes de requête des routes critiques : (collection, filtre, tri) avec valeurs témoins,
+# utilisées par /api/monitoring/indexes pour vérifier l'index retenu par le planner
+QUERY_SHAPES = {
+    "tests_site.duplicate_check": ("tests_site", {"partenaire_id": "x", "programme_id": "x", "date_test": {"$gte": datetime(2025, 1, 1, tzinfo=timezone.utc), "$lte": datetime(2025, 1, 31, tzinfo=timezone.utc)}}, None),
+    "tests_site.list_by_year": ("tests_site", {"date_test": {"$gte": datetime(2025, 1, 1, tzinfo=timezone.utc), "$lte": datetime(2025, 12, 31, tzinfo=timezone.utc)}}, [("date_test", -1), ("id", -1)]),
+    "tests_site.list_by_programme": ("tests_site", {"programme_id": "x", "date_test": {"$gte": datetime(2025, 1, 1, tzinfo=timezone.utc)}}, [("date_test", -1), ("id", -1)]),
+    "tests_ligne.duplicate_check": ("tests_ligne", {"partenaire_id": "x", "programme_id": "x", "date_test": {"$gte": datetime(2025, 1, 1, tzinfo=timezone.utc), "$lte": datetime(2025, 1, 31, tzinfo=timezone.utc)}}, None),
+    "tests_ligne.list_by_year": ("tests_ligne", {"date_test": {"$gte": datetime(2025, 1, 1, tzinfo=timezone.utc), "$lte": datetime(2025, 12, 31, tzinfo=timezone.utc)}}, [("date_test", -1), ("id", -1)]),
+    "alertes.by_statut": ("alertes", {"statut": "ouvert"}, [("created_at", -1), ("id", -1)]),
+    "alertes.by_test": ("alertes", {"test_id": "x"}, None),
+    "alertes.by_id": ("alertes", {"id": "x"}, None),
+    "notification_counters.by_user": ("notification_counters", {"user_id": "x"}, None),
+    "notifications.unread_count": ("notifications", {"user_id": "x", "read": False}, None),
+    "notifications.list": ("notifications", {"user_id": "x"}, [("created_at", -1)]),
+    "connection_logs.list": ("connection_logs", {}, [("login_time", -1), ("id", -1)]),
+    "connection_logs.open_session": ("connection_logs", {"user_id": "x", "logout_time": None}, [("login_time", -1)]),
+    "users.by_id": ("users", {"id": "x"}, None),
+    "users.auth_by_email": ("users", {"email_lower": "x"}, None),
+    "users.chefs_projet_programme": ("users", {"role": "chef_projet", "is_active": True, "programme_ids": "x"}, None),
+    "email_history.by_alerte": ("email_history", {"alerte_id": "x"}, [("sent_at", -1)]),
+}
+
+# Options comparées à l'index existant : un écart (clé ou option modifiée dans le
+# registre) fait reconstruire l'index au lieu de le déclarer inchangé
+INDEX_OPTIONS = ("unique", "sparse", "partialFilterExpression", "expireAfterSeconds")
+
+def _index_spec(document: dict) -> dict:
+    """Clé et options d'un index sous une forme comparable (registre ou index_information())"""
+    spec = {"key": [(champ, int(sens) if isinstance(sens, (int, float)) else sens) for champ, sens in dict(document["key"]).items()]}
+    for option in INDEX_OPTIONS:
+        valeur = document.get(option)
+        if option in ("unique", "sparse"):
+            valeur = bool(valeur)
+        spec[option] = valeur
+    return spec
+
+async def _create_index(collection, modele: IndexModel, resultat: dict, reconstruit: bool = False):
+    """Crée un index du registre, avec repli non unique (dégradé) si des doublons existent"""
+    nom = modele.document["name"]
+    try:
+        await collection.create_indexes([modele])
+        resultat["rebuilt" if reconstruit else "created"].append(nom)
+        return
+    except OperationFailure as e:
+        if not modele.document.get("unique") or e.code != 11000:
+            logger.error(f"Échec création index {collection.name}.{nom} : {e}")
+            resultat["failed"].append(nom)
+            return
+        # Données historiques avec doublons : repli sur un index non unique, nouvel essai au prochain démarrage
+        logger.error(f"Index {collection.name}.{nom} non unique (doublons existants), contrainte non garantie : {e}")
+    options = {option: modele.document[option] for option in INDEX_OPTIONS
+               if option != "unique" and option in modele.document}
+    try:
+        await collection.create_indexes([IndexModel(list(modele.document["key"].items()), name=f"{nom}_non_unique", **options)])
+        resultat["degraded"].append(nom)
+    except OperationFailure as e:
+        logger.error(f"Échec création index {collection.name}.{nom}_non_unique : {e}")
+        resultat["failed"].append(nom)
+
+async def ensure_indexes() -> dict:
+    """Crée les index manquants du registre et reconstruit ceux dont la définition a changé ;
+    retourne {collection: {created, rebuilt, unchanged, degraded, failed}}"""
+    rapport = {}
+    for collection_name, modeles in INDEX_REGISTRY.items():
+        collection = db[collection_name]
+        existants = await collection.index_information()
+        resultat = {"created": [], "rebuilt": [], "unchanged": [], "degraded": [], "failed": []}
+        for modele in modeles:
+            nom = modele.document["name"]
+            repli = f"{nom}_non_unique"
+            if nom in existants and _index_spec(existants[nom]) == _index_spec(modele.document):
+                resultat["unchanged"].append(nom)
+                continue
+            # Définition modifiée dans le registre, ou repli non unique d'un démarrage précédent
+            # (la contrainte unique est retentée à chaque démarrage) : suppression puis recréation
+            nom_existant = nom if nom in existants else repli if repli in existants else None
+            if nom_existant:
+                logger.warning(f"Index {collection_name}.{nom_existant} différent du registre, reconstruction")
+                try:
+                    await collection.drop_index(nom_existant)
+                except OperationFailure as e:
+                    logger.error(f"Échec suppression index {collection_name}.{nom_existant} : {e}")
+                    resultat["failed"].append(nom)
+                    continue
+            await _create_index(collection, modele, resultat, reconstruit=nom_existant is not None)
+        if resultat["created"] or resultat["rebuilt"] or resultat["degraded"] or resultat["failed"]:
+            logger.info(f"Index {collection_name} - créés: {resultat['created']}, reconstruits: {resultat['rebuilt']}, "
+                        f"dégradés: {resultat['degraded']}, échecs: {resultat['failed']}, inchangés: {len(resultat['unchanged'])}")
+        else:
+            logger.info(f"Index {collection_name} - inchangés ({len(resultat['unchanged'])})")
+        rapport[collection_name] = resultat
+    return rapport
+
+async def index_registry_status() -> dict:
+    """Écarts entre les index existants et le registre : manquants, différents,
+    ou dégradés (repli non unique, contrainte unique non garantie)"""
+    rapport = {}
+    for collection_name, modeles in INDEX_REGISTRY.items():
+        existants = await db[collection_name].index_information()
+        ecarts = {"missing": [], "different": [], "degraded": []}
+        for modele in modeles:
+            nom = modele.document["name"]
+            if nom in existants:
+                if _index_spec(existants[nom]) != _index_spec(modele.document):
+                    ecarts["different"].append(nom)
+            elif f"{nom}_non_unique" in existants:
+                ecarts["degraded"].append(nom)
+            else:
+                ecarts["missing"].append(nom)
+        if any(ecarts.values()):
+            rapport[collection_name] = ecarts
+    return rapport
+
+def _index_utilises(plan) -> List[str]:
+    """Noms des index présents dans un plan d'exécution (IXSCAN, COUNT_SCAN...)"""
+    noms = []
+    if isinstance(plan, dict):
+        if plan.get("indexName"):
+            noms.append(plan["indexName"])
+        for valeur in plan.values():
+            noms.extend(_index_utilises(valeur))
+    elif isinstance(plan, list):
+        for valeur in plan:
+            noms.extend(_index_utilises(valeur))
+    return noms
+
+async def explain_query_shapes() -> dict:
+    """Index retenu par le planner pour chaque forme de requête déclarée"""
+    rapport = {}
+    for shape, (collection_name, filtre, tri) in QUERY_SHAPES.items():
+        cursor = db[collection_name].find(filtre)
+        if tri:
+            cursor = cursor.sort(tri)
+        try:
+            explain = await cursor.explain()
+            winning_plan = explain.get("queryPlanner", {}).get("winningPlan", {})
+            index_names = sorted(set(_index_utilises(winning_plan)))
+            rapport[shape] = {
+                "collection": collection_name,
+                "indexes": index_names,
+                "collection_scan": not index_names
+            }
+        except Exception as e:
+            rapport[shape] = {"collection": collection_name, "error": str(e)}
+    return rapport
+
 # Helper functions
 def calculate_remise_percentage(prix_public: float, prix_remise: float) -> float:
     if prix_public <= 0:
         return 0.0
     return round((1 - prix_remise / prix_public) * 100, 2)
 
+# =====================
+# TEMPLATES EMAIL - Rendu des variables
+# =====================
+# Le contexte de rendu (programme, partenaire, test) est chargé une fois par alerte, en
+# lot quand plusieurs brouillons sont générés. Chaque texte de template est découpé une
+# seule fois en segments, puis rendu en une passe (plus de str.replace successifs).
+
+TEMPLATE_PLACEHOLDER_PATTERN = re.compile(r"\[[^\[\]\n]+\]")
+
+@lru_cache(maxsize=256)
+def compile_template(template_text: str) -> tuple:
+    """Segments (texte littéral, placeholder ou None) d'un template"""
+    segments = []
+    position = 0
+    for match in TEMPLATE_PLACEHOLDER_PATTERN.finditer(template_text):
+        segments.append((template_text[position:match.start()], match.group(0)))
+        position = match.end()
+    segments.append((template_text[position:], None))
+    return tuple(segments)
+
+def render_template(template_text: str, values: dict) -> str:
+    """Substitue les placeholders connus en une passe ; les autres crochets restent tels quels"""
+    parts = []
+    for litteral, placeholder in compile_template(template_text):
+        parts.append(litteral)
+        if placeholder is not None:
+            parts.append(values.get(placeholder, placeholder))
+    return "".join(parts)
+
+async def build_render_contexts(alertes: List[dict]) -> dict:
+    """Map alerte_id -> valeurs des placeholders ; données liées chargées en lot"""
+    programmes = await programmes_cache.get_many(a.get('programme_id') for a in alertes)
+    partenaires = await partenaires_cache.get_many(a.get('partenaire_id') for a in alertes)
+    
+    tests = {}
+    for collection_name, alertes_type in (
+        ("tests_site", [a for a in alertes if a.get('type_test') == 'TS']),
+        ("tests_ligne", [a for a in alertes if a.get('type_test') != 'TS']),
+    ):
+        test_ids = [a['test_id'] for a in alertes_type if a.get('test_id')]
+        if test_ids:
+            async for test in db[collection_name].find({"id": {"$in": test_ids}}, {"_id": 0, "id": 1, "date_test": 1}):
+                tests[test['id']] = test
+    
+    contexts = {}
+    for alerte in alertes:
+        programme = programmes.get(alerte.get('programme_id'))
+        partenaire = partenaires.get(alerte.get('partenaire_id'))
+        test = tests.get(alerte.get('test_id'))
+        date_test = parse_date(test.get('date_test')) if test else None
+        values = {
+            '[Nom du programme]': programme['nom'] if programme else 'N/A',
+            '[Nature du problème constaté]': alerte.get('description', 'N/A'),
+            '[Date du test]': date_test.strftime('%d/%m/%Y') if date_test else 'N/A',
+            '[Nom du site / canal du test]': 'Site web' if alerte.get('type_test') == 'TS' else 'Téléphone',
+            '[Remise attendue]': f"{partenaire.get('remise_minimum', 'N/A')} %" if partenaire else 'N/A',
+            '[Observation]': alerte.get('description', 'N/A'),
+            '[Nom du contact]': partenaire.get('contact_email', 'N/A') if partenaire else 'N/A',
+        }
+        contexts[alerte['id']] = {k: str(v) for k, v in values.items()}
+    return contexts
+
 async def replace_template_variables(template_text: str, alerte_id: str) -> str:
     """Replace template variables with actual data from alerte"""
-    # Get alerte data
-    alerte = await db.alertes.find_one({"id": alerte_id})
+    alerte = await db.alertes.find_one({"id": alerte_id}, {"_id": 0})
     if not alerte:
         return template_text
+    contexts = await build_render_contexts([alerte])
+    return render_template(template_text, contexts[alerte_id])
+
+DEFAULT_EMAIL_TEMPLATE = {
+    "name": "Template par défaut",
+    "subject_template": "[Nom du programme] – [Nature du problème constaté]",
+    "body_template": """Bonjour,
+
+J'espère que vous allez bien. 
+
+Dans le cadre de nos tests à l'aveugle réalisés régulièrement sur [Nom du site / canal du test], notre équipe a relevé un point qui pourrait nécessiter une vérification de votre côté.
+
+Détails du test :
+
+Date du test : [Date du test]
+Programme concerné : [Nom du programme]
+Remise attendue : [Remise attendue]
+Observation : [Observation]
+
+Il est possible qu'il s'agisse d'un cas isolé ou lié à nos conditions de test. Nous préférons donc vous partager l'information afin que vous puissiez vérifier de votre côté et confirmer si tout fonctionne normalement.
+
+Merci de votre retour,
+Bien cordialement,""",
+}
+
+# Template par défaut en mémoire ; invalidé par les routes /email-templates
+_default_template_cache = TTLCache(maxsize=1, ttl=300)
+
+def invalidate_default_template():
+    _default_template_cache.clear()
+
+async def get_default_template() -> dict:
+    """Template par défaut (créé s'il n'existe pas)"""
+    template = _default_template_cache.get("default")
+    if template is not None:
+        return template
+    template = await db.email_templates.find_one({"is_default": True}, {"_id": 0})
+    if not template:
+        doc = EmailTemplate(**DEFAULT_EMAIL_TEMPLATE, is_default=True).model_dump()
+        doc['created_at'] = doc['created_at'].isoformat()
+        # Upsert : deux créations concurrentes ne produisent qu'un template par défaut
+        template = await db.email_templates.find_one_and_update(
+            {"is_default": True},
+            {"$setOnInsert": doc},
+            upsert=True,
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+    _default_template_cache["default"] = template
+    return template
+
+class SMTPMailer:
+    """
+    Envoi SMTP hors de la boucle asyncio. Les sessions smtplib (connexion,
+    STARTTLS, login) sont gardées dans un petit pool et réutilisées d'un message
+    à l'autre ; une session restée inactive trop longtemps ou coupée par le
+    serveur est rouverte de manière transparente.
+    """
+
+    def __init__(
+        self,
+        host: Optional[str] = None,
+        port: Optional[int] = None,
+        user: Optional[str] = None,
+        password: Optional[str] = None,
+        starttls: Optional[bool] = None,
+        pool_size: Optional[int] = None,
+        timeout: float = 30.0,
+        idle_timeout: Optional[float] = None
+    ):
+        self.host = host or os.getenv('SMTP_SERVER', 'smtp.office365.com')
+        self.port = port or int(os.getenv('SMTP_PORT', '587'))
+        self.user = user or os.getenv('SMTP_USER', 'automatisation@qwertys.fr')
+        self.password = password if password is not None else os.getenv('SMTP_PASSWORD', '')
+        self.starttls = starttls if starttls is not None else os.getenv('SMTP_STARTTLS', 'true').lower() != 'false'
+        self.pool_size = pool_size or int(os.getenv('SMTP_POOL_SIZE', '2'))
+        self.timeout = timeout
+        # Office 365 ferme les sessions inactives : au-delà, on rouvre plutôt que d'échouer
+        self.idle_timeout = idle_timeout if idle_timeout is not None else float(os.getenv('SMTP_IDLE_TIMEOUT', '60'))
+        self._sessions = queue.LifoQueue()
+        self._executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="smtp")
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.errors = 0
+        self.connections_opened = 0
+        self.sessions_reused = 0
+
+    @property
+    def configured(self) -> bool:
+        return bool(self.password)
+
+    def _count(self, attribut: str):
+        with self._lock:
+            setattr(self, attribut, getattr(self, attribut) + 1)
+
+    def _open(self) -> smtplib.SMTP:
+        smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            smtp.ehlo()
+            if self.starttls:
+                smtp.starttls()
+                smtp.ehlo()
+            if self.password:
+                smtp.login(self.user, self.password)
+        except Exception:
+            self._close(smtp)
+            raise
+        self._count("connections_opened")
+        return smtp
+
+    @staticmethod
+    def _close(smtp: smtplib.SMTP):
+        try:
+            smtp.quit()
+        except Exception:
+            try:
+                smtp.close()
+            except Exception:
+                pass
+
+    def _acquire(self) -> smtplib.SMTP:
+        while True:
+            try:
+                smtp, last_used = self._sessions.get_nowait()
+            except queue.Empty:
+                return self._open()
+            if monotonic() - last_used > self.idle_timeout:
+                self._close(smtp)
+                continue
+            self._count("sessions_reused")
+            return smtp
+
+    def _release(self, smtp: smtplib.SMTP):
+        self._sessions.put((smtp, monotonic()))
+
+    def _send_sync(self, msg):
+        smtp = self._acquire()
+        try:
+            try:
+                smtp.send_message(msg)
+            except (smtplib.SMTPServerDisconnected, ConnectionError):
+                # Session coupée côté serveur : une seconde tentative sur une connexion neuve
+                self._close(smtp)
+                smtp = self._open()
+                smtp.send_message(msg)
+        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError):
+            # Message refusé mais session saine : elle retourne dans le pool
+            self._release(smtp)
+            self._count("errors")
+            raise
+        except Exception:
+            self._close(smtp)
+            self._count("errors")
+            raise
+        self._release(smtp)
+        self._count("sent")
+
+    async def send(self, msg):
+        """Envoie un message sans bloquer la boucle asyncio"""
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._send_sync, msg)
+
+    def close(self):
+        while True:
+            try:
+                smtp, _ = self._sessions.get_nowait()
+            except queue.Empty:
+                break
+            self._close(smtp)
+
+    def stats(self) -> dict:
+        return {
+            "sent": self.sent,
+            "errors": self.errors,
+            "connections_opened": self.connections_opened,
+            "sessions_reused": self.sessions_reused,
+            "idle_sessions": self._sessions.qsize(),
+            "pool_size": self.pool_size
+        }
+
+smtp_mailer = SMTPMailer()
+
+def build_email_message(sender: str, recipient: str, subject: str, body: str, signature: str = "") -> MIMEMultipart:
+    msg = MIMEMultipart()
+    msg['From'] = sender
+    msg['To'] = recipient
+    msg['Subject'] = subject
     
-    # Get related data
-    programme = await db.programmes.find_one({"id": alerte.get('programme_id')}) if alerte.get('programme_id') else None
-    partenaire = await db.partenaires.find_one({"id": alerte.get('partenaire_id')}) if alerte.get('partenaire_id') else None
-    
-    # Get test data
-    test = None
-    if alerte['type_test'] == 'TS':
-        test = await db.tests_site.find_one({"id": alerte['test_id']})
-    else:
-        test = await db.tests_ligne.find_one({"id": alerte['test_id']})
-    
-    # Build replacement dictionary
-    replacements = {
-        '[Nom du programme]': programme['nom'] if programme else 'N/A',
-        '[Nature du problème constaté]': alerte.get('description', 'N/A'),
-        '[Date du test]': datetime.fromisoformat(test['date_test']).strftime('%d/%m/%Y') if test and test.get('date_test') else 'N/A',
-        '[Nom du site / canal du test]': 'Site web' if alerte['type_test'] == 'TS' else 'Téléphone',
-        '[Remise attendue]': f"{partenaire.get('remise_minimum', 'N/A')} %" if partenaire else 'N/A',
-        '[Observation]': alerte.get('description', 'N/A'),
-        '[Nom du contact]': partenaire.get('contact_email', 'N/A') if partenaire else 'N/A',
-    }
-    
-    # Replace variables
-    for key, value in replacements.items():
-        template_text = template_text.replace(key, str(value))
+    # Add body with signature
+    full_body = body
+    if signature:
+        full_body += f"\n\n{signature}"
     
-    return template_text
+    msg.attach(MIMEText(full_body, 'plain'))
+    return msg
 
 async def send_email_smtp(recipient: str, subject: str, body: str, signature: str = "") -> dict:
-    """Send email via SMTP Outlook"""
+    """Send email via SMTP Outlook (session mutualisée, hors de la boucle asyncio)"""
     try:
-        # Get SMTP configuration from environment
-        smtp_server = os.getenv('SMTP_SERVER', 'smtp.office365.com')
-        smtp_port = int(os.getenv('SMTP_PORT', '587'))
-        smtp_user = os.getenv('SMTP_USER', 'automatisation@qwertys.fr')
-        smtp_password = os.getenv('SMTP_PASSWORD', '')
-        
-        if not smtp_password:
+        if not smtp_mailer.configured:
             return {"status": "error", "message": "SMTP configuration not available"}
         
-        # Create message
-        msg = MIMEMultipart()
-        msg['From'] = smtp_user
-        msg['To'] = recipient
-        msg['Subject'] = subject
-        
-        # Add body with signature
-        full_body = body
-        if signature:
-            full_body += f"\n\n{signature}"
-        
-        msg.attach(MIMEText(full_body, 'plain'))
-        
-        # Send email
-        server = smtplib.SMTP(smtp_server, smtp_port)
-        server.starttls()
-        server.login(smtp_user, smtp_password)
-        server.send_message(msg)
-        server.quit()
+        msg = build_email_message(smtp_mailer.user, recipient, subject, body, signature)
+        await smtp_mailer.send(msg)
         
         return {"status": "success", "message": "Email sent successfully"}
     except Exception as e:
         logging.error(f"SMTP Error: {str(e)}")
         return {"status": "error", "message": str(e)}
 
-async def create_email_draft_for_alerte(alerte_id: str):
-    """Automatically create an email draft when an alerte is created"""
+# =====================
+# EMAIL OUTBOX - File d'envoi durable
+# =====================
+# Les envois groupés passent par la collection email_outbox : un worker de fond
+# réclame les messages dus par lots, les envoie à débit limité sur les sessions
+# SMTP mutualisées, replanifie les échecs temporaires avec un backoff exponentiel
+# et répercute les résultats en écritures groupées (brouillons, historique, alertes).
+
+EMAIL_OUTBOX_BATCH_SIZE = int(os.getenv('EMAIL_OUTBOX_BATCH_SIZE', '20'))
+EMAIL_OUTBOX_RATE = float(os.getenv('EMAIL_OUTBOX_RATE', '2'))  # messages par seconde
+EMAIL_OUTBOX_MAX_ATTEMPTS = int(os.getenv('EMAIL_OUTBOX_MAX_ATTEMPTS', '5'))
+EMAIL_OUTBOX_BACKOFF = float(os.getenv('EMAIL_OUTBOX_BACKOFF', '30'))  # secondes, doublé à chaque tentative
+EMAIL_OUTBOX_BACKOFF_MAX = 3600.0
+EMAIL_OUTBOX_POLL_INTERVAL = 10.0
+EMAIL_OUTBOX_LEASE = timedelta(minutes=5)
+
+class RateLimiter:
+    """Espace les acquisitions pour ne pas dépasser `rate` opérations par seconde"""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            attente = self._next - monotonic()
+            if attente > 0:
+                await asyncio.sleep(attente)
+            self._next = max(self._next, monotonic()) + self.interval
+
+class EmailOutboxStats:
+    """Compteurs du worker d'envoi et débit sur la dernière minute"""
+
+    WINDOW = 60.0
+
+    def __init__(self):
+        self.enqueued = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self._sent_times = deque()
+
+    def record_sent(self, count: int):
+        now = monotonic()
+        self.sent += count
+        self._sent_times.extend([now] * count)
+        while self._sent_times and now - self._sent_times[0] > self.WINDOW:
+            self._sent_times.popleft()
+
+    def stats(self) -> dict:
+        now = monotonic()
+        while self._sent_times and now - self._sent_times[0] > self.WINDOW:
+            self._sent_times.popleft()
+        return {
+            "enqueued": self.enqueued,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "sent_last_minute": len(self._sent_times)
+        }
+
+email_outbox_stats = EmailOutboxStats()
+email_outbox_wakeup = asyncio.Event()
+
+def _erreur_smtp_definitive(erreur: Exception) -> bool:
+    """Refus du destinataire ou code 5xx : inutile de réessayer"""
+    if isinstance(erreur, smtplib.SMTPRecipientsRefused):
+        return True
+    return isinstance(erreur, smtplib.SMTPResponseException) and erreur.smtp_code >= 500
+
+def _outbox_backoff(attempts: int) -> timedelta:
+    return timedelta(seconds=min(EMAIL_OUTBOX_BACKOFF * 2 ** (attempts - 1), EMAIL_OUTBOX_BACKOFF_MAX))
+
+async def enqueue_email_drafts(draft_filter: dict, signature_text: str = "") -> dict:
+    """
+    Met en file les brouillons correspondant à draft_filter. Les messages sont écrits
+    d'abord, sous l'index unique active_draft_id (posé tant que le message est en attente
+    ou en cours d'envoi) : un brouillon n'a jamais deux messages actifs, même pour des
+    demandes concurrentes ou rejouées. Les brouillons passent ensuite à queued ; un arrêt
+    entre les deux étapes laisse un message qui sera envoyé normalement.
+    """
+    batch_id = str(uuid.uuid4())
+    now = datetime.now(timezone.utc)
+    drafts = await db.email_drafts.find(
+        {**draft_filter, "status": EmailDraftStatus.draft.value},
+        {"_id": 0, "id": 1, "alerte_id": 1, "recipient": 1, "subject": 1, "body": 1}
+    ).to_list(length=None)
+    if not drafts:
+        return {"batch_id": batch_id, "queued": 0}
+    
+    messages = [
+        {
+            "id": str(uuid.uuid4()),
+            "batch_id": batch_id,
+            "draft_id": draft["id"],
+            "active_draft_id": draft["id"],
+            "alerte_id": draft.get("alerte_id"),
+            "recipient": draft["recipient"],
+            "subject": draft["subject"],
+            "body": draft["body"],
+            "signature_text": signature_text,
+            "status": "pending",
+            "attempts": 0,
+            "next_attempt_at": now,
+            "created_at": now,
+        }
+        for draft in drafts
+    ]
+    deja_en_file = set()
     try:
-        # Get alerte
-        alerte = await db.alertes.find_one({"id": alerte_id})
-        if not alerte:
-            return
-        
-        # Get partenaire to get recipient email
-        partenaire = await db.partenaires.find_one({"id": alerte.get('partenaire_id')}) if alerte.get('partenaire_id') else None
-        if not partenaire or not partenaire.get('contact_email'):
-            logging.warning(f"No contact email for alerte {alerte_id}")
+        await db.email_outbox.insert_many(messages, ordered=False)
+    except BulkWriteError as e:
+        erreurs = e.details.get("writeErrors", [])
+        if any(erreur.get("code") != 11000 for erreur in erreurs):
+            raise
+        # Message actif déjà présent pour ces brouillons (demande concurrente ou rejouée)
+        deja_en_file = {messages[erreur["index"]]["draft_id"] for erreur in erreurs}
+        # Rejeu après un arrêt : le brouillon rejoint le lot de son message existant
+        existants = await db.email_outbox.find(
+            {"active_draft_id": {"$in": list(deja_en_file)}}, {"_id": 0, "draft_id": 1, "batch_id": 1}
+        ).to_list(length=None)
+        if existants:
+            await db.email_drafts.bulk_write([
+                UpdateOne(
+                    {"id": message["draft_id"], "status": EmailDraftStatus.draft.value},
+                    {"$set": {"status": EmailDraftStatus.queued.value, "outbox_batch_id": message["batch_id"]}}
+                )
+                for message in existants
+            ], ordered=False)
+    
+    draft_ids = [draft["id"] for draft in drafts if draft["id"] not in deja_en_file]
+    if draft_ids:
+        await db.email_drafts.update_many(
+            {"id": {"$in": draft_ids}, "status": EmailDraftStatus.draft.value},
+            {"$set": {"status": EmailDraftStatus.queued.value, "outbox_batch_id": batch_id}}
+        )
+        email_outbox_stats.enqueued += len(draft_ids)
+        email_outbox_wakeup.set()
+    return {"batch_id": batch_id, "queued": len(draft_ids)}
+
+async def recover_queued_drafts() -> int:
+    """
+    Remet en brouillon les brouillons queued sans message actif dans la file (échec
+    définitif de l'envoi juste avant leur passage en queued, file écrite par une version
+    antérieure) ; retourne le nombre de brouillons récupérés.
+    """
+    queued = await db.email_drafts.find({"status": EmailDraftStatus.queued.value}, {"_id": 0, "id": 1}).to_list(length=None)
+    if not queued:
+        return 0
+    draft_ids = [draft["id"] for draft in queued]
+    actifs = set(await db.email_outbox.distinct(
+        "draft_id", {"draft_id": {"$in": draft_ids}, "status": {"$in": ["pending", "sending"]}}
+    ))
+    orphelins = [draft_id for draft_id in draft_ids if draft_id not in actifs]
+    if not orphelins:
+        return 0
+    result = await db.email_drafts.update_many(
+        {"id": {"$in": orphelins}, "status": EmailDraftStatus.queued.value},
+        {"$set": {"status": EmailDraftStatus.draft.value}, "$unset": {"outbox_batch_id": ""}}
+    )
+    if result.modified_count:
+        logger.warning(f"{result.modified_count} brouillon(s) queued sans message en file remis en brouillon")
+    return result.modified_count
+
+async def _claim_outbox_batch() -> List[dict]:
+    """Réclame un lot de messages dus (ou dont le worker précédent a expiré)"""
+    now = datetime.now(timezone.utc)
+    dus = {"$or": [
+        {"status": "pending", "next_attempt_at": {"$lte": now}},
+        {"status": "sending", "locked_until": {"$lt": now}},
+    ]}
+    candidats = await db.email_outbox.find(dus, {"_id": 0, "id": 1}).sort("next_attempt_at", 1).limit(EMAIL_OUTBOX_BATCH_SIZE).to_list(EMAIL_OUTBOX_BATCH_SIZE)
+    if not candidats:
+        return []
+    claim_id = str(uuid.uuid4())
+    await db.email_outbox.update_many(
+        {"id": {"$in": [c["id"] for c in candidats]}, **dus},
+        {"$set": {"status": "sending", "claim_id": claim_id, "locked_by": WORKER_ID, "locked_until": now + EMAIL_OUTBOX_LEASE}}
+    )
+    return await db.email_outbox.find({"claim_id": claim_id, "status": "sending"}, {"_id": 0}).to_list(length=None)
+
+async def process_email_outbox_batch(rate_limiter: RateLimiter) -> int:
+    """Envoie un lot de la file et enregistre les résultats ; renvoie le nombre de messages traités"""
+    messages = await _claim_outbox_batch()
+    if not messages:
+        return 0
+    
+    semaphore = asyncio.Semaphore(smtp_mailer.pool_size)
+    
+    async def envoyer(message):
+        async with semaphore:
+            await rate_limiter.acquire()
+            msg = build_email_message(smtp_mailer.user, message["recipient"], message["subject"], message["body"], message.get("signature_text", ""))
+            try:
+                await smtp_mailer.send(msg)
+                return None
+            except Exception as e:
+                return e
+    
+    erreurs = await asyncio.gather(*(envoyer(m) for m in messages))
+    now = datetime.now(timezone.utc)
+    
+    outbox_ops = []
+    history_docs = []
+    envoyes, echoues = [], []
+    for message, erreur in zip(messages, erreurs):
+        attempts = message.get("attempts", 0) + 1
+        if erreur is None:
+            envoyes.append(message)
+            outbox_ops.append(UpdateOne(
+                {"id": message["id"], "claim_id": message["claim_id"]},
+                {"$set": {"status": "sent", "attempts": attempts, "sent_at": now, "last_error": None},
+                 "$unset": {"active_draft_id": ""}}
+            ))
+        elif attempts >= EMAIL_OUTBOX_MAX_ATTEMPTS or _erreur_smtp_definitive(erreur):
+            echoues.append(message)
+            outbox_ops.append(UpdateOne(
+                {"id": message["id"], "claim_id": message["claim_id"]},
+                {"$set": {"status": "failed", "attempts": attempts, "last_error": str(erreur)},
+                 "$unset": {"active_draft_id": ""}}
+            ))
+        else:
+            email_outbox_stats.retried += 1
+            outbox_ops.append(UpdateOne(
+                {"id": message["id"], "claim_id": message["claim_id"]},
+                {"$set": {"status": "pending", "attempts": attempts, "last_error": str(erreur),
+                          "next_attempt_at": now + _outbox_backoff(attempts)}}
+            ))
+            continue
+        signature_text = message.get("signature_text", "")
+        history = EmailHistory(
+            alerte_id=message["alerte_id"],
+            draft_id=message["draft_id"],
+            recipient=message["recipient"],
+            subject=message["subject"],
+            body=message["body"] + f"\n\n{signature_text}" if erreur is None and signature_text else message["body"],
+            status='success' if erreur is None else 'failed',
+            error_message=None if erreur is None else str(erreur)
+        )
+        history_doc = history.model_dump()
+        history_doc['sent_at'] = history_doc['sent_at'].isoformat()
+        history_docs.append(history_doc)
+    
+    await db.email_outbox.bulk_write(outbox_ops, ordered=False)
+    if history_docs:
+        await db.email_history.insert_many(history_docs, ordered=False)
+    if envoyes:
+        await db.email_drafts.update_many(
+            {"id": {"$in": [m["draft_id"] for m in envoyes]}},
+            {"$set": {"status": EmailDraftStatus.sent.value, "sent_at": now.isoformat()}, "$unset": {"outbox_batch_id": ""}}
+        )
+        alerte_ids = list({m["alerte_id"] for m in envoyes if m.get("alerte_id")})
+        if alerte_ids:
+            await db.alertes.update_many({"id": {"$in": alerte_ids}}, {"$set": {"statut": "resolu", "updated_at": now}})
+        email_outbox_stats.record_sent(len(envoyes))
+    if echoues:
+        # Échec définitif : le brouillon redevient modifiable et renvoyable
+        await db.email_drafts.update_many(
+            {"id": {"$in": [m["draft_id"] for m in echoues]}},
+            {"$set": {"status": EmailDraftStatus.draft.value}, "$unset": {"outbox_batch_id": ""}}
+        )
+        email_outbox_stats.failed += len(echoues)
+    return len(messages)
+
+async def email_outbox_depth() -> dict:
+    """Nombre de messages de la file par statut"""
+    pipeline = [{"$group": {"_id": "$status", "count": {"$sum": 1}}}]
+    depth = {"pending": 0, "sending": 0, "sent": 0, "failed": 0}
+    async for row in db.email_outbox.aggregate(pipeline):
+        depth[row["_id"]] = row["count"]
+    return depth
+
+async def email_outbox_worker():
+    """Tâche de fond : vide la file tant qu'il y a des messages dus, sinon attend un réveil ou le prochain sondage"""
+    rate_limiter = RateLimiter(EMAIL_OUTBOX_RATE)
+    while True:
+        try:
+            if smtp_mailer.configured and await process_email_outbox_batch(rate_limiter):
+                continue
+            # File vide : récupération des brouillons restés queued sans message
+            await recover_queued_drafts()
+        except Exception as e:
+            logger.error(f"Erreur worker email_outbox : {e}")
+        email_outbox_wakeup.clear()
+        try:
+            await asyncio.wait_for(email_outbox_wakeup.wait(), timeout=EMAIL_OUTBOX_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+# =====================
+# TÂCHES DE FOND - Effets de bord hors du chemin des requêtes
+# =====================
+# Brouillon d'email et notifications d'une alerte sont traités après la réponse HTTP
+# par une file en mémoire. La clé d'idempotence évite qu'un même effet soit planifié
+# deux fois ; un effet qui lève une exception est rejoué avec un backoff exponentiel.
+
+class BackgroundTaskQueue:
+    """File de tâches asyncio en mémoire avec retry, clés d'idempotence et join()"""
+
+    def __init__(self, name: str, workers: int = 2, max_attempts: int = 3, backoff: float = 0.5, done_ttl: int = 3600):
+        self.name = name
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self._queue = None
+        self._loop = None
+        self._tasks = []
+        self._pending = set()
+        # Clés traitées avec succès récemment : une nouvelle demande est ignorée
+        self._done = TTLCache(maxsize=10000, ttl=done_ttl)
+        self.enqueued = 0
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+        self.duplicates = 0
+
+    def _ensure_workers(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
             return
-        
-        # Get default template
-        default_template = await db.email_templates.find_one({"is_default": True})
-        if not default_template:
-            # Create default template if it doesn't exist
-            default_template = EmailTemplate(
-                name="Template par défaut",
-                subject_template="[Nom du programme] – [Nature du problème constaté]",
-                body_template="""Bonjour,
+        self._loop = loop
+        self._queue = asyncio.Queue()
+        self._pending.clear()
+        self._tasks = [loop.create_task(self._worker()) for _ in range(self.workers)]
+
+    def enqueue(self, key: str, func, *args, **kwargs) -> bool:
+        """Planifie func(*args, **kwargs) ; False si la clé est déjà en file ou traitée"""
+        self._ensure_workers()
+        if key in self._pending or key in self._done:
+            self.duplicates += 1
+            return False
+        self._pending.add(key)
+        self._queue.put_nowait((key, func, args, kwargs))
+        self.enqueued += 1
+        return True
+
+    async def _worker(self):
+        while True:
+            key, func, args, kwargs = await self._queue.get()
+            try:
+                for attempt in range(1, self.max_attempts + 1):
+                    try:
+                        await func(*args, **kwargs)
+                    except Exception as e:
+                        if attempt == self.max_attempts:
+                            self.failed += 1
+                            logger.error(f"Tâche {key} abandonnée après {attempt} tentative(s) : {e}")
+                        else:
+                            self.retried += 1
+                            logger.warning(f"Tâche {key} en échec (tentative {attempt}) : {e}")
+                            await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+                    else:
+                        self.completed += 1
+                        self._done[key] = True
+                        break
+            finally:
+                self._pending.discard(key)
+                self._queue.task_done()
 
-J'espère que vous allez bien. 
+    async def join(self, timeout: Optional[float] = None):
+        """Attend que toutes les tâches planifiées soient terminées (succès ou abandon)"""
+        if self._queue is None or self._loop is not asyncio.get_running_loop():
+            return
+        await asyncio.wait_for(self._queue.join(), timeout)
 
-Dans le cadre de nos tests à l'aveugle réalisés régulièrement sur [Nom du site / canal du test], notre équipe a relevé un point qui pourrait nécessiter une vérification de votre côté.
+    def close(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        self._loop = None
 
-Détails du test :
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "in_flight": len(self._pending),
+            "enqueued": self.enqueued,
+            "completed": self.completed,
+            "failed": self.failed,
+            "retried": self.retried,
+            "duplicates": self.duplicates
+        }
 
-Date du test : [Date du test]
-Programme concerné : [Nom du programme]
-Remise attendue : [Remise attendue]
-Observation : [Observation]
+side_effects_queue = BackgroundTaskQueue(
+    "alerte_side_effects",
+    workers=int(os.getenv('SIDE_EFFECTS_WORKERS', '2'))
+)
 
-Il est possible qu'il s'agisse d'un cas isolé ou lié à nos conditions de test. Nous préférons donc vous partager l'information afin que vous puissiez vérifier de votre côté et confirmer si tout fonctionne normalement.
+def dispatch_alerte_side_effects(alerte_id: str, programme_id: Optional[str], partenaire_id: Optional[str], description: str):
+    """Planifie le brouillon d'email et les notifications chefs de projet d'une alerte enregistrée"""
+    side_effects_queue.enqueue(f"email_draft:{alerte_id}", create_email_draft_for_alerte, alerte_id)
+    if programme_id:
+        side_effects_queue.enqueue(
+            f"notifications:{alerte_id}",
+            create_notifications_for_chefs_projet, alerte_id, programme_id, partenaire_id, description
+        )
 
-Merci de votre retour,
-Bien cordialement,""",
-                is_default=True
-            )
-            doc = default_template.model_dump()
-            doc['created_at'] = doc['created_at'].isoformat()
-            await db.email_templates.insert_one(doc)
-        
-        # Replace variables in template
-        # Handle both dict (from DB) and EmailTemplate object (newly created)
-        if isinstance(default_template, dict):
-            subject_template = default_template['subject_template']
-            body_template = default_template['body_template']
-            template_id = default_template['id']
-        else:
-            subject_template = default_template.subject_template
-            body_template = default_template.body_template
-            template_id = default_template.id
-            
-        subject = await replace_template_variables(subject_template, alerte_id)
-        body = await replace_template_variables(body_template, alerte_id)
-        
-        # Create draft
+async def create_email_drafts_for_alertes(alerte_ids: List[str]) -> int:
+    """Crée les brouillons d'un lot d'alertes qui n'en ont pas encore ; renvoie le nombre créé"""
+    deja_crees = {
+        d['alerte_id'] for d in await db.email_drafts.find({"alerte_id": {"$in": alerte_ids}}, {"_id": 0, "alerte_id": 1}).to_list(None)
+    }
+    alertes = await db.alertes.find(
+        {"id": {"$in": [alerte_id for alerte_id in alerte_ids if alerte_id not in deja_crees]}}, {"_id": 0}
+    ).to_list(None)
+    if not alertes:
+        return 0
+    
+    template = await get_default_template()
+    contexts = await build_render_contexts(alertes)
+    partenaires = await partenaires_cache.get_many(a.get('partenaire_id') for a in alertes)
+    
+    docs = []
+    for alerte in alertes:
+        partenaire = partenaires.get(alerte.get('partenaire_id'))
+        if not partenaire or not partenaire.get('contact_email'):
+            logging.warning(f"No contact email for alerte {alerte['id']}")
+            continue
+        values = contexts[alerte['id']]
         draft = EmailDraft(
-            alerte_id=alerte_id,
-            template_id=template_id,
-            subject=subject,
-            body=body,
+            alerte_id=alerte['id'],
+            template_id=template['id'],
+            subject=render_template(template['subject_template'], values),
+            body=render_template(template['body_template'], values),
             recipient=partenaire['contact_email'],
             status=EmailDraftStatus.draft
         )
         doc = draft.model_dump()
         doc['created_at'] = doc['created_at'].isoformat()
-        await db.email_drafts.insert_one(doc)
-        
-        logging.info(f"Email draft created for alerte {alerte_id}")
+        docs.append(doc)
+    
+    if not docs:
+        return 0
+    # Upsert sur alerte_id (index unique) : deux créations concurrentes ne produisent qu'un brouillon
+    try:
+        result = await db.email_drafts.bulk_write([
+            UpdateOne({"alerte_id": doc["alerte_id"]}, {"$setOnInsert": doc}, upsert=True)
+            for doc in docs
+        ], ordered=False)
+        return result.upserted_count
+    except BulkWriteError as e:
+        if any(erreur.get("code") != 11000 for erreur in e.details.get("writeErrors", [])):
+            raise
+        return e.details.get("nUpserted", 0)
+
+async def create_email_draft_for_alerte(alerte_id: str):
+    """Automatically create an email draft when an alerte is created"""
+    try:
+        # Idempotent : une tâche rejouée ne crée pas de second brouillon
+        if await create_email_drafts_for_alertes([alerte_id]):
+            logging.info(f"Email draft created for alerte {alerte_id}")
     except Exception as e:
         logging.error(f"Error creating email draft: {str(e)}")
+        raise
 
 async def check_and_create_alerte(test_id: str, type_test: TypeTest, description: str, programme_id: str = None, partenaire_id: str = None, user_id: str = None):
     """Ancienne fonction - conservée pour compatibilité"""
@@ -690,15 +2004,10 @@ async def check_and_create_alerte(test_id: str, type_test: TypeTest, description
         user_id=user_id
     )
     doc = alerte.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
     await db.alertes.insert_one(doc)
     
-    # Automatically create email draft for this alerte
-    await create_email_draft_for_alerte(alerte.id)
-    
-    # Create notifications for relevant chefs de projet
-    if programme_id:
-        await create_notifications_for_chefs_projet(alerte.id, programme_id, partenaire_id, description)
+    # Brouillon d'email et notifications en tâche de fond
+    dispatch_alerte_side_effects(alerte.id, programme_id, partenaire_id, description)
 
 async def create_alerte_groupee(test_id: str, type_test: TypeTest, points_attention: List[str], programme_id: str = None, partenaire_id: str = None, user_id: str = None):
     """Nouvelle fonction - Créer UNE SEULE alerte avec plusieurs points d'attention"""
@@ -723,66 +2032,554 @@ async def create_alerte_groupee(test_id: str, type_test: TypeTest, points_attent
         user_id=user_id
     )
     doc = alerte.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
     await db.alertes.insert_one(doc)
     
-    # Automatically create email draft for this alerte
-    await create_email_draft_for_alerte(alerte.id)
+    # Brouillon d'email et notifications en tâche de fond : la requête ne les attend pas
+    # Utiliser tous les points d'attention dans la notification
+    description_complete = description + ": " + "; ".join(points_attention)
+    dispatch_alerte_side_effects(alerte.id, programme_id, partenaire_id, description_complete)
+
+# =====================
+# NOTIFICATIONS TEMPS RÉEL - Pub/sub en mémoire
+# =====================
+# Chaque onglet connecté à /api/notifications/stream (SSE) est un abonné avec sa propre
+# file. Avec un seul worker, create_notifications_for_chefs_projet publie directement ;
+# en déploiement multi-workers (NOTIFICATIONS_CHANGE_STREAM=true), chaque worker suit
+# les insertions de la collection notifications via un change stream MongoDB.
+
+NOTIFICATIONS_CHANGE_STREAM = os.getenv('NOTIFICATIONS_CHANGE_STREAM', 'false').lower() == 'true'
+NOTIFICATION_STREAM_KEEPALIVE = 25.0  # secondes, sous les délais d'inactivité des proxys
+
+class NotificationBroker:
+    """Diffusion en mémoire des événements de notification vers les abonnés d'un utilisateur"""
+
+    def __init__(self, queue_size: int = 100):
+        self.queue_size = queue_size
+        self._subscribers = {}  # user_id -> set(asyncio.Queue)
+        self.backend = "change_stream" if NOTIFICATIONS_CHANGE_STREAM else "memory"
+        self.published = 0
+        self.dropped = 0
+
+    def subscribe(self, user_id: str) -> asyncio.Queue:
+        file_evenements = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers.setdefault(user_id, set()).add(file_evenements)
+        return file_evenements
+
+    def unsubscribe(self, user_id: str, file_evenements: asyncio.Queue):
+        abonnes = self._subscribers.get(user_id)
+        if abonnes is None:
+            return
+        abonnes.discard(file_evenements)
+        if not abonnes:
+            del self._subscribers[user_id]
+
+    def publish(self, user_id: str, event_type: str, data: dict):
+        for file_evenements in self._subscribers.get(user_id, ()):
+            try:
+                file_evenements.put_nowait({"type": event_type, "data": data})
+                self.published += 1
+            except asyncio.QueueFull:
+                # Abonné trop lent : l'événement est perdu, le compteur sera resynchronisé à la reconnexion
+                self.dropped += 1
+
+    def publish_notifications(self, docs: List[dict]):
+        """Publication locale, sauf si le change stream s'en charge pour tous les workers"""
+        if self.backend != "memory":
+            return
+        for doc in docs:
+            self.publish(doc['user_id'], "notification", {k: v for k, v in doc.items() if k != '_id'})
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.backend,
+            "users": len(self._subscribers),
+            "subscribers": sum(len(abonnes) for abonnes in self._subscribers.values()),
+            "published": self.published,
+            "dropped": self.dropped
+        }
+
+notification_broker = NotificationBroker()
+
+async def notification_change_stream_worker():
+    """Tâche de fond : relaie au broker local les notifications insérées par n'importe quel worker"""
+    while True:
+        try:
+            async with db.notifications.watch([{"$match": {"operationType": "insert"}}]) as stream:
+                notification_broker.backend = "change_stream"
+                async for change in stream:
+                    doc = change["fullDocument"]
+                    notification_broker.publish(doc['user_id'], "notification", {k: v for k, v in doc.items() if k != '_id'})
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Change streams indisponibles (MongoDB sans replica set) : publication locale
+            logger.warning(f"Change stream notifications indisponible, publication locale : {e}")
+            notification_broker.backend = "memory"
+        await asyncio.sleep(30)
+
+# =====================
+# COMPTEURS DE NOTIFICATIONS NON LUES
+# =====================
+# Un document par utilisateur dans notification_counters, tenu à jour par $inc à la
+# création et à la lecture des notifications : le badge est une lecture ponctuelle.
+# Un job de réconciliation recalcule périodiquement les compteurs et corrige les écarts.
+
+NOTIFICATION_COUNTERS_RECONCILE_INTERVAL = float(os.getenv('NOTIFICATION_COUNTERS_RECONCILE_INTERVAL', '3600'))
+notification_counters_state = {"last_run": None, "checked": 0, "repaired": 0}
+
+async def increment_unread_counters(user_ids: List[str]):
+    """+1 sur le compteur de chaque destinataire (un aller-retour pour tout le lot)"""
+    if not user_ids:
+        return
+    now = datetime.now(timezone.utc)
+    await db.notification_counters.bulk_write([
+        UpdateOne({"user_id": user_id}, {"$inc": {"unread": 1}, "$set": {"updated_at": now}}, upsert=True)
+        for user_id in user_ids
+    ], ordered=False)
+
+async def decrement_unread_counter(user_id: str, count: int = 1):
+    if count <= 0:
+        return
+    await db.notification_counters.update_one(
+        {"user_id": user_id},
+        {"$inc": {"unread": -count}, "$set": {"updated_at": datetime.now(timezone.utc)}}
+    )
+
+async def get_unread_notification_count(user_id: str) -> int:
+    """Lecture du compteur ; initialisé depuis les notifications au premier accès"""
+    counter = await db.notification_counters.find_one({"user_id": user_id}, {"_id": 0, "unread": 1})
+    if counter is None:
+        unread = await db.notifications.count_documents({"user_id": user_id, "read": False})
+        # $setOnInsert : un $inc concurrent déjà appliqué n'est pas écrasé
+        await db.notification_counters.update_one(
+            {"user_id": user_id},
+            {"$setOnInsert": {"unread": unread, "updated_at": datetime.now(timezone.utc)}},
+            upsert=True
+        )
+        return unread
+    return max(0, counter.get("unread", 0))
+
+async def reconcile_notification_counters() -> dict:
+    """
+    Recalcule les compteurs depuis les notifications et corrige les écarts. Les compteurs
+    sont lus avant l'agrégation et la correction est conditionnée à la valeur lue : un
+    compteur modifié entre-temps est laissé à la prochaine passe.
+    """
+    counters = {
+        c["user_id"]: c.get("unread", 0)
+        async for c in db.notification_counters.find({}, {"_id": 0, "user_id": 1, "unread": 1})
+    }
+    reels = {
+        row["_id"]: row["count"]
+        async for row in db.notifications.aggregate([
+            {"$match": {"read": False}},
+            {"$group": {"_id": "$user_id", "count": {"$sum": 1}}}
+        ])
+    }
+    
+    now = datetime.now(timezone.utc)
+    operations = []
+    for user_id, observe in counters.items():
+        reel = reels.get(user_id, 0)
+        if observe != reel:
+            operations.append(UpdateOne(
+                {"user_id": user_id, "unread": observe},
+                {"$set": {"unread": reel, "updated_at": now, "reconciled_at": now}}
+            ))
+    for user_id, reel in reels.items():
+        if user_id not in counters:
+            operations.append(UpdateOne(
+                {"user_id": user_id},
+                {"$setOnInsert": {"unread": reel, "updated_at": now, "reconciled_at": now}},
+                upsert=True
+            ))
+    
+    repaired = 0
+    if operations:
+        result = await db.notification_counters.bulk_write(operations, ordered=False)
+        repaired = result.modified_count + result.upserted_count
+    
+    notification_counters_state["last_run"] = now.isoformat()
+    notification_counters_state["checked"] = len(set(counters) | set(reels))
+    notification_counters_state["repaired"] += repaired
+    if repaired:
+        logger.warning(f"Compteurs de notifications : {repaired} écart(s) corrigé(s)")
+    return {"checked": notification_counters_state["checked"], "repaired": repaired}
+
+async def notification_counters_reconciler():
+    """Tâche de fond : réconciliation périodique des compteurs de notifications"""
+    while True:
+        try:
+            await reconcile_notification_counters()
+        except Exception as e:
+            logger.error(f"Erreur réconciliation des compteurs de notifications : {e}")
+        await asyncio.sleep(NOTIFICATION_COUNTERS_RECONCILE_INTERVAL)
+
+# =====================
+# RÉTENTION - Archivage mensuel des collections d'historique
+# =====================
+# notifications et connection_logs grossissent sans fin. Un job quotidien déplace les
+# documents plus anciens que la durée de rétention vers des collections d'archive
+# mensuelles compressées (<collection>_archive_YYYY_MM). L'insertion conserve les _id :
+# une passe interrompue puis rejouée ignore les documents déjà archivés.
+
+RETENTION_POLICIES = {
+    "notifications": {"champ": "created_at", "jours": int(os.getenv('NOTIFICATIONS_RETENTION_DAYS', '90'))},
+    "connection_logs": {"champ": "login_time", "jours": int(os.getenv('CONNECTION_LOGS_RETENTION_DAYS', '365'))},
+}
+RETENTION_BATCH_SIZE = 1000
+RETENTION_PAUSE = float(os.getenv('RETENTION_PAUSE', '0.05'))  # secondes entre deux lots
+RETENTION_INTERVAL = float(os.getenv('RETENTION_INTERVAL', '86400'))  # secondes
+RETENTION_LEASE = timedelta(minutes=30)
+ARCHIVE_STORAGE_OPTIONS = {"wiredTiger": {"configString": "block_compressor=zstd"}}
+
+retention_state = {"last_run": None, "running": False, "collections": {}}
+_archives_creees = set()
+
+async def acquire_job_lease(job_id: str, duree: timedelta) -> bool:
+    """Bail exclusif d'un job planifié entre workers (expire si le worker s'arrête)"""
+    now = datetime.now(timezone.utc)
+    try:
+        result = await db.job_leases.update_one(
+            {"id": job_id, "$or": [{"lease_until": {"$lt": now}}, {"lease_owner": WORKER_ID}]},
+            {"$set": {"id": job_id, "lease_owner": WORKER_ID, "lease_until": now + duree}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        # Bail détenu par un autre worker : l'upsert heurte l'index unique sur id
+        return False
+    return result.matched_count == 1 or result.upserted_id is not None
+
+async def release_job_lease(job_id: str):
+    """Libère le bail détenu par ce worker (le job peut être relancé immédiatement)"""
+    await db.job_leases.update_one(
+        {"id": job_id, "lease_owner": WORKER_ID},
+        {"$set": {"lease_until": datetime.now(timezone.utc)}}
+    )
+
+async def _ensure_archive_collection(nom: str):
+    if nom in _archives_creees:
+        return
+    try:
+        await db.create_collection(nom, storageEngine=ARCHIVE_STORAGE_OPTIONS)
+    except CollectionInvalid:
+        pass  # Archive déjà créée
+    except OperationFailure as e:
+        if e.code != 48:  # NamespaceExists (création concurrente)
+            raise
+    _archives_creees.add(nom)
+
+async def _delete_archived_notifications(collection, docs: List[dict]) -> int:
+    """
+    Supprime un lot de notifications archivées. Les non lues sortent des compteurs
+    d'après ce que cet appel a réellement supprimé (par utilisateur, garde sur read) :
+    deux passes qui se chevauchent ne décrémentent pas deux fois.
+    """
+    lues = [doc["_id"] for doc in docs if doc.get("read")]
+    non_lues = {}
+    for doc in docs:
+        if not doc.get("read"):
+            non_lues.setdefault(doc["user_id"], []).append(doc["_id"])
+    
+    deleted = 0
+    if lues:
+        deleted += (await collection.delete_many({"_id": {"$in": lues}, "read": True})).deleted_count
+    for user_id, ids in non_lues.items():
+        result = await collection.delete_many({"_id": {"$in": ids}, "read": {"$ne": True}})
+        if result.deleted_count:
+            await decrement_unread_counter(user_id, result.deleted_count)
+        deleted += result.deleted_count
+    return deleted
+
+async def archive_collection(collection_name: str, champ: str, jours: int) -> int:
+    """Archive par lots les documents antérieurs à la rétention ; renvoie le nombre archivé"""
+    etat = retention_state["collections"].setdefault(collection_name, {"archived": 0})
+    limite = datetime.now(timezone.utc) - timedelta(days=jours)
+    collection = db[collection_name]
+    query = add_date_range({}, collection_name, champ, lt=limite)
+    total = 0
+    
+    while True:
+        # Bail renouvelé à chaque lot : une passe longue n'est pas reprise par un autre worker
+        if not await acquire_job_lease("retention", RETENTION_LEASE):
+            logger.warning(f"Rétention {collection_name} : bail perdu, passe interrompue")
+            break
+        docs = await collection.find(query).sort("_id", 1).limit(RETENTION_BATCH_SIZE).to_list(RETENTION_BATCH_SIZE)
+        if not docs:
+            break
+        
+        par_mois = {}
+        for doc in docs:
+            date = parse_date(doc.get(champ))
+            par_mois.setdefault(date.strftime("%Y_%m") if date else "inconnu", []).append(doc)
+        for mois, docs_mois in par_mois.items():
+            archive = f"{collection_name}_archive_{mois}"
+            await _ensure_archive_collection(archive)
+            try:
+                await db[archive].insert_many(docs_mois, ordered=False)
+            except BulkWriteError as e:
+                if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+                    raise
+        
+        if collection_name == "notifications":
+            deleted = await _delete_archived_notifications(collection, docs)
+        else:
+            deleted = (await collection.delete_many({"_id": {"$in": [doc["_id"] for doc in docs]}})).deleted_count
+        
+        total += deleted
+        etat["archived"] += deleted
+        await asyncio.sleep(RETENTION_PAUSE)
     
-    # Create notifications for relevant chefs de projet
-    if programme_id:
-        # Utiliser tous les points d'attention dans la notification
-        description_complete = description + ": " + "; ".join(points_attention)
-        await create_notifications_for_chefs_projet(alerte.id, programme_id, partenaire_id, description_complete)
+    etat["last_archived"] = total
+    etat["cutoff"] = limite.isoformat()
+    return total
+
+async def run_retention() -> dict:
+    retention_state["running"] = True
+    try:
+        resultats = {}
+        for collection_name, policy in RETENTION_POLICIES.items():
+            if policy["jours"] <= 0:
+                continue  # Rétention désactivée
+            resultats[collection_name] = await archive_collection(collection_name, policy["champ"], policy["jours"])
+        retention_state["last_run"] = datetime.now(timezone.utc).isoformat()
+        if any(resultats.values()):
+            logger.info(f"Rétention : documents archivés {resultats}")
+        return resultats
+    finally:
+        retention_state["running"] = False
+        await release_job_lease("retention")
+
+async def retention_worker():
+    """Tâche de fond : archivage quotidien, exécuté par un seul worker à la fois"""
+    while True:
+        try:
+            if await acquire_job_lease("retention", RETENTION_LEASE):
+                await run_retention()
+        except Exception as e:
+            logger.error(f"Erreur archivage de rétention : {e}")
+        await asyncio.sleep(RETENTION_INTERVAL)
+
+async def collection_size(nom: str) -> dict:
+    try:
+        stats = await db.command("collStats", nom)
+    except OperationFailure:
+        return {"collection": nom, "count": 0, "size": 0, "storage_size": 0}
+    return {
+        "collection": nom,
+        "count": stats.get("count", 0),
+        "size": stats.get("size", 0),
+        "storage_size": stats.get("storageSize", 0)
+    }
 
 async def create_notifications_for_chefs_projet(alerte_id: str, programme_id: str, partenaire_id: str, description: str):
     """Créer des notifications pour les chefs de projet concernés par cette alerte"""
     try:
-        # Trouver tous les chefs de projet qui ont ce programme dans leur liste
+        # Trouver tous les chefs de projet qui ont ce programme dans leur liste (index role_programme_ids)
         chefs_projet = await db.users.find({
             "role": "chef_projet",
             "is_active": True,
             "programme_ids": programme_id
-        }, {"_id": 0}).to_list(100)
+        }, {"_id": 0, "id": 1}).to_list(length=None)
+        
+        # Idempotent : une tâche rejouée ne notifie pas deux fois le même chef de projet
+        deja_notifies = {
+            n['user_id'] for n in await db.notifications.find({"alerte_id": alerte_id}, {"_id": 0, "user_id": 1}).to_list(None)
+        }
+        chefs_projet = [chef for chef in chefs_projet if chef['id'] not in deja_notifies]
         
         if not chefs_projet:
             return
         
         # Récupérer les noms du programme et partenaire pour le message
-        programme = await db.programmes.find_one({"id": programme_id}, {"_id": 0, "nom": 1})
-        partenaire = await db.partenaires.find_one({"id": partenaire_id}, {"_id": 0, "nom": 1})
+        programme = await programmes_cache.get(programme_id)
+        partenaire = await partenaires_cache.get(partenaire_id)
         
         programme_nom = programme.get('nom') if programme else 'Programme inconnu'
         partenaire_nom = partenaire.get('nom') if partenaire else 'Partenaire inconnu'
         
-        # Créer une notification pour chaque chef de projet concerné
+        # Une notification par chef de projet concerné, écrites en un seul aller-retour
+        message = f"[{programme_nom}] - {partenaire_nom} : {description[:100]}"
+        docs = []
         for chef in chefs_projet:
             notification = Notification(
                 user_id=chef['id'],
                 alerte_id=alerte_id,
                 programme_id=programme_id,
                 partenaire_id=partenaire_id,
-                message=f"[{programme_nom}] - {partenaire_nom} : {description[:100]}",
+                message=message,
                 read=False
             )
-            
-            doc = notification.model_dump()
-            doc['created_at'] = doc['created_at'].isoformat()
-            await db.notifications.insert_one(doc)
+            doc = notification.model_dump()  # created_at en date BSON (rétention)
+            docs.append(doc)
         
+        try:
+            await db.notifications.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            # Doublons (alerte_id, user_id) d'une tâche rejouée en parallèle : déjà notifiés
+            write_errors = e.details.get("writeErrors", [])
+            if any(err.get("code") != 11000 for err in write_errors):
+                raise
+            doublons = {err["index"] for err in write_errors}
+            docs = [doc for i, doc in enumerate(docs) if i not in doublons]
+        
+        await increment_unread_counters([doc['user_id'] for doc in docs])
+        notification_broker.publish_notifications(docs)
         print(f"✅ {len(chefs_projet)} notification(s) créée(s) pour l'alerte {alerte_id}")
         
     except Exception as e:
         print(f"❌ Erreur lors de la création des notifications: {str(e)}")
+        raise
 
 # Authentication helper functions
-def verify_password(plain_password, hashed_password):
-    """Verify a password against its hash"""
-    return pwd_context.verify(plain_password, hashed_password)
+class LatencyHistogram:
+    """Histogramme de latences à seaux fixes (millisecondes)"""
+
+    BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, seconds: float):
+        ms = seconds * 1000
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        for i, borne in enumerate(self.BUCKETS_MS):
+            if ms <= borne:
+                self.counts[i] += 1
+                return
+        self.counts[-1] += 1
+
+    def stats(self) -> dict:
+        labels = [f"le_{borne}ms" for borne in self.BUCKETS_MS] + ["gt_5000ms"]
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total_ms / self.count, 2) if self.count else None,
+            "max_ms": round(self.max_ms, 2),
+            "buckets": dict(zip(labels, self.counts))
+        }
 
-def get_password_hash(password):
-    """Hash a password"""
-    return pwd_context.hash(password)
+auth_latency = {
+    "hash": LatencyHistogram(),
+    "verify": LatencyHistogram(),
+    "login": LatencyHistogram(),
+}
+
+async def hash_password_async(password: str) -> str:
+    """Hash a password in the bcrypt pool (does not block the event loop)"""
+    start = perf_counter()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(auth_hash_executor, pwd_context.hash, password)
+    finally:
+        auth_latency["hash"].observe(perf_counter() - start)
+
+async def verify_password_async(plain_password: str, hashed_password: str):
+    """
+    Verify a password in the bcrypt pool.
+    Returns (valid, new_hash): new_hash is set when the stored hash uses another
+    cost factor than BCRYPT_ROUNDS and must be replaced.
+    """
+    start = perf_counter()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(
+            auth_hash_executor, pwd_context.verify_and_update, plain_password, hashed_password
+        )
+    finally:
+        auth_latency["verify"].observe(perf_counter() - start)
+
+def normalize_email(email: str) -> str:
+    """Forme canonique d'un email pour les recherches insensibles à la casse"""
+    return (email or '').strip().lower()
+
+async def find_user_by_email(email: str) -> Optional[dict]:
+    """Utilisateur par email, insensible à la casse : point lookup sur email_lower (index unique)"""
+    email_lower = normalize_email(email)
+    user = await db.users.find_one({"email_lower": email_lower})
+    if user is None:
+        # Compte sans email_lower (avant le backfill, ou écarté comme doublon) :
+        # recherche insensible à la casse comme avant la normalisation, rattrapage à la volée
+        user = await db.users.find_one({
+            "email": {"$regex": f"^{re.escape(email_lower)}$", "$options": "i"},
+            "email_lower": {"$exists": False}
+        })
+        if user:
+            try:
+                await db.users.update_one({"_id": user["_id"]}, {"$set": {"email_lower": email_lower}})
+            except DuplicateKeyError:
+                pass
+    return user
+
+AUTH_USER_CACHE_TTL = float(os.getenv('AUTH_USER_CACHE_TTL', '30'))  # secondes
+AUTH_USER_CACHE_SIZE = int(os.getenv('AUTH_USER_CACHE_SIZE', '1024'))
+
+class AuthUserCache:
+    """
+    Cache LRU borné et à TTL court des utilisateurs authentifiés, indexé par le
+    sujet du JWT (email normalisé). Évite la requête Mongo de get_current_user
+    sur chaque appel ; le TTL borne la propagation d'une désactivation entre workers.
+    """
+
+    def __init__(self, maxsize: int = AUTH_USER_CACHE_SIZE, ttl: float = AUTH_USER_CACHE_TTL):
+        self._users = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, subject: str) -> Optional[User]:
+        user = self._users.get(normalize_email(subject))
+        if user is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return user
+
+    def set(self, subject: str, user: User):
+        self._users[normalize_email(subject)] = user
+
+    def invalidate(self, user_id: Optional[str] = None):
+        """Retire un utilisateur (par id) ou vide le cache si user_id est None"""
+        if user_id is None:
+            self._users.clear()
+            return
+        for subject, user in list(self._users.items()):
+            if user.id == user_id:
+                self._users.pop(subject, None)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._users),
+            "maxsize": self._users.maxsize,
+            "ttl_seconds": self._users.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else None
+        }
+
+auth_user_cache = AuthUserCache()
+
+async def backfill_email_lower():
+    """Renseigne email_lower pour les comptes existants (idempotent, au démarrage)"""
+    users = await db.users.find(
+        {"email_lower": {"$exists": False}, "email": {"$type": "string"}},
+        {"_id": 1, "email": 1}
+    ).to_list(length=None)
+    if not users:
+        return
+    operations = [
+        UpdateOne({"_id": u["_id"]}, {"$set": {"email_lower": normalize_email(u["email"])}})
+        for u in users
+    ]
+    try:
+        result = await db.users.bulk_write(operations, ordered=False)
+        logger.info(f"email_lower renseigné pour {result.modified_count} utilisateur(s)")
+    except BulkWriteError as e:
+        # Emails en doublon à la casse près : ces comptes restent à dédoublonner
+        doublons = [err.get("op", {}).get("u", {}).get("$set", {}).get("email_lower") for err in e.details.get("writeErrors", [])]
+        logger.warning(f"email_lower non renseigné (doublons) : {doublons}")
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     """Create JWT access token"""
@@ -814,11 +2611,17 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
     except JWTError:
         raise credentials_exception
     
+    cached = auth_user_cache.get(token_data.email)
+    if cached is not None:
+        return cached
+    
     # Recherche insensible à la casse (cohérent avec le login)
-    user = await db.users.find_one({"email": {"$regex": f"^{token_data.email}$", "$options": "i"}})
+    user = await find_user_by_email(token_data.email)
     if user is None:
         raise credentials_exception
-    return User(**user)
+    current_user = User(**user)
+    auth_user_cache.set(token_data.email, current_user)
+    return current_user
 
 async def get_current_active_user(current_user: User = Depends(get_current_user)):
     """Get current active user"""
@@ -860,19 +2663,23 @@ async def generate_insights_with_ai(period: str = "week", programme_id: str = No
             date_limit = datetime.now(timezone.utc) - timedelta(days=7)
         
         # Construire les filtres
-        test_filter = {'created_at': {'$gte': date_limit.isoformat()}}
+        test_filter = {}
         if programme_id:
             test_filter['programme_id'] = programme_id
         if partenaire_id:
             test_filter['partenaire_id'] = partenaire_id
         
         # Stats tests
-        tests_site = await db.tests_site.find(test_filter, {'_id': 0}).to_list(1000)
+        tests_site = await db.tests_site.find(
+            add_date_range(dict(test_filter), "tests_site", 'created_at', gte=date_limit), {'_id': 0}
+        ).to_list(1000)
         
-        tests_ligne = await db.tests_ligne.find(test_filter, {'_id': 0}).to_list(1000)
+        tests_ligne = await db.tests_ligne.find(
+            add_date_range(dict(test_filter), "tests_ligne", 'created_at', gte=date_limit), {'_id': 0}
+        ).to_list(1000)
         
         # Stats alertes (avec mêmes filtres)
-        alerte_filter = {'created_at': {'$gte': date_limit.isoformat()}}
+        alerte_filter = add_date_range({}, "alertes", 'created_at', gte=date_limit)
         if programme_id:
             alerte_filter['programme_id'] = programme_id
         if partenaire_id:
@@ -881,12 +2688,9 @@ async def generate_insights_with_ai(period: str = "week", programme_id: str = No
         alertes = await db.alertes.find(alerte_filter, {'_id': 0}).to_list(1000)
         
         # Récupérer programmes et partenaires pour contexte
-        programmes = await db.programmes.find({}, {'_id': 0, 'id': 1, 'nom': 1}).to_list(100)
-        partenaires = await db.partenaires.find({}, {'_id': 0, 'id': 1, 'nom': 1}).to_list(100)
-        
-        # Créer dicts pour lookup
-        programmes_dict = {p['id']: p['nom'] for p in programmes}
-        partenaires_dict = {p['id']: p['nom'] for p in partenaires}
+        # Dicts de lookup servis par le cache de référence
+        programmes_dict = await programmes_cache.noms()
+        partenaires_dict = await partenaires_cache.noms()
         
         # Calculer statistiques
         total_tests = len(tests_site) + len(tests_ligne)
@@ -1019,11 +2823,12 @@ async def create_programme(input: ProgrammeCreate):
     doc = programme.model_dump()
     doc['created_at'] = doc['created_at'].isoformat()
     await db.programmes.insert_one(doc)
+    programmes_cache.invalidate()
     return programme
 
 @api_router.get("/programmes", response_model=List[Programme])
 async def get_programmes():
-    programmes = await db.programmes.find({}, {"_id": 0}).to_list(1000)
+    programmes = await programmes_cache.get_all()
     for p in programmes:
         if isinstance(p.get('created_at'), str):
             p['created_at'] = datetime.fromisoformat(p['created_at'])
@@ -1031,7 +2836,7 @@ async def get_programmes():
 
 @api_router.get("/programmes/{programme_id}", response_model=Programme)
 async def get_programme(programme_id: str):
-    programme = await db.programmes.find_one({"id": programme_id}, {"_id": 0})
+    programme = await programmes_cache.get(programme_id)
     if not programme:
         raise HTTPException(status_code=404, detail="Programme non trouvé")
     if isinstance(programme.get('created_at'), str):
@@ -1046,6 +2851,7 @@ async def update_programme(programme_id: str, input: ProgrammeCreate):
     
     update_data = input.model_dump()
     await db.programmes.update_one({"id": programme_id}, {"$set": update_data})
+    programmes_cache.invalidate()
     
     updated = await db.programmes.find_one({"id": programme_id}, {"_id": 0})
     if isinstance(updated.get('created_at'), str):
@@ -1057,6 +2863,7 @@ async def delete_programme(programme_id: str):
     result = await db.programmes.delete_one({"id": programme_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Programme non trouvé")
+    programmes_cache.invalidate()
     return {"message": "Programme supprimé"}
 
 # Routes - Partenaires
@@ -1066,6 +2873,7 @@ async def create_partenaire(input: PartenaireCreate):
     doc = partenaire.model_dump()
     doc['created_at'] = doc['created_at'].isoformat()
     await db.partenaires.insert_one(doc)
+    partenaires_cache.invalidate()
     return partenaire
 
 @api_router.get("/partenaires")
@@ -1108,11 +2916,10 @@ async def get_partenaires(
 @api_router.get("/contacts/all")
 async def get_all_contacts():
     """Get all partenaire contacts with their associated programmes"""
-    partenaires = await db.partenaires.find({}, {"_id": 0}).to_list(1000)
-    programmes = await db.programmes.find({}, {"_id": 0}).to_list(1000)
+    partenaires = await partenaires_cache.get_all()
     
     # Create a map for quick programme lookup
-    programmes_map = {p['id']: p['nom'] for p in programmes}
+    programmes_map = await programmes_cache.noms()
     
     contacts = []
     for partenaire in partenaires:
@@ -1130,7 +2937,7 @@ async def get_all_contacts():
 
 @api_router.get("/partenaires/{partenaire_id}", response_model=Partenaire)
 async def get_partenaire(partenaire_id: str):
-    partenaire = await db.partenaires.find_one({"id": partenaire_id}, {"_id": 0})
+    partenaire = await partenaires_cache.get(partenaire_id)
     if not partenaire:
         raise HTTPException(status_code=404, detail="Partenaire non trouvé")
     if isinstance(partenaire.get('created_at'), str):
@@ -1145,6 +2952,7 @@ async def update_partenaire(partenaire_id: str, input: PartenaireCreate):
     
     update_data = input.model_dump()
     await db.partenaires.update_one({"id": partenaire_id}, {"$set": update_data})
+    partenaires_cache.invalidate()
     
     updated = await db.partenaires.find_one({"id": partenaire_id}, {"_id": 0})
     if isinstance(updated.get('created_at'), str):
@@ -1156,12 +2964,13 @@ async def delete_partenaire(partenaire_id: str):
     result = await db.partenaires.delete_one({"id": partenaire_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Partenaire non trouvé")
+    partenaires_cache.invalidate()
     return {"message": "Partenaire supprimé"}
 
 # Route pour vérifier la remise par rapport à la remise minimum attendue
 @api_router.get("/partenaires/{partenaire_id}/verify-remise")
 async def verify_remise(partenaire_id: str, remise_calculee: float):
-    partenaire = await db.partenaires.find_one({"id": partenaire_id}, {"_id": 0})
+    partenaire = await partenaires_cache.get(partenaire_id)
     if not partenaire:
         raise HTTPException(status_code=404, detail="Partenaire non trouvé")
     
@@ -1209,29 +3018,21 @@ async def check_duplicate_test(
     # Query pour chercher un test existant
     query = {
         'partenaire_id': partenaire_id,
-        'programme_id': programme_id,
-        'date_test': {
-            '$gte': start_of_month,
-            '$lt': end_of_month
-        }
+        'programme_id': programme_id
     }
     
     # Chercher dans la bonne collection
     collection = db.tests_site if test_type == 'site' else db.tests_ligne
+    add_date_range(query, collection.name, 'date_test', gte=start_of_month, lt=end_of_month)
     existing_test = await collection.find_one(query, {'_id': 0})
     
     if existing_test:
         # Récupérer les infos de l'utilisateur qui a créé le test
-        creator = None
-        if existing_test.get('user_id'):
-            creator = await db.users.find_one(
-                {'id': existing_test['user_id']},
-                {'_id': 0, 'prenom': 1, 'nom': 1, 'email': 1}
-            )
+        creator = await users_cache.get(existing_test.get('user_id'))
         
         # Récupérer les noms du partenaire et programme
-        partenaire = await db.partenaires.find_one({'id': partenaire_id}, {'_id': 0, 'nom': 1})
-        programme = await db.programmes.find_one({'id': programme_id}, {'_id': 0, 'nom': 1})
+        partenaire = await partenaires_cache.get(partenaire_id)
+        programme = await programmes_cache.get(programme_id)
         
         return {
             'exists': True,
@@ -1264,17 +3065,16 @@ async def create_test_site(input: TestSiteCreate, current_user: User = Depends(g
     start_of_month = datetime(now.year, now.month, 1).isoformat()
     end_of_month = datetime(now.year + 1, 1, 1).isoformat() if now.month == 12 else datetime(now.year, now.month + 1, 1).isoformat()
     
-    existing_test = await db.tests_site.find_one({
+    existing_test = await db.tests_site.find_one(add_date_range({
         'partenaire_id': input.partenaire_id,
-        'programme_id': input.programme_id,
-        'date_test': {'$gte': start_of_month, '$lt': end_of_month}
-    }, {'_id': 0, 'id': 1, 'date_test': 1, 'user_id': 1})
+        'programme_id': input.programme_id
+    }, "tests_site", 'date_test', gte=start_of_month, lt=end_of_month), {'_id': 0, 'id': 1, 'date_test': 1, 'user_id': 1})
     
     if existing_test:
         # Récupérer les infos pour le message d'erreur
-        partenaire = await db.partenaires.find_one({'id': input.partenaire_id}, {'_id': 0, 'nom': 1})
-        programme = await db.programmes.find_one({'id': input.programme_id}, {'_id': 0, 'nom': 1})
-        creator = await db.users.find_one({'id': existing_test.get('user_id')}, {'_id': 0, 'prenom': 1, 'nom': 1}) if existing_test.get('user_id') else None
+        partenaire = await partenaires_cache.get(input.partenaire_id)
+        programme = await programmes_cache.get(input.programme_id)
+        creator = await users_cache.get(existing_test.get('user_id'))
         
         creator_name = f"{creator.get('prenom', '')} {creator.get('nom', '')}" if creator else "Inconnu"
         raise HTTPException(
@@ -1293,8 +3093,13 @@ async def create_test_site(input: TestSiteCreate, current_user: User = Depends(g
     test_data = input.model_dump()
     test = TestSite(**test_data, pct_remise_calcule=pct_remise, user_id=current_user.id)
     
+    # Save test (avant l'alerte qui le référence)
+    doc = test.model_dump()
+    doc['date_test'] = parse_date(doc['date_test'])
+    await db.tests_site.insert_one(doc)
+    
     # Récupérer le partenaire pour vérifier la remise minimum
-    partenaire = await db.partenaires.find_one({"id": input.partenaire_id}, {"_id": 0})
+    partenaire = await partenaires_cache.get(input.partenaire_id)
     
     # NE PAS créer d'alerte automatique si test non réalisable
     # (le frontend crée déjà une alerte spécifique "Test non réalisable")
@@ -1330,12 +3135,6 @@ async def create_test_site(input: TestSiteCreate, current_user: User = Depends(g
                 current_user.id
             )
     
-    # Save test
-    doc = test.model_dump()
-    doc['date_test'] = doc['date_test'].isoformat()
-    doc['created_at'] = doc['created_at'].isoformat()
-    await db.tests_site.insert_one(doc)
-    
     return test
 
 @api_router.get("/tests-site")
@@ -1350,6 +3149,9 @@ async def get_tests_site(
     page: int = Query(1, ge=1, description="Numéro de page"),
     limit: int = Query(50, ge=1, le=200, description="Nombre d'éléments par page"),
     paginate: bool = Query(False, description="Activer la pagination"),
+    keyset: bool = Query(False, description="Pagination par curseur (retourne next_cursor)"),
+    cursor: Optional[str] = Query(None, description="Curseur opaque retourné par la page précédente"),
+    include_total: bool = Query(False, description="Inclure le total estimé en mode curseur"),
     current_user: User = Depends(get_current_active_user)
 ):
     query = {}
@@ -1384,45 +3186,35 @@ async def get_tests_site(
     
     # Gestion des filtres de date
     if date_debut or date_fin:
-        query['date_test'] = {}
-        if date_debut:
-            query['date_test']['$gte'] = date_debut
-        if date_fin:
-            query['date_test']['$lte'] = date_fin
+        add_date_range(query, "tests_site", 'date_test', gte=date_debut, lte=date_fin)
     elif annee:
         # Filtre par année
-        query['date_test'] = {
-            '$gte': datetime(annee, 1, 1).isoformat(),
-            '$lte': datetime(annee, 12, 31, 23, 59, 59).isoformat()
-        }
+        add_date_range(query, "tests_site", 'date_test',
+                       gte=datetime(annee, 1, 1).isoformat(),
+                       lte=datetime(annee, 12, 31, 23, 59, 59).isoformat())
     else:
         # Par défaut : année en cours uniquement
         current_year = datetime.now().year
-        query['date_test'] = {
-            '$gte': datetime(current_year, 1, 1).isoformat(),
-            '$lte': datetime(current_year, 12, 31, 23, 59, 59).isoformat()
-        }
-    
-    # Compter le total pour pagination
-    total = await db.tests_site.count_documents(query)
-    
-    # Pagination ou récupération complète
-    if paginate:
+        add_date_range(query, "tests_site", 'date_test',
+                       gte=datetime(current_year, 1, 1).isoformat(),
+                       lte=datetime(current_year, 12, 31, 23, 59, 59).isoformat())
+    
+    next_cursor = None
+    if keyset or cursor:
+        # Pagination par curseur : pas de skip, total optionnel et mis en cache
+        tests, next_cursor = await fetch_page_curseur(db.tests_site, query, "date_test", cursor, limit)
+        total = await count_estime(db.tests_site, query) if include_total else None
+    elif paginate:
+        # Compter le total pour pagination
+        total = await db.tests_site.count_documents(query)
         skip = (page - 1) * limit
         tests = await db.tests_site.find(query, {"_id": 0}).sort("date_test", -1).skip(skip).limit(limit).to_list(limit)
     else:
         # Sans pagination: limite à 5000 pour compatibilité
         tests = await db.tests_site.find(query, {"_id": 0}).sort("date_test", -1).to_list(5000)
     
-    # Optimisation: Récupérer tous les users en une seule requête (évite N+1)
-    user_ids = list(set([t['user_id'] for t in tests if t.get('user_id')]))
-    users_dict = {}
-    if user_ids:
-        users = await db.users.find(
-            {"id": {"$in": user_ids}},
-            {"_id": 0, "password_hash": 0}
-        ).to_list(len(user_ids))
-        users_dict = {u['id']: u for u in users}
+    # Créateurs servis par le cache des utilisateurs (aucune requête par page)
+    users_dict = await users_cache.get_map()
     
     # Enrichir avec les informations de l'utilisateur créateur
     for t in tests:
@@ -1451,7 +3243,9 @@ async def get_tests_site(
                 "role": user.get('role')
             }
     
-    # Retourner format paginé ou liste simple
+    # Retourner format curseur, paginé ou liste simple
+    if keyset or cursor:
+        return CursorPaginatedResponse(items=tests, limit=limit, next_cursor=next_cursor, total=total)
     if paginate:
         return {
             "items": tests,
@@ -1487,7 +3281,8 @@ async def update_test_site(test_id: str, input: TestSiteCreate):
     # Prepare update data
     update_data = input.model_dump()
     update_data['pct_remise_calcule'] = pct_remise
-    update_data['date_test'] = update_data['date_test'].isoformat()
+    update_data['date_test'] = parse_date(update_data['date_test'])
+    update_data['updated_at'] = datetime.now(timezone.utc)  # Version des données des rapports en cache
     
     # Update in database
     await db.tests_site.update_one(
@@ -1530,26 +3325,16 @@ async def get_partenaires_testes_mois(
     else:
         next_month = datetime(now.year, now.month + 1, 1, tzinfo=timezone.utc)
     
-    # Format ISO pour les dates stockées en string
-    first_day_iso = first_day.isoformat()
-    next_month_iso = next_month.isoformat()
-    
-    # Query qui gère les dates en datetime ET en string ISO
-    query = {
-        "$or": [
-            # Cas datetime
-            {"date_test": {"$gte": first_day, "$lt": next_month, "$type": "date"}},
-            # Cas string ISO
-            {"date_test": {"$gte": first_day_iso, "$lt": next_month_iso, "$type": "string"}}
-        ]
-    }
-    
+    query = {}
     if programme_id:
         query["programme_id"] = programme_id
     
     # Sélectionner la collection
     collection = db.tests_site if test_type == "site" else db.tests_ligne
     
+    # Plage BSON (et chaînes ISO tant que la migration des dates n'est pas terminée)
+    add_date_range(query, collection.name, "date_test", gte=first_day, lt=next_month)
+    
     # Récupérer uniquement les partenaire_id distincts
     tests = await collection.find(query, {"_id": 0, "partenaire_id": 1}).to_list(5000)
     
@@ -1613,17 +3398,16 @@ async def create_test_ligne(input: TestLigneCreate, current_user: User = Depends
     start_of_month = datetime(now.year, now.month, 1).isoformat()
     end_of_month = datetime(now.year + 1, 1, 1).isoformat() if now.month == 12 else datetime(now.year, now.month + 1, 1).isoformat()
     
-    existing_test = await db.tests_ligne.find_one({
+    existing_test = await db.tests_ligne.find_one(add_date_range({
         'partenaire_id': input.partenaire_id,
-        'programme_id': input.programme_id,
-        'date_test': {'$gte': start_of_month, '$lt': end_of_month}
-    }, {'_id': 0, 'id': 1, 'date_test': 1, 'user_id': 1})
+        'programme_id': input.programme_id
+    }, "tests_ligne", 'date_test', gte=start_of_month, lt=end_of_month), {'_id': 0, 'id': 1, 'date_test': 1, 'user_id': 1})
     
     if existing_test:
         # Récupérer les infos pour le message d'erreur
-        partenaire = await db.partenaires.find_one({'id': input.partenaire_id}, {'_id': 0, 'nom': 1})
-        programme = await db.programmes.find_one({'id': input.programme_id}, {'_id': 0, 'nom': 1})
-        creator = await db.users.find_one({'id': existing_test.get('user_id')}, {'_id': 0, 'prenom': 1, 'nom': 1}) if existing_test.get('user_id') else None
+        partenaire = await partenaires_cache.get(input.partenaire_id)
+        programme = await programmes_cache.get(input.programme_id)
+        creator = await users_cache.get(existing_test.get('user_id'))
         
         creator_name = f"{creator.get('prenom', '')} {creator.get('nom', '')}" if creator else "Inconnu"
         raise HTTPException(
@@ -1638,6 +3422,11 @@ async def create_test_ligne(input: TestLigneCreate, current_user: User = Depends
     
     test = TestLigne(**input.model_dump(), user_id=current_user.id)
     
+    # Save test (avant l'alerte qui le référence)
+    doc = test.model_dump()
+    doc['date_test'] = parse_date(doc['date_test'])
+    await db.tests_ligne.insert_one(doc)
+    
     # NE PAS créer d'alerte automatique si test non réalisable
     # (le frontend crée déjà une alerte spécifique "Test non réalisable")
     if not input.test_non_realisable:
@@ -1661,12 +3450,6 @@ async def create_test_ligne(input: TestLigneCreate, current_user: User = Depends
                 current_user.id
             )
     
-    # Save test
-    doc = test.model_dump()
-    doc['date_test'] = doc['date_test'].isoformat()
-    doc['created_at'] = doc['created_at'].isoformat()
-    await db.tests_ligne.insert_one(doc)
-    
     return test
 
 @api_router.get("/tests-ligne")
@@ -1680,6 +3463,9 @@ async def get_tests_ligne(
     page: int = Query(1, ge=1, description="Numéro de page"),
     limit: int = Query(50, ge=1, le=200, description="Nombre d'éléments par page"),
     paginate: bool = Query(False, description="Activer la pagination"),
+    keyset: bool = Query(False, description="Pagination par curseur (retourne next_cursor)"),
+    cursor: Optional[str] = Query(None, description="Curseur opaque retourné par la page précédente"),
+    include_total: bool = Query(False, description="Inclure le total estimé en mode curseur"),
     current_user: User = Depends(get_current_active_user)
 ):
     query = {}
@@ -1708,45 +3494,35 @@ async def get_tests_ligne(
     
     # Gestion des filtres de date
     if date_debut or date_fin:
-        query['date_test'] = {}
-        if date_debut:
-            query['date_test']['$gte'] = date_debut
-        if date_fin:
-            query['date_test']['$lte'] = date_fin
+        add_date_range(query, "tests_ligne", 'date_test', gte=date_debut, lte=date_fin)
     elif annee:
         # Filtre par année
-        query['date_test'] = {
-            '$gte': datetime(annee, 1, 1).isoformat(),
-            '$lte': datetime(annee, 12, 31, 23, 59, 59).isoformat()
-        }
+        add_date_range(query, "tests_ligne", 'date_test',
+                       gte=datetime(annee, 1, 1).isoformat(),
+                       lte=datetime(annee, 12, 31, 23, 59, 59).isoformat())
     else:
         # Par défaut : année en cours uniquement
         current_year = datetime.now().year
-        query['date_test'] = {
-            '$gte': datetime(current_year, 1, 1).isoformat(),
-            '$lte': datetime(current_year, 12, 31, 23, 59, 59).isoformat()
-        }
-    
-    # Compter le total pour pagination
-    total = await db.tests_ligne.count_documents(query)
-    
-    # Pagination ou récupération complète
-    if paginate:
+        add_date_range(query, "tests_ligne", 'date_test',
+                       gte=datetime(current_year, 1, 1).isoformat(),
+                       lte=datetime(current_year, 12, 31, 23, 59, 59).isoformat())
+    
+    next_cursor = None
+    if keyset or cursor:
+        # Pagination par curseur : pas de skip, total optionnel et mis en cache
+        tests, next_cursor = await fetch_page_curseur(db.tests_ligne, query, "date_test", cursor, limit)
+        total = await count_estime(db.tests_ligne, query) if include_total else None
+    elif paginate:
+        # Compter le total pour pagination
+        total = await db.tests_ligne.count_documents(query)
         skip = (page - 1) * limit
         tests = await db.tests_ligne.find(query, {"_id": 0}).sort("date_test", -1).skip(skip).limit(limit).to_list(limit)
     else:
         # Sans pagination: limite à 5000 pour compatibilité
         tests = await db.tests_ligne.find(query, {"_id": 0}).sort("date_test", -1).to_list(5000)
     
-    # Optimisation: Récupérer tous les users en une seule requête (évite N+1)
-    user_ids = list(set([t['user_id'] for t in tests if t.get('user_id')]))
-    users_dict = {}
-    if user_ids:
-        users = await db.users.find(
-            {"id": {"$in": user_ids}},
-            {"_id": 0, "password_hash": 0}
-        ).to_list(len(user_ids))
-        users_dict = {u['id']: u for u in users}
+    # Créateurs servis par le cache des utilisateurs (aucune requête par page)
+    users_dict = await users_cache.get_map()
     
     # Enrichir avec les informations de l'utilisateur créateur
     for t in tests:
@@ -1775,7 +3551,9 @@ async def get_tests_ligne(
                 "role": user.get('role')
             }
     
-    # Retourner format paginé ou liste simple
+    # Retourner format curseur, paginé ou liste simple
+    if keyset or cursor:
+        return CursorPaginatedResponse(items=tests, limit=limit, next_cursor=next_cursor, total=total)
     if paginate:
         return {
             "items": tests,
@@ -1807,9 +3585,10 @@ async def update_test_ligne(test_id: str, input: TestLigneCreate):
     
     # Prepare update data
     update_data = input.model_dump()
-    update_data['date_test'] = update_data['date_test'].isoformat()
+    update_data['date_test'] = parse_date(update_data['date_test'])
     if update_data.get('delai_attente') and isinstance(update_data['delai_attente'], time):
         update_data['delai_attente'] = update_data['delai_attente'].strftime('%H:%M:%S')
+    update_data['updated_at'] = datetime.now(timezone.utc)  # Version des données des rapports en cache
     
     # Update in database
     await db.tests_ligne.update_one(
@@ -1841,6 +3620,9 @@ async def get_incidents(
     page: int = Query(1, ge=1, description="Numéro de page"),
     limit: int = Query(50, ge=1, le=200, description="Nombre d'éléments par page"),
     paginate: bool = Query(False, description="Activer la pagination"),
+    keyset: bool = Query(False, description="Pagination par curseur (retourne next_cursor)"),
+    cursor: Optional[str] = Query(None, description="Curseur opaque retourné par la page précédente"),
+    include_total: bool = Query(False, description="Inclure le total estimé en mode curseur"),
     current_user: User = Depends(get_current_active_user)
 ):
     query = {}
@@ -1858,11 +3640,14 @@ async def get_incidents(
     if statut:
         query['statut'] = statut
     
-    # Compter le total pour pagination
-    total = await db.alertes.count_documents(query)
-    
-    # Pagination ou récupération complète
-    if paginate:
+    next_cursor = None
+    if keyset or cursor:
+        # Pagination par curseur : pas de skip, total optionnel et mis en cache
+        alertes, next_cursor = await fetch_page_curseur(db.alertes, query, "created_at", cursor, limit)
+        total = await count_estime(db.alertes, query) if include_total else None
+    elif paginate:
+        # Compter le total pour pagination
+        total = await db.alertes.count_documents(query)
         skip = (page - 1) * limit
         alertes = await db.alertes.find(query, {"_id": 0}).sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
     else:
@@ -1874,7 +3659,9 @@ async def get_incidents(
         if i.get('resolved_at') and isinstance(i['resolved_at'], str):
             i['resolved_at'] = datetime.fromisoformat(i['resolved_at'])
     
-    # Retourner format paginé ou liste simple
+    # Retourner format curseur, paginé ou liste simple
+    if keyset or cursor:
+        return CursorPaginatedResponse(items=alertes, limit=limit, next_cursor=next_cursor, total=total)
     if paginate:
         return {
             "items": alertes,
@@ -1913,24 +3700,14 @@ async def get_incidents_enriched(
     else:
         alertes = await db.alertes.find(query, {"_id": 0}).sort("created_at", -1).to_list(1000)
     
-    # Enrich with programme and partenaire data
     for alerte in alertes:
         if isinstance(alerte.get('created_at'), str):
             alerte['created_at'] = datetime.fromisoformat(alerte['created_at'])
         if alerte.get('resolved_at') and isinstance(alerte['resolved_at'], str):
             alerte['resolved_at'] = datetime.fromisoformat(alerte['resolved_at'])
-        
-        # Get programme details
-        if alerte.get('programme_id'):
-            programme = await db.programmes.find_one({"id": alerte['programme_id']}, {"_id": 0})
-            alerte['programme_nom'] = programme['nom'] if programme else None
-        
-        # Get partenaire details
-        if alerte.get('partenaire_id'):
-            partenaire = await db.partenaires.find_one({"id": alerte['partenaire_id']}, {"_id": 0})
-            if partenaire:
-                alerte['partenaire_nom'] = partenaire['nom']
-                alerte['partenaire_contact_email'] = partenaire.get('contact_email')
+    
+    # Enrich with programme and partenaire data (batch, no per-alerte query)
+    await enrich_alertes_noms(alertes, avec_contact=True)
     
     if paginate:
         return {
@@ -1951,11 +3728,11 @@ async def create_alerte_standalone(
     """Créer une alerte directement (sans test associé) - utilisé pour les tests non réalisables"""
     
     # Vérifier que le programme et le partenaire existent
-    programme = await db.programmes.find_one({"id": alerte.programme_id}, {"_id": 0})
+    programme = await programmes_cache.get(alerte.programme_id)
     if not programme:
         raise HTTPException(status_code=404, detail="Programme non trouvé")
     
-    partenaire = await db.partenaires.find_one({"id": alerte.partenaire_id}, {"_id": 0})
+    partenaire = await partenaires_cache.get(alerte.partenaire_id)
     if not partenaire:
         raise HTTPException(status_code=404, detail="Partenaire non trouvé")
     
@@ -1970,14 +3747,16 @@ async def create_alerte_standalone(
         "partenaire_id": alerte.partenaire_id,
         "screenshots": alerte.screenshots,  # IDs des screenshots
         "user_id": current_user.id,
-        "created_at": datetime.now(timezone.utc).isoformat(),
+        "created_at": datetime.now(timezone.utc),
         "resolved_at": None
     }
     
     await db.alertes.insert_one(alerte_doc)
     
-    # Créer des notifications pour les chefs de projet concernés
-    await create_notifications_for_chefs_projet(
+    # Créer des notifications pour les chefs de projet concernés (en tâche de fond)
+    side_effects_queue.enqueue(
+        f"notifications:{alerte_doc['id']}",
+        create_notifications_for_chefs_projet,
         alerte_doc["id"], 
         alerte.programme_id, 
         alerte.partenaire_id, 
@@ -1997,10 +3776,10 @@ async def resolve_incident(alerte_id: str):
     if not existing:
         raise HTTPException(status_code=404, detail="Incident non trouvé")
     
-    resolved_at = datetime.now(timezone.utc).isoformat()
+    resolved_at = datetime.now(timezone.utc)
     await db.alertes.update_one(
         {"id": alerte_id},
-        {"$set": {"statut": StatutAlerte.resolu, "resolved_at": resolved_at}}
+        {"$set": {"statut": StatutAlerte.resolu, "resolved_at": resolved_at, "updated_at": resolved_at}}
     )
     
     updated = await db.alertes.find_one({"id": alerte_id}, {"_id": 0})
@@ -2044,13 +3823,45 @@ async def get_notifications(current_user: User = Depends(get_current_active_user
 
 @api_router.get("/notifications/unread-count")
 async def get_unread_count(current_user: User = Depends(get_current_active_user)):
-    """Compter les notifications non lues"""
-    count = await db.notifications.count_documents({
-        "user_id": current_user.id,
-        "read": False
-    })
+    """Compter les notifications non lues (compteur maintenu, lecture ponctuelle)"""
+    count = await get_unread_notification_count(current_user.id)
     return {"count": count}
 
+def format_sse(event_type: str, data: dict) -> str:
+    payload = json.dumps(data, default=lambda v: v.isoformat() if isinstance(v, datetime) else str(v))
+    return f"event: {event_type}\ndata: {payload}\n\n"
+
+@api_router.get("/notifications/stream")
+async def stream_notifications(
+    request: Request,
+    token: Optional[str] = Query(None, description="JWT (EventSource ne permet pas d'en-tête Authorization)"),
+    header_token: Optional[str] = Depends(oauth2_scheme)
+):
+    """Flux SSE des notifications de l'utilisateur connecté (remplace le polling)"""
+    current_user = await get_current_active_user(await get_current_user(header_token or token))
+    file_evenements = notification_broker.subscribe(current_user.id)
+    
+    async def event_stream():
+        try:
+            # Compteur initial : le client se resynchronise à chaque (re)connexion
+            count = await get_unread_notification_count(current_user.id)
+            yield format_sse("unread_count", {"count": count})
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(file_evenements.get(), timeout=NOTIFICATION_STREAM_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield format_sse(event["type"], event["data"])
+        finally:
+            notification_broker.unsubscribe(current_user.id, file_evenements)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @api_router.put("/notifications/{notification_id}/read")
 async def mark_notification_read(
     notification_id: str,
@@ -2064,6 +3875,7 @@ async def mark_notification_read(
     
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="Notification non trouvée")
+    await decrement_unread_counter(current_user.id)
     
     return {"message": "Notification marquée comme lue"}
 
@@ -2074,40 +3886,334 @@ async def mark_all_notifications_read(current_user: User = Depends(get_current_a
         {"user_id": current_user.id, "read": False},
         {"$set": {"read": True}}
     )
+    # Décrément du nombre réellement modifié : une notification arrivée entre-temps reste comptée
+    await decrement_unread_counter(current_user.id, result.modified_count)
     
     return {"message": f"{result.modified_count} notification(s) marquée(s) comme lue(s)"}
 
-# Routes - Export Incident Report
-@api_router.get("/export-alerte-report/{test_id}")
-async def export_incident_report(
-    test_id: str,
-    test_type: str = Query(..., description="Type de test: 'site' ou 'ligne'"),
-    current_user: User = Depends(get_current_active_user)
-):
-    """Generate a PDF alerte report for a test"""
-    
-    # Récupérer le test selon son type
-    if test_type == "site":
-        test = await db.tests_site.find_one({"id": test_id})
-        test_label = "Test Site"
-    elif test_type == "ligne":
-        test = await db.tests_ligne.find_one({"id": test_id})
-        test_label = "Test Ligne"
-    else:
-        raise HTTPException(status_code=400, detail="Type de test invalide")
-    
-    if not test:
-        raise HTTPException(status_code=404, detail="Test non trouvé")
-    
-    # Récupérer les alertes liés à ce test
-    alertes = await db.alertes.find({"test_id": test_id}).to_list(length=None)
-    
-    if not alertes:
-        raise HTTPException(status_code=404, detail="Aucun alerte trouvé pour ce test")
+# =====================
+# POOL DE RENDU DES RAPPORTS (PDF, XLSX, PPTX)
+# =====================
+# reportlab, openpyxl et python-pptx sont du pur CPU sous le GIL : un gros export figeait la
+# boucle asyncio pour tous les utilisateurs. Chaque export est découpé en une étape async
+# (lectures Mongo / GridFS) et une fonction de rendu pure, au niveau module, qui ne reçoit
+# que des données simples (picklables) et renvoie des octets ou écrit un fichier.
+# Le rendu s'exécute dans un ProcessPoolExecutor borné ; les demandes au-delà de
+# RENDER_WORKERS attendent côté asyncio (annulables si le client abandonne) et sont
+# refusées en 503 au-delà de RENDER_MAX_QUEUE.
+
+RENDER_WORKERS = int(os.getenv('RENDER_WORKERS', '2'))
+RENDER_MAX_QUEUE = int(os.getenv('RENDER_MAX_QUEUE', '20'))
+
+class RenderPool:
+    """ProcessPoolExecutor borné avec file d'attente mesurée, créé au premier rendu"""
+
+    def __init__(self, workers: int = RENDER_WORKERS, max_queue: int = RENDER_MAX_QUEUE):
+        self.workers = max(1, workers)
+        self.max_queue = max_queue
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self._semaphore = None
+        self._loop = None
+        self._running = 0
+        self._queued = 0
+        self._max_queued = 0
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._render_seconds = 0.0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._executor_lock:
+            if self._executor is None:
+                # spawn : ne pas forker un process qui porte la boucle asyncio, Motor et des threads
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._executor
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.workers)
+            self._loop = loop
+        return self._semaphore
+
+    async def run(self, func, *args, on_abandon=None):
+        """
+        Exécute func(*args) dans un process du pool ; func doit être définie au niveau module.
+        Le créneau n'est libéré qu'à la fin réelle du rendu, même si l'appelant est annulé
+        (client déconnecté) : le process continue et occupe toujours un worker.
+        on_abandon() est appelée en cas d'échec ou d'annulation, une fois que le process
+        n'utilise plus les arguments (fichiers temporaires à supprimer).
+        """
+        if self._queued >= self.max_queue:
+            self._rejected += 1
+            raise HTTPException(status_code=503, detail="Trop d'exports en cours de génération, réessayez dans quelques instants")
+        semaphore = self._get_semaphore()
+        self._queued += 1
+        self._max_queued = max(self._max_queued, self._queued)
+        try:
+            await semaphore.acquire()
+        except BaseException:
+            if on_abandon is not None:
+                on_abandon()
+            raise
+        finally:
+            self._queued -= 1
+        self._running += 1
+        debut = perf_counter()
+        try:
+            future = asyncio.get_running_loop().run_in_executor(self._get_executor(), func, *args)
+        except BaseException:
+            self._render_done(semaphore, debut, None)
+            if on_abandon is not None:
+                on_abandon()
+            raise
+        future.add_done_callback(lambda f: self._render_done(semaphore, debut, f))
+        try:
+            return await asyncio.shield(future)
+        except BaseException:
+            if on_abandon is not None:
+                if future.done():
+                    on_abandon()
+                else:
+                    future.add_done_callback(lambda f: on_abandon())
+            raise
+
+    def _render_done(self, semaphore: asyncio.Semaphore, debut: float, future):
+        """Fin réelle d'un rendu : libère le créneau et compte le résultat"""
+        self._running -= 1
+        self._render_seconds += perf_counter() - debut
+        semaphore.release()
+        if future is not None and not future.cancelled() and future.exception() is None:
+            self._completed += 1
+            return
+        self._failed += 1
+        if future is not None and not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+            # Process de rendu tué (OOM...) : le pool est recréé au prochain rendu
+            self.close()
+
+    def close(self):
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def stats(self) -> dict:
+        termines = self._completed + self._failed
+        return {
+            "workers": self.workers,
+            "running": self._running,
+            "queued": self._queued,
+            "max_queued": self._max_queued,
+            "max_queue": self.max_queue,
+            "completed": self._completed,
+            "failed": self._failed,
+            "rejected": self._rejected,
+            "avg_render_ms": round(self._render_seconds / termines * 1000, 1) if termines else 0.0
+        }
+
+render_pool = RenderPool()
+
+class RenderedReport:
+    """Rapport généré par un exporteur : octets en mémoire ou fichier temporaire sur disque"""
+
+    def __init__(self, filename: str, media_type: str, content: Optional[bytes] = None, path: Optional[str] = None):
+        self.filename = filename
+        self.media_type = media_type
+        self.content = content
+        self.path = path
+
+    def open(self):
+        return open(self.path, "rb") if self.path else io.BytesIO(self.content)
+
+    def cleanup(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+# =====================
+# CACHE DES RAPPORTS GÉNÉRÉS
+# =====================
+# Un même bilan (partenaire, période) est souvent exporté plusieurs fois par différents
+# chefs de projet. Les fichiers générés sont conservés dans le bucket GridFS "report_cache"
+# sous une clé dérivée de (exporteur, paramètres, version des données). La version résume
+# les documents lus par le rapport (nombre, max created_at / updated_at) et les références
+# affichées : création, modification ou suppression changent la clé, et les anciennes
+# entrées, plus jamais lues, sortent par éviction LRU (taille totale et nombre d'entrées).
+# La clé sert d'ETag : un GET conditionnel sur un rapport inchangé renvoie 304 sans rendu.
+# Les rendus qui impriment leur date de génération (PDF, PPT) ajoutent le jour à leur
+# version : un rapport en cache n'est jamais servi avec la date d'un jour précédent.
+
+REPORT_CACHE_MAX_BYTES = int(float(os.getenv('REPORT_CACHE_MAX_MB', '512')) * 1024 * 1024)
+REPORT_CACHE_MAX_ENTRIES = int(os.getenv('REPORT_CACHE_MAX_ENTRIES', '500'))
+
+report_cache_fs = motor.motor_asyncio.AsyncIOMotorGridFSBucket(db, bucket_name="report_cache")
+REPORT_CACHE_ORPHAN_GRACE = timedelta(minutes=10)  # upload en cours, entrée pas encore écrite
+
+report_cache_state = {"hits": 0, "misses": 0, "not_modified": 0, "evicted": 0, "orphans_removed": 0}
+
+def generation_day() -> str:
+    """Jour (UTC) imprimé par les rendus datés, à inclure dans leur version de cache"""
+    return datetime.now(timezone.utc).date().isoformat()
+
+async def data_version(sources: list, refs=None) -> str:
+    """Empreinte des documents lus par un rapport : sources = [(collection, filtre)], refs = références affichées"""
+    empreinte = [refs]
+    for collection_name, query in sources:
+        rows = await db[collection_name].aggregate([
+            {"$match": query},
+            {"$group": {"_id": None, "count": {"$sum": 1}, "created": {"$max": "$created_at"}, "updated": {"$max": "$updated_at"}}},
+            {"$project": {"_id": 0}}
+        ]).to_list(1)
+        empreinte.append([collection_name, rows[0] if rows else None])
+    return hashlib.sha256(json.dumps(empreinte, sort_keys=True, default=str).encode()).hexdigest()
+
+def report_cache_key(exporter: str, params: dict, version: str) -> str:
+    return hashlib.sha256(json.dumps([exporter, params, version], sort_keys=True, default=str).encode()).hexdigest()
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidats = [candidat.strip() for candidat in if_none_match.split(",")]
+    return "*" in candidats or any(candidat.removeprefix("W/") == etag for candidat in candidats)
+
+async def iter_gridfs_chunks(grid_out):
+    """Contenu d'un fichier GridFS, morceau par morceau"""
+    while True:
+        chunk = await grid_out.readchunk()
+        if not chunk:
+            break
+        yield chunk
+
+async def evict_report_cache(keep: Optional[str] = None) -> int:
+    """Supprime les entrées les moins récemment lues au-delà des limites de taille et de nombre"""
+    total, nombre, evincees = 0, 0, []
+    async for entry in db.report_cache.find({}, {"_id": 0, "key": 1, "file_id": 1, "size": 1}).sort("last_access", DESCENDING):
+        total += entry.get("size", 0)
+        nombre += 1
+        if entry["key"] != keep and (total > REPORT_CACHE_MAX_BYTES or nombre > REPORT_CACHE_MAX_ENTRIES):
+            evincees.append(entry)
+    for entry in evincees:
+        try:
+            await report_cache_fs.delete(entry["file_id"])
+        except gridfs.errors.NoFile:
+            pass
+    if evincees:
+        await db.report_cache.delete_many({"key": {"$in": [entry["key"] for entry in evincees]}})
+        report_cache_state["evicted"] += len(evincees)
+    return len(evincees)
+
+async def sweep_report_cache_orphans() -> int:
+    """
+    Supprime les fichiers GridFS du cache qu'aucune entrée report_cache ne référence
+    (arrêt entre l'upload et l'insertion de l'entrée), invisibles pour l'éviction.
+    """
+    limite = datetime.now(timezone.utc) - REPORT_CACHE_ORPHAN_GRACE
+    fichiers = await db["report_cache.files"].find({"uploadDate": {"$lt": limite}}, {"_id": 1}).to_list(length=None)
+    if not fichiers:
+        return 0
+    references = set(await db.report_cache.distinct("file_id", {"file_id": {"$in": [f["_id"] for f in fichiers]}}))
+    orphelins = [f["_id"] for f in fichiers if f["_id"] not in references]
+    for file_id in orphelins:
+        try:
+            await report_cache_fs.delete(file_id)
+        except gridfs.errors.NoFile:
+            pass
+    report_cache_state["orphans_removed"] += len(orphelins)
+    return len(orphelins)
+
+async def _report_cache_put(key: str, exporter: str, report: RenderedReport) -> dict:
+    with report.open() as source:
+        file_id = await report_cache_fs.upload_from_stream(
+            report.filename, source, metadata={"key": key, "content_type": report.media_type}
+        )
+    fichier = await db["report_cache.files"].find_one({"_id": file_id}, {"length": 1})
+    now = datetime.now(timezone.utc)
+    entry = {
+        "key": key,
+        "exporter": exporter,
+        "file_id": file_id,
+        "filename": report.filename,
+        "media_type": report.media_type,
+        "size": fichier.get("length", 0) if fichier else 0,
+        "hits": 0,
+        "created_at": now,
+        "last_access": now
+    }
+    try:
+        await db.report_cache.insert_one(dict(entry))
+    except DuplicateKeyError:
+        # Même rapport généré en parallèle par une autre requête : on garde le premier
+        await report_cache_fs.delete(file_id)
+        return await db.report_cache.find_one({"key": key}, {"_id": 0})
+    await evict_report_cache(keep=key)
+    await sweep_report_cache_orphans()
+    return entry
+
+async def serve_cached_report(request: Request, exporter: str, params: dict, version: str, build, headers_for) -> Response:
+    """
+    Sert un rapport depuis le cache, ou le génère avec build() -> RenderedReport puis le met en cache.
+    headers_for(filename) renvoie les en-têtes propres à la route (Content-Disposition...).
+    """
+    key = report_cache_key(exporter, params, version)
+    cache_headers = {"ETag": f'"{key}"', "Cache-Control": "private, no-cache"}
+    if _etag_matches(request.headers.get("if-none-match"), cache_headers["ETag"]):
+        report_cache_state["not_modified"] += 1
+        return Response(status_code=304, headers=cache_headers)
+    
+    grid_out = None
+    entry = await db.report_cache.find_one_and_update(
+        {"key": key},
+        {"$set": {"last_access": datetime.now(timezone.utc)}, "$inc": {"hits": 1}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    if entry:
+        try:
+            grid_out = await report_cache_fs.open_download_stream(entry["file_id"])
+            report_cache_state["hits"] += 1
+        except gridfs.errors.NoFile:
+            await db.report_cache.delete_one({"key": key})
+    if grid_out is None:
+        report_cache_state["misses"] += 1
+        report = await build()
+        try:
+            entry = await _report_cache_put(key, exporter, report)
+        finally:
+            report.cleanup()
+        grid_out = await report_cache_fs.open_download_stream(entry["file_id"])
     
-    # Récupérer les informations du programme et partenaire
-    programme = await db.programmes.find_one({"id": test.get("programme_id")})
-    partenaire = await db.partenaires.find_one({"id": test.get("partenaire_id")})
+    return StreamingResponse(
+        iter_gridfs_chunks(grid_out),
+        media_type=entry["media_type"],
+        headers={**headers_for(entry["filename"]), **cache_headers, "Content-Length": str(entry["size"])}
+    )
+
+async def report_cache_usage() -> dict:
+    rows = await db.report_cache.aggregate([
+        {"$group": {"_id": None, "entries": {"$sum": 1}, "size": {"$sum": "$size"}}},
+        {"$project": {"_id": 0}}
+    ]).to_list(1)
+    return {
+        **report_cache_state,
+        **(rows[0] if rows else {"entries": 0, "size": 0}),
+        "max_size": REPORT_CACHE_MAX_BYTES,
+        "max_entries": REPORT_CACHE_MAX_ENTRIES
+    }
+
+def render_incident_report_pdf(rapport: dict) -> bytes:
+    """
+    Rendu reportlab du rapport d'incident, exécuté dans le pool de rendu.
+    rapport : test, alertes, test_type, test_label, programme_nom, partenaire_nom,
+    jour_generation (ISO) et images (octets des captures par identifiant GridFS).
+    """
+    test = rapport["test"]
+    alertes = rapport["alertes"]
+    test_type = rapport["test_type"]
+    test_label = rapport["test_label"]
+    images = rapport["images"]
     
     # Créer le PDF en mémoire
     buffer = io.BytesIO()
@@ -2158,7 +4264,8 @@ async def export_incident_report(
     story.append(Spacer(1, 0.2*inch))
     
     # Date de génération
-    date_generation = datetime.now(timezone.utc).strftime("%d/%m/%Y à %H:%M")
+    # Jour seul : le rendu est mis en cache pour la journée (generation_day dans sa version)
+    date_generation = datetime.fromisoformat(rapport["jour_generation"]).strftime("%d/%m/%Y")
     story.append(Paragraph(f"<b>Date de génération :</b> {date_generation}", normal_style))
     story.append(Spacer(1, 0.3*inch))
     
@@ -2166,9 +4273,9 @@ async def export_incident_report(
     story.append(Paragraph("INFORMATIONS DU TEST", heading_style))
     
     test_data = [
-        ["Programme", programme.get('nom', 'N/A') if programme else 'N/A'],
-        ["Partenaire", partenaire.get('nom', 'N/A') if partenaire else 'N/A'],
-        ["Date du test", test.get('date_test', 'N/A')],
+        ["Programme", rapport["programme_nom"]],
+        ["Partenaire", rapport["partenaire_nom"]],
+        ["Date du test", date_iso(test.get('date_test')) or 'N/A'],
     ]
     
     if test_type == "site":
@@ -2239,7 +4346,7 @@ async def export_incident_report(
         
         # Créer des Paragraphs pour gérer le word wrap
         statut_para = Paragraph(alerte.get('statut', 'N/A').upper(), normal_style)
-        date_para = Paragraph(alerte.get('created_at', 'N/A')[:10] if alerte.get('created_at') else 'N/A', normal_style)
+        date_para = Paragraph(date_iso(alerte.get('created_at'))[:10] if alerte.get('created_at') else 'N/A', normal_style)
         
         incident_data.extend([
             ["Statut", statut_para],
@@ -2315,9 +4422,8 @@ async def export_incident_report(
             screenshot_images = []
             for screenshot_id in screenshots_ids[:3]:  # Max 3 screenshots
                 try:
-                    # Récupérer l'image depuis GridFS
-                    grid_out = await fs.open_download_stream(ObjectId(screenshot_id))
-                    image_data = await grid_out.read()
+                    # Image lue depuis GridFS par l'étape async (absente si illisible)
+                    image_data = images[screenshot_id]
                     
                     # Créer un objet Image reportlab depuis les bytes
                     img_buffer = io.BytesIO(image_data)
@@ -2369,9 +4475,8 @@ async def export_incident_report(
         
         for idx, screenshot_id in enumerate(test_screenshots[:3], 1):
             try:
-                # Récupérer l'image depuis GridFS
-                grid_out = await fs.open_download_stream(ObjectId(screenshot_id))
-                image_data = await grid_out.read()
+                # Image lue depuis GridFS par l'étape async (absente si illisible)
+                image_data = images[screenshot_id]
                 
                 # Créer un objet Image reportlab - GRANDE TAILLE pour lisibilité
                 img_buffer = io.BytesIO(image_data)
@@ -2408,7 +4513,53 @@ async def export_incident_report(
     
     # Build PDF
     doc.build(story)
-    buffer.seek(0)
+    return buffer.getvalue()
+
+async def load_report_images(screenshot_ids: List[str]) -> dict:
+    """Octets des captures lues depuis GridFS ; une capture illisible est absente du résultat"""
+    images = {}
+    for screenshot_id in screenshot_ids:
+        if screenshot_id in images:
+            continue
+        try:
+            grid_out = await fs.open_download_stream(ObjectId(screenshot_id))
+            images[screenshot_id] = await grid_out.read()
+        except Exception as e:
+            logging.error(f"Erreur chargement screenshot {screenshot_id}: {str(e)}")
+    return images
+
+# Routes - Export Incident Report
+@api_router.get("/export-alerte-report/{test_id}")
+async def export_incident_report(
+    test_id: str,
+    request: Request,
+    test_type: str = Query(..., description="Type de test: 'site' ou 'ligne'"),
+    current_user: User = Depends(get_current_active_user)
+):
+    """Generate a PDF alerte report for a test"""
+    
+    # Récupérer le test selon son type
+    if test_type == "site":
+        test = await db.tests_site.find_one({"id": test_id}, {"_id": 0})
+        test_label = "Test Site"
+    elif test_type == "ligne":
+        test = await db.tests_ligne.find_one({"id": test_id}, {"_id": 0})
+        test_label = "Test Ligne"
+    else:
+        raise HTTPException(status_code=400, detail="Type de test invalide")
+    
+    if not test:
+        raise HTTPException(status_code=404, detail="Test non trouvé")
+    
+    # Récupérer les alertes liés à ce test
+    alertes = await db.alertes.find({"test_id": test_id}, {"_id": 0}).to_list(length=None)
+    
+    if not alertes:
+        raise HTTPException(status_code=404, detail="Aucun alerte trouvé pour ce test")
+    
+    # Récupérer les informations du programme et partenaire
+    programme = await programmes_cache.get(test.get("programme_id"))
+    partenaire = await partenaires_cache.get(test.get("partenaire_id"))
     
     # Construire le nom de fichier avec le format: TestType-Programme-Partenaire-DateHeure
     test_type_label = "TestSite" if test_type == "site" else "TestLigne"
@@ -2420,7 +4571,7 @@ async def export_incident_report(
     if date_test_str:
         try:
             # Parser la date ISO et formater en YYYYMMDD_HHMM
-            date_test_parsed = datetime.fromisoformat(date_test_str.replace('Z', '+00:00'))
+            date_test_parsed = parse_date(date_test_str)
             date_formatted = date_test_parsed.strftime('%Y%m%d_%H%M')
         except:
             date_formatted = datetime.now().strftime('%Y%m%d_%H%M')
@@ -2445,10 +4596,31 @@ async def export_incident_report(
     
     filename = f"{test_type_label}-{clean_filename(programme_nom)}-{clean_filename(partenaire_nom)}-{date_formatted}.pdf"
     
-    return StreamingResponse(
-        buffer,
-        media_type="application/pdf",
-        headers={
+    jour_generation = generation_day()
+    
+    async def build() -> RenderedReport:
+        # Captures lues ici ; le rendu reportlab (CPU) part dans le pool de rendu
+        screenshot_ids = [sid for alerte in alertes for sid in (alerte.get('screenshots') or [])[:3]]
+        screenshot_ids += (test.get('screenshots') or [])[:3]
+        pdf = await render_pool.run(render_incident_report_pdf, {
+            "test": test,
+            "alertes": alertes,
+            "test_type": test_type,
+            "test_label": test_label,
+            "programme_nom": programme.get('nom', 'N/A') if programme else 'N/A',
+            "partenaire_nom": partenaire.get('nom', 'N/A') if partenaire else 'N/A',
+            "images": await load_report_images(screenshot_ids),
+            "jour_generation": jour_generation,
+        })
+        return RenderedReport(filename, "application/pdf", content=pdf)
+    
+    version = await data_version(
+        [("tests_site" if test_type == "site" else "tests_ligne", {"id": test_id}), ("alertes", {"test_id": test_id})],
+        refs=[programme_nom, partenaire_nom, jour_generation]  # Date de génération imprimée
+    )
+    return await serve_cached_report(
+        request, "incident-report-pdf", {"test_id": test_id, "test_type": test_type}, version, build,
+        lambda filename: {
             "Content-Disposition": f"attachment; filename={filename}",
             "X-Filename": filename  # Header supplémentaire pour le frontend
         }
@@ -2456,6 +4628,65 @@ async def export_incident_report(
 
 # Routes - Stats & Dashboard
 
+async def count_tests_par_couple(collection, debut: str, fin: str, champ_reussite: str) -> dict:
+    """
+    Compte les tests d'une période en UNE seule agrégation, groupés par couple
+    (partenaire_id, programme_id). Remplace les count_documents par couple :
+    le nombre de requêtes ne dépend plus de la taille du catalogue.
+    Retourne {(partenaire_id, programme_id): {"total", "reussis", "non_realisables"}}
+    """
+    pipeline = [
+        {"$match": add_date_range({}, collection.name, "date_test", gte=debut, lte=fin)},
+        {"$group": {
+            "_id": {"partenaire_id": "$partenaire_id", "programme_id": "$programme_id"},
+            "total": {"$sum": 1},
+            "reussis": {"$sum": {"$cond": [{"$eq": [f"${champ_reussite}", True]}, 1, 0]}},
+            "non_realisables": {"$sum": {"$cond": [{"$eq": ["$test_non_realisable", True]}, 1, 0]}}
+        }}
+    ]
+
+    resultats = {}
+    async for row in collection.aggregate(pipeline):
+        couple = (row['_id'].get('partenaire_id'), row['_id'].get('programme_id'))
+        resultats[couple] = {
+            "total": row['total'],
+            "reussis": row['reussis'],
+            "non_realisables": row['non_realisables']
+        }
+    return resultats
+
+async def couples_testes_par_mois(collection, annee: int, mois_fin: int) -> dict:
+    """
+    Une seule agrégation sur l'année : bucketise date_test par mois (dates BSON
+    ou chaînes ISO) et par couple (partenaire_id, programme_id).
+    Ne couvre que les mois [1, mois_fin[ (mois clos).
+    Retourne {mois: set((partenaire_id, programme_id))}
+    """
+    # Chaînes ISO comparées sur le préfixe AAAA-MM-JJ pendant la migration des dates
+    match = add_date_range({}, collection.name, "date_test",
+                           gte=f"{annee}-01-01", lt=f"{annee}-{mois_fin:02d}-01")
+
+    pipeline = [
+        {"$match": match},
+        {"$project": {
+            "_id": 0,
+            "partenaire_id": 1,
+            "programme_id": 1,
+            "mois": {"$cond": [
+                {"$eq": [{"$type": "$date_test"}, "date"]},
+                {"$month": "$date_test"},
+                {"$toInt": {"$substrCP": ["$date_test", 5, 2]}}
+            ]}
+        }},
+        {"$group": {"_id": {"mois": "$mois", "partenaire_id": "$partenaire_id", "programme_id": "$programme_id"}}}
+    ]
+
+    par_mois = {}
+    async for row in collection.aggregate(pipeline):
+        cle = row['_id']
+        par_mois.setdefault(cle['mois'], set()).add((cle.get('partenaire_id'), cle.get('programme_id')))
+    return par_mois
+
 async def get_agent_dashboard_stats(user: User):
     """Dashboard simplifié pour les agents - focus sur les tâches à faire"""
     from datetime import datetime, timezone
@@ -2468,9 +4699,12 @@ async def get_agent_dashboard_stats(user: User):
     last_day = datetime(year, month, last_day_num, 23, 59, 59, tzinfo=timezone.utc).isoformat()
     
     # Récupérer tous les partenaires et programmes
-    partenaires = await db.partenaires.find({}, {"_id": 0}).to_list(1000)
-    programmes = await db.programmes.find({}, {"_id": 0}).to_list(1000)
-    programmes_dict = {p['id']: p['nom'] for p in programmes}
+    partenaires = await partenaires_cache.get_all()
+    programmes_dict = await programmes_cache.noms()
+    
+    # Tests du mois agrégés par couple partenaire/programme (1 requête par collection)
+    site_par_couple = await count_tests_par_couple(db.tests_site, first_day, last_day, "application_remise")
+    ligne_par_couple = await count_tests_par_couple(db.tests_ligne, first_day, last_day, "application_offre")
     
     # Tâches à effectuer : tests manquants ce mois
     taches_tests = []
@@ -2495,13 +4729,7 @@ async def get_agent_dashboard_stats(user: User):
             # Vérifier test site ce mois (uniquement si requis)
             if test_site_requis:
                 tests_site_attendus += 1
-                test_site_count = await db.tests_site.count_documents({
-                    "partenaire_id": part_id,
-                    "programme_id": prog_id,
-                    "date_test": {"$gte": first_day, "$lte": last_day}
-                })
-                
-                if test_site_count > 0:
+                if (part_id, prog_id) in site_par_couple:
                     tests_site_effectues += 1
                 else:
                     # Collecter les tests site manquants comme "tâches à faire"
@@ -2517,13 +4745,7 @@ async def get_agent_dashboard_stats(user: User):
             # Vérifier test ligne ce mois (uniquement si requis)
             if test_ligne_requis:
                 tests_ligne_attendus += 1
-                test_ligne_count = await db.tests_ligne.count_documents({
-                    "partenaire_id": part_id,
-                    "programme_id": prog_id,
-                    "date_test": {"$gte": first_day, "$lte": last_day}
-                })
-                
-                if test_ligne_count > 0:
+                if (part_id, prog_id) in ligne_par_couple:
                     tests_ligne_effectues += 1
                 else:
                     # Collecter les tests ligne manquants comme "tâches à faire"
@@ -2542,28 +4764,14 @@ async def get_agent_dashboard_stats(user: User):
         {"_id": 0}
     ).to_list(1000)
     
-    # Enrichir les alertes avec les noms de partenaires et programmes
-    for alerte in incidents_en_cours:
-        # Récupérer le partenaire
-        partenaire = await db.partenaires.find_one(
-            {"id": alerte.get("partenaire_id")},
-            {"_id": 0, "nom": 1}
-        )
-        alerte["partenaire_nom"] = partenaire.get("nom") if partenaire else "Inconnu"
-        
-        # Récupérer le programme
-        programme = await db.programmes.find_one(
-            {"id": alerte.get("programme_id")},
-            {"_id": 0, "nom": 1}
-        )
-        alerte["programme_nom"] = programme.get("nom") if programme else "Inconnu"
+    # Enrichir les alertes en lot (aucune requête par alerte)
+    await enrich_alertes_noms(incidents_en_cours, defaut="Inconnu")
     
     # Compter les tests effectués ce mois (pour message encourageant)
-    tests_effectues_mois = await db.tests_site.count_documents({
-        "date_test": {"$gte": first_day, "$lte": last_day}
-    }) + await db.tests_ligne.count_documents({
-        "date_test": {"$gte": first_day, "$lte": last_day}
-    })
+    tests_effectues_mois = (
+        sum(c["total"] for c in site_par_couple.values())
+        + sum(c["total"] for c in ligne_par_couple.values())
+    )
     
     # Calculs pour la progression globale
     tests_attendus = tests_site_attendus + tests_ligne_attendus
@@ -2660,10 +4868,12 @@ async def get_tests_manquants_annee(current_user: User = Depends(get_current_use
             "message": "Les données seront disponibles à partir du 1er février"
         }
     
-    # Récupérer tous les partenaires et programmes
-    partenaires = await db.partenaires.find({}, {"_id": 0}).to_list(1000)
-    programmes = await db.programmes.find({}, {"_id": 0}).to_list(1000)
-    programmes_dict = {p['id']: p['nom'] for p in programmes}
+    # Récupérer tous les partenaires (contrats attendus)
+    partenaires = await partenaires_cache.get_all()
+    
+    # Tests de l'année bucketisés par mois et par couple (1 requête par collection)
+    site_par_mois = await couples_testes_par_mois(db.tests_site, current_year, current_month)
+    ligne_par_mois = await couples_testes_par_mois(db.tests_ligne, current_year, current_month)
     
     # Résultats par mois
     resultats_mois = []
@@ -2677,15 +4887,8 @@ async def get_tests_manquants_annee(current_user: User = Depends(get_current_use
     
     # Pour chaque mois clos (janvier → mois précédent)
     for mois in range(1, current_month):
-        # Dates du mois
-        first_day = datetime(current_year, mois, 1, tzinfo=timezone.utc)
-        if mois == 12:
-            next_month = datetime(current_year + 1, 1, 1, tzinfo=timezone.utc)
-        else:
-            next_month = datetime(current_year, mois + 1, 1, tzinfo=timezone.utc)
-        
-        first_day_iso = first_day.isoformat()
-        next_month_iso = next_month.isoformat()
+        couples_site = site_par_mois.get(mois, set())
+        couples_ligne = ligne_par_mois.get(mois, set())
         
         # Compteurs pour ce mois
         tests_attendus_mois = 0
@@ -2704,22 +4907,11 @@ async def get_tests_manquants_annee(current_user: User = Depends(get_current_use
                 test_site_requis = contact.get('test_site_requis', False)
                 test_ligne_requis = contact.get('test_ligne_requis', False)
                 
-                # Tests Site
+                # Tests Site (un test non_realisable compte comme effectué)
                 if test_site_requis:
                     tests_site_attendus_mois += 1
                     tests_attendus_mois += 1
-                    
-                    # Vérifier si test effectué (y compris non_realisable)
-                    query_site = {
-                        "partenaire_id": part_id,
-                        "programme_id": prog_id,
-                        "$or": [
-                            {"date_test": {"$gte": first_day, "$lt": next_month, "$type": "date"}},
-                            {"date_test": {"$gte": first_day_iso, "$lt": next_month_iso, "$type": "string"}}
-                        ]
-                    }
-                    test_site_count = await db.tests_site.count_documents(query_site)
-                    if test_site_count > 0:
+                    if (part_id, prog_id) in couples_site:
                         tests_site_effectues_mois += 1
                         tests_effectues_mois += 1
                 
@@ -2727,17 +4919,7 @@ async def get_tests_manquants_annee(current_user: User = Depends(get_current_use
                 if test_ligne_requis:
                     tests_ligne_attendus_mois += 1
                     tests_attendus_mois += 1
-                    
-                    query_ligne = {
-                        "partenaire_id": part_id,
-                        "programme_id": prog_id,
-                        "$or": [
-                            {"date_test": {"$gte": first_day, "$lt": next_month, "$type": "date"}},
-                            {"date_test": {"$gte": first_day_iso, "$lt": next_month_iso, "$type": "string"}}
-                        ]
-                    }
-                    test_ligne_count = await db.tests_ligne.count_documents(query_ligne)
-                    if test_ligne_count > 0:
+                    if (part_id, prog_id) in couples_ligne:
                         tests_ligne_effectues_mois += 1
                         tests_effectues_mois += 1
         
@@ -2778,8 +4960,8 @@ async def get_dashboard_stats(current_user: User = Depends(get_current_user)):
         return await get_agent_dashboard_stats(current_user)
     
     # Pour les autres rôles (admin, programme, partenaire), le dashboard normal
-    total_programmes = await db.programmes.count_documents({})
-    total_partenaires = await db.partenaires.count_documents({})
+    total_programmes = len(await programmes_cache.get_map())
+    total_partenaires = len(await partenaires_cache.get_map())
     total_incidents_ouverts = await db.alertes.count_documents({"statut": "ouvert"})
     
     # Calculer les dates du mois en cours
@@ -2795,9 +4977,12 @@ async def get_dashboard_stats(current_user: User = Depends(get_current_user)):
     is_j5_alert = days_until_end <= 5
     
     # Récupérer tous les partenaires et programmes
-    partenaires = await db.partenaires.find({}, {"_id": 0}).to_list(1000)
-    programmes = await db.programmes.find({}, {"_id": 0}).to_list(1000)
-    programmes_dict = {p['id']: p['nom'] for p in programmes}
+    partenaires = await partenaires_cache.get_all()
+    programmes_dict = await programmes_cache.noms()
+    
+    # Tests du mois agrégés par couple partenaire/programme (1 requête par collection)
+    site_par_couple = await count_tests_par_couple(db.tests_site, first_day, last_day, "application_remise")
+    ligne_par_couple = await count_tests_par_couple(db.tests_ligne, first_day, last_day, "application_offre")
     
     # Calculer les tests attendus et effectués
     # Pour chaque partenaire x programme : 1 test site + 1 test ligne attendu
@@ -2836,11 +5021,7 @@ async def get_dashboard_stats(current_user: User = Depends(get_current_user)):
             # Vérifier test site ce mois (uniquement si requis)
             test_site_count = 0
             if test_site_requis:
-                test_site_count = await db.tests_site.count_documents({
-                    "partenaire_id": part_id,
-                    "programme_id": prog_id,
-                    "date_test": {"$gte": first_day, "$lte": last_day}
-                })
+                test_site_count = site_par_couple.get((part_id, prog_id), {}).get("total", 0)
                 if test_site_count > 0:
                     tests_effectues += 1
                     tests_site_effectues += 1
@@ -2848,11 +5029,7 @@ async def get_dashboard_stats(current_user: User = Depends(get_current_user)):
             # Vérifier test ligne ce mois (uniquement si requis)
             test_ligne_count = 0
             if test_ligne_requis:
-                test_ligne_count = await db.tests_ligne.count_documents({
-                    "partenaire_id": part_id,
-                    "programme_id": prog_id,
-                    "date_test": {"$gte": first_day, "$lte": last_day}
-                })
+                test_ligne_count = ligne_par_couple.get((part_id, prog_id), {}).get("total", 0)
                 if test_ligne_count > 0:
                     tests_effectues += 1
                     tests_ligne_effectues += 1
@@ -2881,35 +5058,19 @@ async def get_dashboard_stats(current_user: User = Depends(get_current_user)):
     if is_j5_alert:
         tests_manquants_j5 = partenaires_manquants
     
-    # Taux de réussite TS (sur le mois)
-    total_tests_site_mois = await db.tests_site.count_documents({
-        "date_test": {"$gte": first_day, "$lte": last_day}
-    })
-    tests_site_reussis = await db.tests_site.count_documents({
-        "date_test": {"$gte": first_day, "$lte": last_day},
-        "application_remise": True
-    })
+    # Taux de réussite TS (sur le mois) - dérivé de l'agrégation, sans requête supplémentaire
+    total_tests_site_mois = sum(c["total"] for c in site_par_couple.values())
+    tests_site_reussis = sum(c["reussis"] for c in site_par_couple.values())
     taux_reussite_ts = (tests_site_reussis / total_tests_site_mois * 100) if total_tests_site_mois > 0 else 0
     
     # Taux de réussite TL (sur le mois)
-    total_tests_ligne_mois = await db.tests_ligne.count_documents({
-        "date_test": {"$gte": first_day, "$lte": last_day}
-    })
-    tests_ligne_reussis = await db.tests_ligne.count_documents({
-        "date_test": {"$gte": first_day, "$lte": last_day},
-        "application_offre": True
-    })
+    total_tests_ligne_mois = sum(c["total"] for c in ligne_par_couple.values())
+    tests_ligne_reussis = sum(c["reussis"] for c in ligne_par_couple.values())
     taux_reussite_tl = (tests_ligne_reussis / total_tests_ligne_mois * 100) if total_tests_ligne_mois > 0 else 0
     
     # Compter les tests non réalisables ce mois
-    tests_site_non_realisables = await db.tests_site.count_documents({
-        "date_test": {"$gte": first_day, "$lte": last_day},
-        "test_non_realisable": True
-    })
-    tests_ligne_non_realisables = await db.tests_ligne.count_documents({
-        "date_test": {"$gte": first_day, "$lte": last_day},
-        "test_non_realisable": True
-    })
+    tests_site_non_realisables = sum(c["non_realisables"] for c in site_par_couple.values())
+    tests_ligne_non_realisables = sum(c["non_realisables"] for c in ligne_par_couple.values())
     total_tests_non_realisables = tests_site_non_realisables + tests_ligne_non_realisables
     
     # Calcul du nombre réel de tests manquants
@@ -3002,537 +5163,460 @@ async def export_bilan_partenaire(
     date_fin: str = Query(...)
 ):
     # Récupérer le partenaire
-    partenaire = await db.partenaires.find_one({"id": partenaire_id}, {"_id": 0})
+    partenaire = await partenaires_cache.get(partenaire_id)
     if not partenaire:
         raise HTTPException(status_code=404, detail="Partenaire non trouvé")
     
-    # Récupérer tous les programmes
-    programmes = await db.programmes.find({}, {"_id": 0}).to_list(1000)
-    programmes_dict = {p['id']: p['nom'] for p in programmes}
+    # Noms des programmes (cache mémoire)
+    programmes_dict = await programmes_cache.noms()
     
     # Query pour tous les tests du partenaire dans la période (tous programmes)
-    query = {
-        'partenaire_id': partenaire_id,
-        'date_test': {
-            '$gte': date_debut,
-            '$lte': date_fin
-        }
-    }
-    
-    # Récupérer les tests site et ligne
-    tests_site = await db.tests_site.find(query, {"_id": 0}).to_list(10000)
-    tests_ligne = await db.tests_ligne.find(query, {"_id": 0}).to_list(10000)
+    query = {'partenaire_id': partenaire_id}
+    query_site = add_date_range(dict(query), "tests_site", 'date_test', gte=date_debut, lte=date_fin)
+    query_ligne = add_date_range(dict(query), "tests_ligne", 'date_test', gte=date_debut, lte=date_fin)
     
-    # Create CSV with both test types
-    output = io.StringIO()
+    fieldnames_site = ['Date', 'Programme', 'Application remise', 'Prix public', 'Prix remisé', 
+                      '% Remise', 'Naming', 'Cumul codes', 'Commentaire', 'Remarques importantes']
+    fieldnames_ligne = ['Date', 'Programme', 'Téléphone', 'Messagerie dédiée', 'Décroche dédié',
+                       'Délai attente', 'Conseiller', 'Évaluation', 'Offre appliquée', 'Commentaire', 'Remarques importantes']
     
-    # Header
-    output.write(f"BILAN PARTENAIRE: {partenaire['nom']}\n")
-    output.write(f"Période: du {date_debut} au {date_fin}\n")
-    output.write(f"Remise minimum attendue: {partenaire.get('remise_minimum', 'Non définie')}%\n")
-    output.write("\n")
-    
-    # Tests Site
-    output.write("=== TESTS SITE ===\n")
-    if tests_site:
-        fieldnames_site = ['Date', 'Programme', 'Application remise', 'Prix public', 'Prix remisé', 
-                          '% Remise', 'Naming', 'Cumul codes', 'Commentaire', 'Remarques importantes']
-        writer = csv.DictWriter(output, fieldnames=fieldnames_site)
-        writer.writeheader()
-        
-        for test in tests_site:
-            date_str = test['date_test'] if isinstance(test['date_test'], str) else test['date_test'].isoformat()
-            programme_nom = programmes_dict.get(test['programme_id'], test['programme_id'])
-            
-            writer.writerow({
-                'Date': date_str,
-                'Programme': programme_nom,
-                'Application remise': 'OUI' if test['application_remise'] else 'NON',
-                'Prix public': f"{test['prix_public']}€",
-                'Prix remisé': f"{test['prix_remise']}€",
-                '% Remise': f"{test['pct_remise_calcule']}%",
-                'Naming': test.get('naming_constate', ''),
-                'Cumul codes': 'OUI' if test['cumul_codes'] else 'NON',
-                'Commentaire': test.get('commentaire', ''),
-                'Remarques importantes': test.get('remarques_importantes', '')
-            })
-    else:
-        output.write("Aucun test site sur cette période\n")
+    def ligne_site(test):
+        return {
+            'Date': date_iso(test.get('date_test')),
+            'Programme': programmes_dict.get(test['programme_id'], test['programme_id']),
+            'Application remise': 'OUI' if test['application_remise'] else 'NON',
+            'Prix public': f"{test['prix_public']}€",
+            'Prix remisé': f"{test['prix_remise']}€",
+            '% Remise': f"{test['pct_remise_calcule']}%",
+            'Naming': test.get('naming_constate', ''),
+            'Cumul codes': 'OUI' if test['cumul_codes'] else 'NON',
+            'Commentaire': test.get('commentaire', ''),
+            'Remarques importantes': test.get('remarques_importantes', '')
+        }
     
-    output.write("\n\n")
+    def ligne_ligne(test):
+        return {
+            'Date': date_iso(test.get('date_test')),
+            'Programme': programmes_dict.get(test['programme_id'], test['programme_id']),
+            'Téléphone': test['numero_telephone'],
+            'Messagerie dédiée': 'OUI' if test['messagerie_vocale_dediee'] else 'NON',
+            'Décroche dédié': 'OUI' if test['decroche_dedie'] else 'NON',
+            'Délai attente': test['delai_attente'],
+            'Conseiller': test.get('nom_conseiller', 'NC'),
+            'Évaluation': test['evaluation_accueil'],
+            'Offre appliquée': 'OUI' if test['application_offre'] else 'NON',
+            'Commentaire': test.get('commentaire', ''),
+            'Remarques importantes': test.get('remarques_importantes', '')
+        }
     
-    # Tests Ligne
-    output.write("=== TESTS LIGNE ===\n")
-    if tests_ligne:
-        fieldnames_ligne = ['Date', 'Programme', 'Téléphone', 'Messagerie dédiée', 'Décroche dédié',
-                           'Délai attente', 'Conseiller', 'Évaluation', 'Offre appliquée', 'Commentaire', 'Remarques importantes']
-        writer = csv.DictWriter(output, fieldnames=fieldnames_ligne)
-        writer.writeheader()
+    champs_site = ['date_test', 'programme_id', 'application_remise', 'prix_public', 'prix_remise',
+                   'pct_remise_calcule', 'naming_constate', 'cumul_codes', 'commentaire', 'remarques_importantes']
+    champs_ligne = ['date_test', 'programme_id', 'numero_telephone', 'messagerie_vocale_dediee', 'decroche_dedie',
+                    'delai_attente', 'nom_conseiller', 'evaluation_accueil', 'application_offre', 'commentaire',
+                    'remarques_importantes']
+    
+    def curseur_tests(collection_name: str, query_tests: dict, champs: List[str]):
+        return db[collection_name].find(
+            query_tests, {"_id": 0, **{champ: 1 for champ in champs}}
+        ).sort([('date_test', 1), ('id', 1)]).batch_size(CSV_EXPORT_BATCH_SIZE)
+    
+    async def bilan_csv():
+        # Header
+        yield (
+            f"BILAN PARTENAIRE: {partenaire['nom']}\n"
+            f"Période: du {date_debut} au {date_fin}\n"
+            f"Remise minimum attendue: {partenaire.get('remise_minimum', 'Non définie')}%\n"
+            "\n"
+        )
         
-        for test in tests_ligne:
-            date_str = test['date_test'] if isinstance(test['date_test'], str) else test['date_test'].isoformat()
-            programme_nom = programmes_dict.get(test['programme_id'], test['programme_id'])
-            
-            writer.writerow({
-                'Date': date_str,
-                'Programme': programme_nom,
-                'Téléphone': test['numero_telephone'],
-                'Messagerie dédiée': 'OUI' if test['messagerie_vocale_dediee'] else 'NON',
-                'Décroche dédié': 'OUI' if test['decroche_dedie'] else 'NON',
-                'Délai attente': test['delai_attente'],
-                'Conseiller': test.get('nom_conseiller', 'NC'),
-                'Évaluation': test['evaluation_accueil'],
-                'Offre appliquée': 'OUI' if test['application_offre'] else 'NON',
-                'Commentaire': test.get('commentaire', ''),
-                'Remarques importantes': test.get('remarques_importantes', '')
-            })
-    else:
-        output.write("Aucun test ligne sur cette période\n")
+        for titre, collection_name, query_tests, champs, fieldnames, row, vide, fin in (
+            ("=== TESTS SITE ===\n", "tests_site", query_site, champs_site, fieldnames_site, ligne_site,
+             "Aucun test site sur cette période\n", "\n\n"),
+            ("=== TESTS LIGNE ===\n", "tests_ligne", query_ligne, champs_ligne, fieldnames_ligne, ligne_ligne,
+             "Aucun test ligne sur cette période\n", ""),
+        ):
+            yield titre
+            section_vide = True
+            async for chunk in iter_csv_rows(curseur_tests(collection_name, query_tests, champs), fieldnames, io.StringIO(), row=row):
+                section_vide = False
+                yield chunk
+            if section_vide:
+                yield vide
+            if fin:
+                yield fin
     
-    output.seek(0)
     return StreamingResponse(
-        iter([output.getvalue()]),
+        bilan_csv(),
         media_type="text/csv",
         headers={"Content-Disposition": f"attachment; filename=bilan_{partenaire['nom']}_{date_debut}_{date_fin}.csv"}
     )
 
-# Routes - Export Bilan Excel Tests Site
-@api_router.get("/export/bilan-site-excel")
-async def export_bilan_site_excel(
-    partenaire_id: Optional[str] = Query(None),
-    programme_id: Optional[str] = Query(None),
-    date_debut: str = Query(...),
-    date_fin: str = Query(...)
-):
+# =====================
+# EXPORT EXCEL EN ÉCRITURE SEULE (bilans site / ligne)
+# =====================
+# Classeur openpyxl write_only écrit dans un fichier temporaire, avec des styles nommés
+# partagés au lieu d'objets Border/Alignment par cellule. Le curseur (trié par groupe puis
+# date) est lu côté asyncio, le classeur est rendu dans le pool de rendu. Le fichier final
+# est servi depuis le disque puis supprimé.
+
+MOIS_FR = {
+    1: 'Janvier', 2: 'Février', 3: 'Mars', 4: 'Avril',
+    5: 'Mai', 6: 'Juin', 7: 'Juillet', 8: 'Août',
+    9: 'Septembre', 10: 'Octobre', 11: 'Novembre', 12: 'Décembre'
+}
+EXCEL_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+def _bilan_excel_styles() -> List[NamedStyle]:
+    bordure = Border(
+        left=Side(style='thin', color='000000'),
+        right=Side(style='thin', color='000000'),
+        top=Side(style='thin', color='000000'),
+        bottom=Side(style='thin', color='000000')
+    )
+    titre = NamedStyle(name='bilan_titre')
+    titre.font = Font(name='Calibri', size=14, bold=True, color='C00000')
+    titre.alignment = Alignment(horizontal='center', vertical='center')
+    entete = NamedStyle(name='bilan_entete')
+    entete.font = Font(name='Calibri', size=11, bold=True, color='FFFFFF')
+    entete.fill = PatternFill(start_color='C00000', end_color='C00000', fill_type='solid')
+    entete.alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
+    entete.border = bordure
+    cellule = NamedStyle(name='bilan_cellule')
+    cellule.alignment = Alignment(horizontal='center', vertical='center')
+    cellule.border = bordure
+    return [titre, entete, cellule]
+
+def mois_et_date_fr(value) -> tuple:
+    """('Février-2025', '15/02/2025') sans dépendre de la locale du process"""
+    date_str = value if isinstance(value, str) else date_iso(value)
     try:
-        from datetime import datetime as dt
-        import locale
-        
-        # Essayer de définir la locale française
-        try:
-            locale.setlocale(locale.LC_TIME, 'fr_FR.UTF-8')
-        except:
-            try:
-                locale.setlocale(locale.LC_TIME, 'fr_FR')
-            except:
-                pass  # Si pas de locale française, on utilisera l'anglais
-        
-        # Récupérer le partenaire ou programme
-        entity_name = ""
-        if partenaire_id:
-            partenaire = await db.partenaires.find_one({"id": partenaire_id}, {"_id": 0})
-            if not partenaire:
-                raise HTTPException(status_code=404, detail="Partenaire non trouvé")
-            entity_name = partenaire['nom']
-        elif programme_id:
-            programme = await db.programmes.find_one({"id": programme_id}, {"_id": 0})
-            if not programme:
-                raise HTTPException(status_code=404, detail="Programme non trouvé")
-            entity_name = programme['nom']
-        else:
-            raise HTTPException(status_code=400, detail="partenaire_id ou programme_id requis")
-        
-        # Récupérer tous les programmes et partenaires pour affichage
-        programmes = await db.programmes.find({}, {"_id": 0}).to_list(1000)
-        programmes_dict = {p['id']: p['nom'] for p in programmes}
-        
-        partenaires_all = await db.partenaires.find({}, {"_id": 0}).to_list(1000)
-        partenaires_dict = {p['id']: p['nom'] for p in partenaires_all}
-        
-        # Query pour tous les tests site du partenaire/programme dans la période
-        # Ajouter l'heure de fin de journée pour inclure toute la journée
-        date_fin_full = date_fin + "T23:59:59" if "T" not in date_fin else date_fin
-        date_debut_full = date_debut + "T00:00:00" if "T" not in date_debut else date_debut
-        
-        query = {
-            'date_test': {
-                '$gte': date_debut_full,
-                '$lte': date_fin_full
-            }
-        }
-        
-        if partenaire_id:
-            query['partenaire_id'] = partenaire_id
-        elif programme_id:
-            query['programme_id'] = programme_id
-        
-        tests_site = await db.tests_site.find(query, {"_id": 0}).to_list(10000)
-        
-        # Grouper les tests par programme (si export par partenaire) ou par partenaire (si export par programme)
-        tests_groupes = {}
-        group_key = 'programme_id' if partenaire_id else 'partenaire_id'
-        group_dict = programmes_dict if partenaire_id else partenaires_dict
-        
-        for test in tests_site:
-            key = test.get(group_key)
-            if key:  # Seulement si la clé existe
-                if key not in tests_groupes:
-                    tests_groupes[key] = []
-                tests_groupes[key].append(test)
-    
-        # Vérifier s'il y a des tests à exporter
-        if not tests_groupes:
-            raise HTTPException(status_code=404, detail="Aucun test site trouvé pour cette période")
-    
-        # Créer le workbook Excel
-        wb = Workbook()
-        wb.remove(wb.active)  # Supprimer la feuille par défaut
-    
-        # Styles
-        header_font = Font(name='Calibri', size=11, bold=True, color='FFFFFF')
-        header_fill = PatternFill(start_color='C00000', end_color='C00000', fill_type='solid')
-        header_alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
-    
-        title_font = Font(name='Calibri', size=14, bold=True, color='C00000')
-        title_alignment = Alignment(horizontal='center', vertical='center')
-    
-        cell_alignment_center = Alignment(horizontal='center', vertical='center')
-        cell_alignment_left = Alignment(horizontal='left', vertical='center')
-    
-        border_style = Border(
-            left=Side(style='thin', color='000000'),
-            right=Side(style='thin', color='000000'),
-            top=Side(style='thin', color='000000'),
-            bottom=Side(style='thin', color='000000')
-        )
-    
-        # Mapper mois en français
-        mois_fr = {
-            1: 'Janvier', 2: 'Février', 3: 'Mars', 4: 'Avril',
-            5: 'Mai', 6: 'Juin', 7: 'Juillet', 8: 'Août',
-            9: 'Septembre', 10: 'Octobre', 11: 'Novembre', 12: 'Décembre'
-        }
-    
-    # Créer une feuille par groupe
-        for group_id, tests in tests_groupes.items():
-            group_name = group_dict.get(group_id, group_id)
-            
-            # Créer la feuille (limiter le nom à 31 caractères pour Excel)
-            if partenaire_id:
-                sheet_name = f"{entity_name[:15]} - {group_name[:12]}"
-                title_text = f"TESTS SITE – {entity_name} – {group_name}"
-            else:
-                sheet_name = f"{group_name[:15]} - {entity_name[:12]}"
-                title_text = f"TESTS SITE – {group_name} – {entity_name}"
-            
-            ws = wb.create_sheet(title=sheet_name)
-            
-            # Titre principal (ligne 1 fusionnée)
-            ws.merge_cells('A1:I1')
-            title_cell = ws['A1']
-            title_cell.value = title_text
-            title_cell.font = title_font
-            title_cell.alignment = title_alignment
-            ws.row_dimensions[1].height = 25
-            
-            # En-têtes (ligne 2)
-            headers = ['MOIS', 'DATE EXACTE', 'OBJET', 'APPLICATION DE LA REMISE', 
-                       'Application claire (Prix GP vs Prix remisé)', '% REMISE', 'Naming de la remise', 
-                       'Cumul des codes promos', 'Remarques importantes']
-            
-            for col_num, header in enumerate(headers, 1):
-                cell = ws.cell(row=2, column=col_num)
-                cell.value = header
-                cell.font = header_font
-                cell.fill = header_fill
-                cell.alignment = header_alignment
-                cell.border = border_style
-            
-            ws.row_dimensions[2].height = 30
-            
-            # Données
-            for row_num, test in enumerate(tests, 3):
-                # Date
-                date_str = test['date_test'] if isinstance(test['date_test'], str) else test['date_test'].isoformat()
+        date_obj = value if isinstance(value, datetime) else datetime.fromisoformat(date_str.replace('Z', '+00:00'))
+        return f"{MOIS_FR[date_obj.month]}-{date_obj.year}", date_obj.strftime('%d/%m/%Y')
+    except (ValueError, AttributeError):
+        return date_str[:7], date_str
+
+def bilan_excel_filename(entity_name: str, date_debut: str) -> str:
+    """Nom du fichier : export_[entity]_[mois-année].xlsx"""
+    try:
+        date_obj_debut = datetime.fromisoformat(date_debut.replace('Z', '+00:00'))
+        return f"export_{entity_name.lower().replace(' ', '_')}_{MOIS_FR[date_obj_debut.month].lower()}-{date_obj_debut.year}.xlsx"
+    except ValueError:
+        return f"export_{entity_name.lower().replace(' ', '_')}.xlsx"
+
+class BilanRowsFile:
+    """
+    Fichier temporaire des valeurs de cellules d'un bilan Excel : l'étape async l'écrit
+    au fil du curseur, le pool de rendu le relit par morceaux. Seul le chemin traverse
+    la frontière entre processus ; la mémoire reste constante des deux côtés.
+    """
+
+    CHUNK_SIZE = 1000  # lignes par morceau sérialisé
+
+    def __init__(self):
+        fd, self.path = tempfile.mkstemp(suffix=".rows")
+        self._fichier = os.fdopen(fd, "wb")
+        self._lignes = []
+
+    def feuille(self, sheet_name: str, title_text: str):
+        self._flush()
+        self._dump(("feuille", sheet_name, title_text))
+
+    def ligne(self, valeurs: list):
+        self._lignes.append(valeurs)
+        if len(self._lignes) >= self.CHUNK_SIZE:
+            self._flush()
+
+    def _flush(self):
+        if self._lignes:
+            self._dump(("lignes", self._lignes))
+            self._lignes = []
+
+    def _dump(self, morceau):
+        pickle.dump(morceau, self._fichier, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def close(self):
+        if not self._fichier.closed:
+            self._flush()
+            self._fichier.close()
+
+    def cleanup(self):
+        self._fichier.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    @staticmethod
+    def read(path: str):
+        """Morceaux ("feuille", nom, titre) et ("lignes", [valeurs...]) dans l'ordre d'écriture"""
+        with open(path, "rb") as fichier:
+            while True:
                 try:
-                    date_obj = dt.fromisoformat(date_str.replace('Z', '+00:00'))
-                    # MOIS : Février-2025
-                    mois_nom = mois_fr.get(date_obj.month, date_obj.strftime('%B'))
-                    mois_formatted = f"{mois_nom}-{date_obj.year}"
-                    # DATE EXACTE : 15/02/2025
-                    date_formatted = date_obj.strftime('%d/%m/%Y')
-                except:
-                    mois_formatted = date_str[:7]
-                    date_formatted = date_str
-                
-                # Application claire de la remise
-                prix_gp = test.get('prix_public', 0)
-                prix_remise = test.get('prix_remise', 0)
-                application_claire = f"{prix_gp}€ vs {prix_remise}€"
-                
-                row_data = [
-                    mois_formatted,  # MOIS
-                    date_formatted,  # DATE EXACTE
-                    test.get('commentaire', ''),  # OBJET
-                    'Oui' if test.get('application_remise') else 'Non',  # APPLICATION DE LA REMISE
-                    application_claire,  # Application claire
-                    f"{test.get('pct_remise_calcule', 0)}%",  # % REMISE
-                    test.get('naming_constate', ''),  # Naming de la remise
-                    'Oui' if test.get('cumul_codes') else 'Non',  # Cumul des codes promos
-                    test.get('remarques_importantes', ''),  # Remarques importantes
-                ]
-                
-                for col_num, value in enumerate(row_data, 1):
-                    cell = ws.cell(row=row_num, column=col_num)
-                    cell.value = value
-                    cell.border = border_style
-                    cell.alignment = cell_alignment_center
-            
-            # Ajuster largeurs de colonnes
-            column_widths = {
-                'A': 18,  # MOIS
-                'B': 15,  # DATE EXACTE
-                'C': 35,  # OBJET
-                'D': 25,  # APPLICATION DE LA REMISE
-                'E': 30,  # Application claire
-                'F': 12,  # % REMISE
-                'G': 30,  # Naming
-                'H': 25,  # Cumul codes
-                'I': 40   # Remarques importantes
-            }
-            
+                    yield pickle.load(fichier)
+                except EOFError:
+                    return
+
+def render_bilan_excel(path: str, rows_path: str, headers: List[str], column_widths: dict) -> None:
+    """
+    Rendu openpyxl (write_only) exécuté dans le pool de rendu : écrit dans path un classeur
+    avec une feuille par groupe, en relisant au fil de l'eau le BilanRowsFile rows_path.
+    """
+    wb = Workbook(write_only=True)
+    for style in _bilan_excel_styles():
+        wb.add_named_style(style)
+    
+    def cellules(ws, valeurs, style):
+        result = []
+        for valeur in valeurs:
+            cell = WriteOnlyCell(ws, value=valeur)
+            cell.style = style
+            result.append(cell)
+        return result
+    
+    ws = None
+    for morceau in BilanRowsFile.read(rows_path):
+        if morceau[0] == "feuille":
+            _, sheet_name, title_text = morceau
+            ws = wb.create_sheet(title=sheet_name)
             for col_letter, width in column_widths.items():
                 ws.column_dimensions[col_letter].width = width
-        
-        # Sauvegarder dans un buffer
-        output = io.BytesIO()
-        wb.save(output)
-        output.seek(0)
-        
-        # Nom du fichier : export_[entity]_[mois-année].xlsx
-        try:
-            date_obj_debut = dt.fromisoformat(date_debut.replace('Z', '+00:00'))
-            mois_nom = mois_fr.get(date_obj_debut.month, date_obj_debut.strftime('%B')).lower()
-            filename = f"export_{entity_name.lower().replace(' ', '_')}_{mois_nom}-{date_obj_debut.year}.xlsx"
-        except:
-            filename = f"export_{entity_name.lower().replace(' ', '_')}.xlsx"
-        
-        return StreamingResponse(
-            output,
-            media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            headers={"Content-Disposition": f"attachment; filename={filename}"}
-        )
+            # Titre principal (ligne 1 fusionnée) puis en-têtes (ligne 2)
+            ws.merged_cells.add(f"A1:{get_column_letter(len(headers))}1")
+            ws.row_dimensions[1].height = 25
+            ws.row_dimensions[2].height = 30
+            ws.append(cellules(ws, [title_text], 'bilan_titre'))
+            ws.append(cellules(ws, headers, 'bilan_entete'))
+        else:
+            for valeurs in morceau[1]:
+                ws.append(cellules(ws, valeurs, 'bilan_cellule'))
+    
+    wb.save(path)
 
-    except HTTPException:
+async def write_bilan_excel(cursor, group_key: str, sheet_for_group, headers: List[str], column_widths: dict, row_values) -> str:
+    """
+    Écrit un classeur avec une feuille par groupe depuis un curseur trié par group_key
+    (les feuilles suivent donc l'ordre des identifiants de groupe, et non plus l'ordre
+    de première apparition des tests) ; renvoie le chemin du fichier temporaire (à
+    supprimer par l'appelant).
+    sheet_for_group(group_id) -> (nom de feuille, titre) ; row_values(test) -> valeurs.
+    """
+    # Étape async : les valeurs des cellules partent ligne à ligne dans un fichier temporaire
+    rows = BilanRowsFile()
+    try:
+        groupe_courant = None
+        premiere = True
+        async for test in cursor:
+            group_id = test.get(group_key)
+            if premiere or group_id != groupe_courant:
+                premiere = False
+                groupe_courant = group_id
+                rows.feuille(*sheet_for_group(group_id))
+            rows.ligne(row_values(test))
+        rows.close()
+    except BaseException:
+        # Y compris l'annulation de la requête (CancelledError)
+        rows.cleanup()
         raise
-    except Exception as e:
-        logging.error(f"Erreur lors de la génération du bilan Excel site: {str(e)}", exc_info=True)
-        raise HTTPException(status_code=500, detail=f"Erreur lors de la génération: {str(e)}")
 
-# Routes - Export Bilan Excel Tests Ligne
-@api_router.get("/export/bilan-ligne-excel")
-async def export_bilan_ligne_excel(
-    partenaire_id: Optional[str] = Query(None),
-    programme_id: Optional[str] = Query(None),
-    date_debut: str = Query(...),
-    date_fin: str = Query(...)
-):
-    try:
-        from datetime import datetime as dt
-        import locale
-        
-        # Essayer de définir la locale française
-        try:
-            locale.setlocale(locale.LC_TIME, 'fr_FR.UTF-8')
-        except:
-            try:
-                locale.setlocale(locale.LC_TIME, 'fr_FR')
-            except:
-                pass
-        
-        # Récupérer le partenaire ou programme
-        entity_name = ""
-        if partenaire_id:
-            partenaire = await db.partenaires.find_one({"id": partenaire_id}, {"_id": 0})
-            if not partenaire:
-                raise HTTPException(status_code=404, detail="Partenaire non trouvé")
-            entity_name = partenaire['nom']
-        elif programme_id:
-            programme = await db.programmes.find_one({"id": programme_id}, {"_id": 0})
-            if not programme:
-                raise HTTPException(status_code=404, detail="Programme non trouvé")
-            entity_name = programme['nom']
-        else:
-            raise HTTPException(status_code=400, detail="partenaire_id ou programme_id requis")
-        
-        # Récupérer tous les programmes et partenaires
-        programmes = await db.programmes.find({}, {"_id": 0}).to_list(1000)
-        programmes_dict = {p['id']: p['nom'] for p in programmes}
-        
-        partenaires_all = await db.partenaires.find({}, {"_id": 0}).to_list(1000)
-        partenaires_dict = {p['id']: p['nom'] for p in partenaires_all}
-        
-        # Query pour tous les tests ligne du partenaire/programme dans la période
-        # Ajouter l'heure de fin de journée pour inclure toute la journée
-        date_fin_full = date_fin + "T23:59:59" if "T" not in date_fin else date_fin
-        date_debut_full = date_debut + "T00:00:00" if "T" not in date_debut else date_debut
-        
-        query = {
-            'date_test': {
-                '$gte': date_debut_full,
-                '$lte': date_fin_full
-            }
-        }
-        
-        if partenaire_id:
-            query['partenaire_id'] = partenaire_id
-        elif programme_id:
-            query['programme_id'] = programme_id
-        
-        tests_ligne = await db.tests_ligne.find(query, {"_id": 0}).to_list(10000)
-        
-        # Grouper les tests par programme (si export par partenaire) ou par partenaire (si export par programme)
-        tests_groupes = {}
-        group_key = 'programme_id' if partenaire_id else 'partenaire_id'
-        group_dict = programmes_dict if partenaire_id else partenaires_dict
-        
-        for test in tests_ligne:
-            key = test.get(group_key)
-            if key:  # Seulement si la clé existe
-                if key not in tests_groupes:
-                    tests_groupes[key] = []
-                tests_groupes[key].append(test)
-        
-        # Vérifier s'il y a des tests à exporter
-        if not tests_groupes:
-            raise HTTPException(status_code=404, detail="Aucun test ligne trouvé pour cette période")
-        
-        # Créer le workbook Excel
-        wb = Workbook()
-        wb.remove(wb.active)  # Supprimer la feuille par défaut
-        
-        # Styles
-        header_font = Font(name='Calibri', size=11, bold=True, color='FFFFFF')
-        header_fill = PatternFill(start_color='C00000', end_color='C00000', fill_type='solid')
-        header_alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
-    
-        title_font = Font(name='Calibri', size=14, bold=True, color='C00000')
-        title_alignment = Alignment(horizontal='center', vertical='center')
-    
-        cell_alignment_center = Alignment(horizontal='center', vertical='center')
-        cell_alignment_left = Alignment(horizontal='left', vertical='center')
-    
-        border_style = Border(
-            left=Side(style='thin', color='000000'),
-            right=Side(style='thin', color='000000'),
-            top=Side(style='thin', color='000000'),
-            bottom=Side(style='thin', color='000000')
-        )
-    
-        # Mapper mois en français
-        mois_fr = {
-            1: 'Janvier', 2: 'Février', 3: 'Mars', 4: 'Avril',
-            5: 'Mai', 6: 'Juin', 7: 'Juillet', 8: 'Août',
-            9: 'Septembre', 10: 'Octobre', 11: 'Novembre', 12: 'Décembre'
-        }
+    fd, path = tempfile.mkstemp(suffix=".xlsx")
+    os.close(fd)
+
+    def abandon():
+        # Rendu en échec ou requête annulée : appelé quand le process n'écrit plus dans path
+        rows.cleanup()
+        if os.path.exists(path):
+            os.remove(path)
+
+    await render_pool.run(render_bilan_excel, path, rows.path, headers, column_widths, on_abandon=abandon)
+    rows.cleanup()
+    return path
+
+def bilan_site_row(test) -> list:
+    mois_formatted, date_formatted = mois_et_date_fr(test.get('date_test'))
+    return [
+        mois_formatted,  # MOIS
+        date_formatted,  # DATE EXACTE
+        test.get('commentaire', ''),  # OBJET
+        'Oui' if test.get('application_remise') else 'Non',  # APPLICATION DE LA REMISE
+        f"{test.get('prix_public', 0)}€ vs {test.get('prix_remise', 0)}€",  # Application claire
+        f"{test.get('pct_remise_calcule', 0)}%",  # % REMISE
+        test.get('naming_constate', ''),  # Naming de la remise
+        'Oui' if test.get('cumul_codes') else 'Non',  # Cumul des codes promos
+        test.get('remarques_importantes', ''),  # Remarques importantes
+    ]
+
+def bilan_ligne_row(test) -> list:
+    mois_formatted, date_formatted = mois_et_date_fr(test.get('date_test'))
+    return [
+        mois_formatted,  # MOIS
+        date_formatted,  # DATE EXACTE
+        test.get('numero_telephone', ''),  # Numéro de téléphone
+        'Oui' if test.get('messagerie_vocale_dediee') else 'Non',  # Messagerie Vocale dédiée
+        test.get('delai_attente', ''),  # Délai d'attente
+        test.get('nom_conseiller', ''),  # Nom du conseiller
+        'Oui' if test.get('decroche_dedie') else 'Non',  # Décroche dédiée
+        test.get('evaluation_accueil', ''),  # Évaluation de l'accueil
+        'Oui' if test.get('application_offre') else 'Non',  # Application de l'offre
+        test.get('remarques_importantes', ''),  # Remarques importantes
+    ]
+
+# Format de chaque bilan Excel : collection, libellé, en-têtes, largeurs de colonnes, ligne d'un test
+BILAN_EXCEL_FORMATS = {
+    "site": {
+        "collection": "tests_site",
+        "type_label": "SITE",
+        "headers": ['MOIS', 'DATE EXACTE', 'OBJET', 'APPLICATION DE LA REMISE', 
+                    'Application claire (Prix GP vs Prix remisé)', '% REMISE', 'Naming de la remise', 
+                    'Cumul des codes promos', 'Remarques importantes'],
+        "column_widths": {
+            'A': 18,  # MOIS
+            'B': 15,  # DATE EXACTE
+            'C': 35,  # OBJET
+            'D': 25,  # APPLICATION DE LA REMISE
+            'E': 30,  # Application claire
+            'F': 12,  # % REMISE
+            'G': 30,  # Naming
+            'H': 25,  # Cumul codes
+            'I': 40   # Remarques importantes
+        },
+        "row_values": bilan_site_row,
+    },
+    "ligne": {
+        "collection": "tests_ligne",
+        "type_label": "LIGNE",
+        "headers": ['MOIS', 'DATE EXACTE', 'Numéro de téléphone', 'Messagerie Vocale dédiée', 
+                    'Délai d\'attente', 'Nom du conseiller', 'Décroche dédiée', 
+                    'Évaluation de l\'accueil', 'Application de l\'offre', 'Remarques importantes'],
+        "column_widths": {
+            'A': 18,  # MOIS
+            'B': 15,  # DATE EXACTE
+            'C': 20,  # Numéro de téléphone
+            'D': 25,  # Messagerie Vocale dédiée
+            'E': 18,  # Délai d'attente
+            'F': 25,  # Nom du conseiller
+            'G': 18,  # Décroche dédiée
+            'H': 25,  # Évaluation de l'accueil
+            'I': 25,  # Application de l'offre
+            'J': 40   # Remarques importantes
+        },
+        "row_values": bilan_ligne_row,
+    },
+}
+
+def bilan_excel_query(collection_name: str, partenaire_id: Optional[str], programme_id: Optional[str], date_debut: str, date_fin: str) -> dict:
+    """Tests du partenaire (ou du programme) sur la période, journée de fin incluse"""
+    # Ajouter l'heure de fin de journée pour inclure toute la journée
+    date_fin_full = date_fin + "T23:59:59" if "T" not in date_fin else date_fin
+    date_debut_full = date_debut + "T00:00:00" if "T" not in date_debut else date_debut
+    
+    query = {'partenaire_id': partenaire_id} if partenaire_id else {'programme_id': programme_id}
+    return add_date_range(query, collection_name, 'date_test', gte=date_debut_full, lte=date_fin_full)
+
+async def build_bilan_excel(
+    type_test: str,
+    partenaire_id: Optional[str],
+    programme_id: Optional[str],
+    date_debut: str,
+    date_fin: str,
+    progress=None
+) -> RenderedReport:
+    """Bilan Excel d'un type de test : une feuille par programme (export partenaire) ou par partenaire (export programme)"""
+    bilan = BILAN_EXCEL_FORMATS[type_test]
+    collection_name = bilan["collection"]
+    type_label = bilan["type_label"]
+    
+    # Récupérer le partenaire ou programme
+    entity_name = ""
+    if partenaire_id:
+        partenaire = await partenaires_cache.get(partenaire_id)
+        if not partenaire:
+            raise HTTPException(status_code=404, detail="Partenaire non trouvé")
+        entity_name = partenaire['nom']
+    elif programme_id:
+        programme = await programmes_cache.get(programme_id)
+        if not programme:
+            raise HTTPException(status_code=404, detail="Programme non trouvé")
+        entity_name = programme['nom']
+    else:
+        raise HTTPException(status_code=400, detail="partenaire_id ou programme_id requis")
     
-        # Créer une feuille par groupe
-        for group_id, tests in tests_groupes.items():
-            group_name = group_dict.get(group_id, group_id)
-        
-            # Créer la feuille (limiter le nom à 31 caractères pour Excel)
-            if partenaire_id:
-                sheet_name = f"{entity_name[:15]} - {group_name[:12]}"
-                title_text = f"TESTS LIGNE – {entity_name} – {group_name}"
-            else:
-                sheet_name = f"{group_name[:15]} - {entity_name[:12]}"
-                title_text = f"TESTS LIGNE – {group_name} – {entity_name}"
-        
-            ws = wb.create_sheet(title=sheet_name)
-        
-            # Titre principal (ligne 1 fusionnée)
-            ws.merge_cells('A1:J1')
-            title_cell = ws['A1']
-            title_cell.value = title_text
-            title_cell.font = title_font
-            title_cell.alignment = title_alignment
-            ws.row_dimensions[1].height = 25
-        
-            # En-têtes (ligne 2) - NOUVELLES COLONNES
-            headers = ['MOIS', 'DATE EXACTE', 'Numéro de téléphone', 'Messagerie Vocale dédiée', 
-                       'Délai d\'attente', 'Nom du conseiller', 'Décroche dédiée', 
-                       'Évaluation de l\'accueil', 'Application de l\'offre', 'Remarques importantes']
-        
-            for col_num, header in enumerate(headers, 1):
-                cell = ws.cell(row=2, column=col_num)
-                cell.value = header
-                cell.font = header_font
-                cell.fill = header_fill
-                cell.alignment = header_alignment
-                cell.border = border_style
-        
-            ws.row_dimensions[2].height = 30
-        
-            # Données
-            for row_num, test in enumerate(tests, 3):
-                # Date
-                date_str = test['date_test'] if isinstance(test['date_test'], str) else test['date_test'].isoformat()
-                try:
-                    date_obj = dt.fromisoformat(date_str.replace('Z', '+00:00'))
-                    # MOIS : Février-2025
-                    mois_nom = mois_fr.get(date_obj.month, date_obj.strftime('%B'))
-                    mois_formatted = f"{mois_nom}-{date_obj.year}"
-                    # DATE EXACTE : 15/02/2025
-                    date_formatted = date_obj.strftime('%d/%m/%Y')
-                except:
-                    mois_formatted = date_str[:7]
-                    date_formatted = date_str
-            
-                row_data = [
-                    mois_formatted,  # MOIS
-                    date_formatted,  # DATE EXACTE
-                    test.get('numero_telephone', ''),  # Numéro de téléphone
-                    'Oui' if test.get('messagerie_vocale_dediee') else 'Non',  # Messagerie Vocale dédiée
-                    test.get('delai_attente', ''),  # Délai d'attente
-                    test.get('nom_conseiller', ''),  # Nom du conseiller
-                    'Oui' if test.get('decroche_dedie') else 'Non',  # Décroche dédiée
-                    test.get('evaluation_accueil', ''),  # Évaluation de l'accueil
-                    'Oui' if test.get('application_offre') else 'Non',  # Application de l'offre
-                    test.get('remarques_importantes', ''),  # Remarques importantes
-                ]
-            
-                for col_num, value in enumerate(row_data, 1):
-                    cell = ws.cell(row=row_num, column=col_num)
-                    cell.value = value
-                    cell.border = border_style
-                    cell.alignment = cell_alignment_center
-        
-            # Ajuster largeurs de colonnes
-            column_widths = {
-                'A': 18,  # MOIS
-                'B': 15,  # DATE EXACTE
-                'C': 20,  # Numéro de téléphone
-                'D': 25,  # Messagerie Vocale dédiée
-                'E': 18,  # Délai d'attente
-                'F': 25,  # Nom du conseiller
-                'G': 18,  # Décroche dédiée
-                'H': 25,  # Évaluation de l'accueil
-                'I': 25,  # Application de l'offre
-                'J': 40   # Remarques importantes
-            }
+    # Grouper les tests par programme (si export par partenaire) ou par partenaire (si export par programme)
+    group_key = 'programme_id' if partenaire_id else 'partenaire_id'
+    group_dict = await (programmes_cache.noms() if partenaire_id else partenaires_cache.noms())
     
-            for col_letter, width in column_widths.items():
-                ws.column_dimensions[col_letter].width = width
+    query = bilan_excel_query(collection_name, partenaire_id, programme_id, date_debut, date_fin)
+    query[group_key] = {"$nin": [None, ""]}  # Seulement si la clé de groupe existe
     
-        # Sauvegarder dans un buffer
-        output = io.BytesIO()
-        wb.save(output)
-        output.seek(0)
-        
-        # Nom du fichier : export_[entity]_[mois-année].xlsx
-        try:
-            date_obj_debut = dt.fromisoformat(date_debut.replace('Z', '+00:00'))
-            mois_nom = mois_fr.get(date_obj_debut.month, date_obj_debut.strftime('%B')).lower()
-            filename = f"export_{entity_name.lower().replace(' ', '_')}_{mois_nom}-{date_obj_debut.year}.xlsx"
-        except:
-            filename = f"export_{entity_name.lower().replace(' ', '_')}.xlsx"
-        
-        return StreamingResponse(
-            output,
-            media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            headers={"Content-Disposition": f"attachment; filename={filename}"}
-        )
+    # Vérifier s'il y a des tests à exporter
+    if not await db[collection_name].find_one(query, {"_id": 1}):
+        raise HTTPException(status_code=404, detail=f"Aucun test {type_label.lower()} trouvé pour cette période")
     
+    def sheet_for_group(group_id):
+        group_name = group_dict.get(group_id, group_id)
+        # Limiter le nom de feuille à 31 caractères pour Excel
+        if partenaire_id:
+            return f"{entity_name[:15]} - {group_name[:12]}", f"TESTS {type_label} – {entity_name} – {group_name}"
+        return f"{group_name[:15]} - {entity_name[:12]}", f"TESTS {type_label} – {group_name} – {entity_name}"
+    
+    if progress:
+        await progress(10, "Lecture des tests")
+    cursor = db[collection_name].find(query, {"_id": 0}).sort(
+        [(group_key, 1), ('date_test', 1), ('id', 1)]
+    ).batch_size(CSV_EXPORT_BATCH_SIZE)
+    path = await write_bilan_excel(cursor, group_key, sheet_for_group, bilan["headers"], bilan["column_widths"], bilan["row_values"])
+    
+    return RenderedReport(bilan_excel_filename(entity_name, date_debut), EXCEL_MEDIA_TYPE, path=path)
+
+async def export_bilan_excel(
+    request: Request,
+    type_test: str,
+    partenaire_id: Optional[str],
+    programme_id: Optional[str],
+    date_debut: str,
+    date_fin: str
+) -> Response:
+    """Bilan Excel servi depuis le cache des rapports tant que les tests de la période sont inchangés"""
+    collection_name = BILAN_EXCEL_FORMATS[type_test]["collection"]
+    entity = await (partenaires_cache.get(partenaire_id) if partenaire_id else programmes_cache.get(programme_id))
+    version = await data_version(
+        [(collection_name, bilan_excel_query(collection_name, partenaire_id, programme_id, date_debut, date_fin))],
+        refs=[entity, await (programmes_cache.noms() if partenaire_id else partenaires_cache.noms())]
+    )
+    return await serve_cached_report(
+        request,
+        f"bilan-{type_test}-excel",
+        {"partenaire_id": partenaire_id, "programme_id": programme_id, "date_debut": date_debut, "date_fin": date_fin},
+        version,
+        lambda: build_bilan_excel(type_test, partenaire_id, programme_id, date_debut, date_fin),
+        lambda filename: {"Content-Disposition": f"attachment; filename={filename}"}
+    )
+
+# Routes - Export Bilan Excel Tests Site
+@api_router.get("/export/bilan-site-excel")
+async def export_bilan_site_excel(
+    request: Request,
+    partenaire_id: Optional[str] = Query(None),
+    programme_id: Optional[str] = Query(None),
+    date_debut: str = Query(...),
+    date_fin: str = Query(...)
+):
+    try:
+        return await export_bilan_excel(request, "site", partenaire_id, programme_id, date_debut, date_fin)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Erreur lors de la génération du bilan Excel site: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Erreur lors de la génération: {str(e)}")
+
+# Routes - Export Bilan Excel Tests Ligne
+@api_router.get("/export/bilan-ligne-excel")
+async def export_bilan_ligne_excel(
+    request: Request,
+    partenaire_id: Optional[str] = Query(None),
+    programme_id: Optional[str] = Query(None),
+    date_debut: str = Query(...),
+    date_fin: str = Query(...)
+):
+    try:
+        return await export_bilan_excel(request, "ligne", partenaire_id, programme_id, date_debut, date_fin)
     except HTTPException:
         raise
     except Exception as e:
@@ -3540,6 +5624,46 @@ async def export_bilan_ligne_excel(
         raise HTTPException(status_code=500, detail=f"Erreur lors de la génération: {str(e)}")
 
 # Routes - Export CSV (legacy)
+CSV_EXPORT_BATCH_SIZE = 1000
+CSV_EXPORT_CHUNK_SIZE = 64 * 1024  # octets accumulés avant d'émettre un morceau
+
+def _csv_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return '' if value is None else value
+
+async def iter_csv_rows(cursor, fieldnames: List[str], writer_buffer: io.StringIO, writeheader: bool = True, row=None):
+    """
+    Écrit les documents du curseur en lignes CSV dans writer_buffer et émet son contenu
+    par morceaux : la mémoire reste constante quel que soit le nombre de lignes.
+    L'en-tête n'est écrit qu'avec la première ligne (rien n'est émis si aucun document).
+    row(doc) construit la ligne ; par défaut, les champs homonymes des colonnes.
+    """
+    writer = csv.DictWriter(writer_buffer, fieldnames=fieldnames, extrasaction='ignore')
+    header_pending = writeheader
+    async for doc in cursor:
+        if header_pending:
+            writer.writeheader()
+            header_pending = False
+        writer.writerow(row(doc) if row else {k: _csv_value(doc.get(k)) for k in fieldnames})
+        if writer_buffer.tell() >= CSV_EXPORT_CHUNK_SIZE:
+            yield writer_buffer.getvalue()
+            writer_buffer.seek(0)
+            writer_buffer.truncate(0)
+    if writer_buffer.tell():
+        yield writer_buffer.getvalue()
+        writer_buffer.seek(0)
+        writer_buffer.truncate(0)
+
+def stream_collection_csv(collection_name: str, query: dict, fieldnames: List[str], filename: str) -> StreamingResponse:
+    """Export CSV en flux d'une collection : curseur par lots, projection sur les colonnes exportées"""
+    cursor = db[collection_name].find(query, {"_id": 0, **{k: 1 for k in fieldnames}}).batch_size(CSV_EXPORT_BATCH_SIZE)
+    return StreamingResponse(
+        iter_csv_rows(cursor, fieldnames, io.StringIO()),
+        media_type="text/csv",
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
+
 @api_router.get("/export/tests-site")
 async def export_tests_site_csv(
     programme_id: Optional[str] = Query(None),
@@ -3551,30 +5675,10 @@ async def export_tests_site_csv(
     if partenaire_id:
         query['partenaire_id'] = partenaire_id
     
-    tests = await db.tests_site.find(query, {"_id": 0}).to_list(10000)
-    
-    # Create CSV
-    output = io.StringIO()
-    if tests:
-        fieldnames = ['id', 'programme_id', 'partenaire_id', 'date_test', 'application_remise',
-                     'prix_public', 'prix_remise', 'pct_remise_calcule', 'naming_constate',
-                     'cumul_codes', 'commentaire']
-        writer = csv.DictWriter(output, fieldnames=fieldnames)
-        writer.writeheader()
-        for test in tests:
-            # Convert datetime to string
-            if 'date_test' in test and not isinstance(test['date_test'], str):
-                test['date_test'] = test['date_test'].isoformat() if hasattr(test['date_test'], 'isoformat') else str(test['date_test'])
-            # Remove created_at from export
-            test.pop('created_at', None)
-            writer.writerow({k: test.get(k, '') for k in fieldnames})
-    
-    output.seek(0)
-    return StreamingResponse(
-        iter([output.getvalue()]),
-        media_type="text/csv",
-        headers={"Content-Disposition": "attachment; filename=tests_site.csv"}
-    )
+    fieldnames = ['id', 'programme_id', 'partenaire_id', 'date_test', 'application_remise',
+                 'prix_public', 'prix_remise', 'pct_remise_calcule', 'naming_constate',
+                 'cumul_codes', 'commentaire']
+    return stream_collection_csv("tests_site", query, fieldnames, "tests_site.csv")
 
 @api_router.get("/export/tests-ligne")
 async def export_tests_ligne_csv(
@@ -3587,30 +5691,10 @@ async def export_tests_ligne_csv(
     if partenaire_id:
         query['partenaire_id'] = partenaire_id
     
-    tests = await db.tests_ligne.find(query, {"_id": 0}).to_list(10000)
-    
-    # Create CSV
-    output = io.StringIO()
-    if tests:
-        fieldnames = ['id', 'programme_id', 'partenaire_id', 'date_test', 'numero_telephone',
-                     'messagerie_vocale_dediee', 'decroche_dedie', 'delai_attente', 'nom_conseiller',
-                     'evaluation_accueil', 'application_offre', 'commentaire']
-        writer = csv.DictWriter(output, fieldnames=fieldnames)
-        writer.writeheader()
-        for test in tests:
-            # Convert datetime to string
-            if 'date_test' in test and not isinstance(test['date_test'], str):
-                test['date_test'] = test['date_test'].isoformat() if hasattr(test['date_test'], 'isoformat') else str(test['date_test'])
-            # Remove created_at from export
-            test.pop('created_at', None)
-            writer.writerow({k: test.get(k, '') for k in fieldnames})
-    
-    output.seek(0)
-    return StreamingResponse(
-        iter([output.getvalue()]),
-        media_type="text/csv",
-        headers={"Content-Disposition": "attachment; filename=tests_ligne.csv"}
-    )
+    fieldnames = ['id', 'programme_id', 'partenaire_id', 'date_test', 'numero_telephone',
+                 'messagerie_vocale_dediee', 'decroche_dedie', 'delai_attente', 'nom_conseiller',
+                 'evaluation_accueil', 'application_offre', 'commentaire']
+    return stream_collection_csv("tests_ligne", query, fieldnames, "tests_ligne.csv")
 
 # Routes - Email Templates
 @api_router.get("/email-templates", response_model=List[EmailTemplate])
@@ -3631,6 +5715,7 @@ async def create_email_template(input: EmailTemplateCreate):
     doc = template.model_dump()
     doc['created_at'] = doc['created_at'].isoformat()
     await db.email_templates.insert_one(doc)
+    invalidate_default_template()
     return template
 
 @api_router.put("/email-templates/{template_id}", response_model=EmailTemplate)
@@ -3651,6 +5736,7 @@ async def update_email_template(template_id: str, input: EmailTemplateCreate):
         {"id": template_id},
         {"$set": update_data}
     )
+    invalidate_default_template()
     
     updated = await db.email_templates.find_one({"id": template_id})
     return EmailTemplate(**updated)
@@ -3658,6 +5744,7 @@ async def update_email_template(template_id: str, input: EmailTemplateCreate):
 @api_router.delete("/email-templates/{template_id}")
 async def delete_email_template(template_id: str):
     result = await db.email_templates.delete_one({"id": template_id})
+    invalidate_default_template()
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Template not found")
     return {"message": "Template deleted"}
@@ -3675,6 +5762,7 @@ async def set_default_template(template_id: str):
         {"id": template_id},
         {"$set": {"is_default": True}}
     )
+    invalidate_default_template()
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Template not found")
@@ -3738,7 +5826,10 @@ async def create_email_draft(input: EmailDraftCreate):
     draft = EmailDraft(**input.model_dump())
     doc = draft.model_dump()
     doc['created_at'] = doc['created_at'].isoformat()
-    await db.email_drafts.insert_one(doc)
+    try:
+        await db.email_drafts.insert_one(doc)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail="Un brouillon existe déjà pour cette alerte")
     return draft
 
 @api_router.put("/email-drafts/{draft_id}", response_model=EmailDraft)
@@ -3775,6 +5866,8 @@ async def send_email_draft(draft_id: str, request: SendEmailRequest):
     
     if draft['status'] == 'sent':
         raise HTTPException(status_code=400, detail="Draft already sent")
+    if draft['status'] == 'queued' or await db.email_outbox.find_one({"active_draft_id": draft_id}, {"_id": 1}):
+        raise HTTPException(status_code=400, detail="Draft already queued")
     
     # Get signature if provided
     signature_text = ""
@@ -3817,7 +5910,7 @@ async def send_email_draft(draft_id: str, request: SendEmailRequest):
         # Update alerte status to indicate contact was made
         await db.alertes.update_one(
             {"id": draft['alerte_id']},
-            {"$set": {"statut": "resolu"}}
+            {"$set": {"statut": "resolu", "updated_at": datetime.now(timezone.utc)}}
         )
         
         return {"message": "Email sent successfully", "status": "success"}
@@ -3838,6 +5931,55 @@ async def send_email_draft(draft_id: str, request: SendEmailRequest):
         
         raise HTTPException(status_code=500, detail=result['message'])
 
+class BulkSendEmailRequest(BaseModel):
+    draft_ids: Optional[List[str]] = None
+    mois: Optional[str] = None  # YYYY-MM : brouillons des alertes créées ce mois-ci
+    signature_id: Optional[str] = None
+
+@api_router.post("/email-drafts/send-bulk")
+async def send_email_drafts_bulk(request: BulkSendEmailRequest, current_user: User = Depends(get_current_active_user)):
+    """Met en file d'envoi un ou plusieurs brouillons ; l'envoi est assuré par le worker email_outbox"""
+    if not request.draft_ids and not request.mois:
+        raise HTTPException(status_code=400, detail="Indiquer draft_ids ou mois")
+    
+    draft_filter = {}
+    if request.draft_ids:
+        draft_filter["id"] = {"$in": request.draft_ids}
+    if request.mois:
+        try:
+            debut = datetime.strptime(request.mois, "%Y-%m").replace(tzinfo=timezone.utc)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Format de mois invalide (YYYY-MM attendu)")
+        fin = (debut + timedelta(days=32)).replace(day=1)
+        alerte_query = add_date_range({}, "alertes", "created_at", gte=debut, lt=fin)
+        alertes = await db.alertes.find(alerte_query, {"_id": 0, "id": 1}).to_list(length=None)
+        draft_filter["alerte_id"] = {"$in": [a["id"] for a in alertes]}
+    
+    signature_text = ""
+    if request.signature_id:
+        signature = await db.signatures.find_one({"id": request.signature_id})
+        if signature:
+            signature_text = signature['signature_text']
+    
+    result = await enqueue_email_drafts(draft_filter, signature_text)
+    if not smtp_mailer.configured:
+        result["warning"] = "SMTP non configuré : les messages restent en file"
+    return result
+
+@api_router.get("/email-outbox/{batch_id}")
+async def get_email_outbox_batch(batch_id: str):
+    """Avancement d'un lot mis en file"""
+    messages = await db.email_outbox.find(
+        {"batch_id": batch_id},
+        {"_id": 0, "body": 0, "signature_text": 0, "claim_id": 0}
+    ).to_list(length=None)
+    if not messages:
+        raise HTTPException(status_code=404, detail="Lot introuvable")
+    statuts = {}
+    for message in messages:
+        statuts[message["status"]] = statuts.get(message["status"], 0) + 1
+    return {"batch_id": batch_id, "total": len(messages), "status": statuts, "messages": messages}
+
 # Routes - Email History
 @api_router.get("/email-history", response_model=List[EmailHistory])
 async def get_email_history(alerte_id: Optional[str] = None):
@@ -3854,17 +5996,23 @@ async def get_email_history(alerte_id: Optional[str] = None):
 @api_router.post("/auth/login", response_model=Token)
 async def login(login_request: LoginRequest, request: Request):
     """Authenticate user and return JWT token"""
+    login_start = perf_counter()
     # Case-insensitive email search
-    user = await db.users.find_one({"email": {"$regex": f"^{login_request.email}$", "$options": "i"}})
+    user = await find_user_by_email(login_request.email)
     if not user:
         raise HTTPException(status_code=401, detail="Email ou mot de passe incorrect")
     
-    if not verify_password(login_request.password, user['password_hash']):
+    valid, new_hash = await verify_password_async(login_request.password, user['password_hash'])
+    if not valid:
         raise HTTPException(status_code=401, detail="Email ou mot de passe incorrect")
     
     if not user.get('is_active', True):
         raise HTTPException(status_code=400, detail="Compte utilisateur désactivé")
     
+    if new_hash:
+        # Coût bcrypt modifié : rehash transparent avec le mot de passe en clair du login
+        await db.users.update_one({"id": user['id']}, {"$set": {"password_hash": new_hash}})
+    
     # Enregistrer le log de connexion
     try:
         connection_log = {
@@ -3874,7 +6022,7 @@ async def login(login_request: LoginRequest, request: Request):
             "user_nom": user.get('nom', ''),
             "user_prenom": user.get('prenom', ''),
             "user_role": user.get('role', 'agent'),
-            "login_time": datetime.now(timezone.utc).isoformat(),
+            "login_time": datetime.now(timezone.utc),
             "ip_address": request.client.host if request.client else None,
             "user_agent": request.headers.get('user-agent', '')[:200]
         }
@@ -3887,6 +6035,7 @@ async def login(login_request: LoginRequest, request: Request):
     access_token = create_access_token(
         data={"sub": user['email']}, expires_delta=access_token_expires
     )
+    auth_latency["login"].observe(perf_counter() - login_start)
     return {"access_token": access_token, "token_type": "bearer"}
 
 @api_router.post("/auth/register", response_model=User)
@@ -3900,7 +6049,7 @@ async def register(user_create: UserCreate, current_user: User = Depends(get_cur
         raise HTTPException(status_code=403, detail="Seul un super administrateur peut créer un autre super administrateur")
     
     # Check if user already exists
-    existing_user = await db.users.find_one({"email": user_create.email})
+    existing_user = await find_user_by_email(user_create.email)
     if existing_user:
         raise HTTPException(status_code=400, detail="Cet email est déjà utilisé")
     
@@ -3917,10 +6066,15 @@ async def register(user_create: UserCreate, current_user: User = Depends(get_cur
     )
     
     user_dict = user.model_dump()
-    user_dict['password_hash'] = get_password_hash(user_create.password)
+    user_dict['email_lower'] = normalize_email(user.email)
+    user_dict['password_hash'] = await hash_password_async(user_create.password)
     user_dict['created_at'] = user_dict['created_at'].isoformat()
     
-    await db.users.insert_one(user_dict)
+    try:
+        await db.users.insert_one(user_dict)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Cet email est déjà utilisé")
+    users_cache.invalidate()
     return user
 
 @api_router.post("/auth/init-admin")
@@ -3939,10 +6093,12 @@ async def init_admin():
     )
     
     admin_dict = admin.model_dump()
-    admin_dict['password_hash'] = get_password_hash("admin123")
+    admin_dict['email_lower'] = normalize_email(admin.email)
+    admin_dict['password_hash'] = await hash_password_async("admin123")
     admin_dict['created_at'] = admin_dict['created_at'].isoformat()
     
     await db.users.insert_one(admin_dict)
+    users_cache.invalidate()
     return {"message": "Administrateur créé avec succès", "email": "admin@hubblindtests.com", "password": "admin123"}
 
 # =====================
@@ -3995,7 +6151,7 @@ async def create_identifiant_mystere(
         raise HTTPException(status_code=403, detail="Seuls les administrateurs peuvent créer des identifiants")
     
     # Vérifier que le programme existe
-    programme = await db.programmes.find_one({"id": identifiant.programme_id})
+    programme = await programmes_cache.get(identifiant.programme_id)
     if not programme:
         raise HTTPException(status_code=404, detail="Programme non trouvé")
     
@@ -4024,7 +6180,7 @@ async def update_identifiant_mystere(
     update_data = {k: v for k, v in identifiant_update.model_dump().items() if v is not None}
     
     if "programme_id" in update_data:
-        programme = await db.programmes.find_one({"id": update_data["programme_id"]})
+        programme = await programmes_cache.get(update_data["programme_id"])
         if not programme:
             raise HTTPException(status_code=404, detail="Programme non trouvé")
     
@@ -4060,16 +6216,29 @@ async def delete_identifiant_mystere(
 async def get_connection_logs(
     current_user: User = Depends(get_current_active_user),
     limit: int = Query(100, ge=1, le=500),
-    skip: int = Query(0, ge=0)
+    skip: int = Query(0, ge=0),
+    keyset: bool = Query(False, description="Pagination par curseur (retourne next_cursor, remplace skip)"),
+    cursor: Optional[str] = Query(None, description="Curseur opaque retourné par la page précédente"),
+    include_total: bool = Query(True, description="Inclure le total (estimation mise en cache en mode curseur)")
 ):
     """Get connection logs (Super Admin ou utilisateurs autorisés)"""
     # Vérifier si l'utilisateur a le droit d'accéder aux logs
-    user_data = await db.users.find_one({"email": current_user.email.lower()}, {"_id": 0})
+    user_data = await find_user_by_email(current_user.email)
     can_view = user_data.get('can_view_logs', False) if user_data else False
     
     if current_user.role != UserRole.super_admin and not can_view:
         raise HTTPException(status_code=403, detail="Accès non autorisé aux logs de connexion")
     
+    if keyset or cursor:
+        # Pagination par curseur : pas de skip, total mis en cache
+        logs, next_cursor = await fetch_page_curseur(db.connection_logs, {}, "login_time", cursor, limit)
+        return {
+            "logs": logs,
+            "total": await count_estime(db.connection_logs, {}) if include_total else None,
+            "limit": limit,
+            "next_cursor": next_cursor
+        }
+    
     logs = await db.connection_logs.find({}, {"_id": 0}).sort("login_time", -1).skip(skip).limit(limit).to_list(length=limit)
     total = await db.connection_logs.count_documents({})
     
@@ -4091,7 +6260,7 @@ async def clear_connection_logs(
     
     query = {}
     if before_date:
-        query["login_time"] = {"$lt": before_date}
+        add_date_range(query, "connection_logs", "login_time", lt=before_date)
     
     result = await db.connection_logs.delete_many(query)
     return {"message": f"{result.deleted_count} log(s) supprimé(s)"}
@@ -4129,7 +6298,7 @@ async def logout(
             await db.connection_logs.update_one(
                 {"id": last_log['id']},
                 {"$set": {
-                    "logout_time": now.isoformat(),
+                    "logout_time": now,
                     "session_duration": duration_str
                 }}
             )
@@ -4320,7 +6489,7 @@ async def create_user(user_create: UserCreate, current_user: User = Depends(get_
         raise HTTPException(status_code=403, detail="Seuls les administrateurs peuvent créer des utilisateurs")
     
     # Check if user already exists
-    existing_user = await db.users.find_one({"email": user_create.email})
+    existing_user = await find_user_by_email(user_create.email)
     if existing_user:
         raise HTTPException(status_code=400, detail="Cet email est déjà utilisé")
     
@@ -4337,10 +6506,15 @@ async def create_user(user_create: UserCreate, current_user: User = Depends(get_
     )
     
     user_dict = user.model_dump()
-    user_dict['password_hash'] = get_password_hash(user_create.password)
+    user_dict['email_lower'] = normalize_email(user.email)
+    user_dict['password_hash'] = await hash_password_async(user_create.password)
     user_dict['created_at'] = user_dict['created_at'].isoformat()
     
-    await db.users.insert_one(user_dict)
+    try:
+        await db.users.insert_one(user_dict)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Cet email est déjà utilisé")
+    users_cache.invalidate()
     return user
 
 @api_router.put("/users/{user_id}", response_model=User)
@@ -4363,10 +6537,12 @@ async def update_user(user_id: str, user_update: UserUpdate, current_user: User
     if user_update.is_active is not None:
         update_data['is_active'] = user_update.is_active
     if user_update.password is not None:
-        update_data['password_hash'] = get_password_hash(user_update.password)
+        update_data['password_hash'] = await hash_password_async(user_update.password)
     
     if update_data:
         await db.users.update_one({"id": user_id}, {"$set": update_data})
+        users_cache.invalidate()
+        auth_user_cache.invalidate(user_id)
     
     updated_user = await db.users.find_one({"id": user_id})
     return User(**updated_user)
@@ -4383,6 +6559,8 @@ async def delete_user(user_id: str, current_user: User = Depends(get_current_act
     result = await db.users.delete_one({"id": user_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Utilisateur non trouvé")
+    users_cache.invalidate()
+    auth_user_cache.invalidate(user_id)
     
     return {"message": "Utilisateur supprimé avec succès"}
 
@@ -4510,13 +6688,14 @@ async def debug_bilan_partenaire_analysis(
         
         # PHASE 1 - DATA CONTRACT
         # Get partenaire
-        partenaire = await db.partenaires.find_one({"id": partenaire_id})
+        partenaire = await partenaires_cache.get(partenaire_id)
         if not partenaire:
             return {"error": "Partenaire not found"}
         
         # Get programmes
         programme_ids = partenaire.get('programmes_ids', [])
-        programmes = await db.programmes.find({"id": {"$in": programme_ids}}).to_list(length=None)
+        programmes_map = await programmes_cache.get_map()
+        programmes = [programmes_map[pid] for pid in programme_ids if pid in programmes_map]
         programmes = sorted(programmes, key=lambda p: p['nom'])
         
         if not programmes:
@@ -4543,17 +6722,15 @@ async def debug_bilan_partenaire_analysis(
             period_label = f"Année glissante"
         
         # Get tests
-        tests_site = await db.tests_site.find({
+        tests_site = await db.tests_site.find(add_date_range({
             "programme_id": programme['id'],
-            "partenaire_id": partenaire_id,
-            "date_test": {"$gte": date_debut.isoformat(), "$lt": date_fin.isoformat()}
-        }).sort("date_test", 1).to_list(length=3)
+            "partenaire_id": partenaire_id
+        }, "tests_site", "date_test", gte=date_debut, lt=date_fin)).sort("date_test", 1).to_list(length=3)
         
-        tests_ligne = await db.tests_ligne.find({
+        tests_ligne = await db.tests_ligne.find(add_date_range({
             "programme_id": programme['id'],
-            "partenaire_id": partenaire_id,
-            "date_test": {"$gte": date_debut.isoformat(), "$lt": date_fin.isoformat()}
-        }).sort("date_test", 1).to_list(length=3)
+            "partenaire_id": partenaire_id
+        }, "tests_ligne", "date_test", gte=date_debut, lt=date_fin)).sort("date_test", 1).to_list(length=3)
         
         # SECTION A - SCHEMA
         debug_report["SECTION_A_SCHEMA"] = {
@@ -4715,7 +6892,7 @@ async def debug_bilan_partenaire_analysis(
         site_rows = []
         for test in tests_site:
             try:
-                test_date = datetime.fromisoformat(test['date_test'])
+                test_date = parse_date(test['date_test'])
                 pct_remise = test.get('pct_remise_calcule', 0)
                 site_rows.append([
                     format_french_month(test_date),
@@ -4731,7 +6908,7 @@ async def debug_bilan_partenaire_analysis(
         ligne_rows = []
         for test in tests_ligne:
             try:
-                test_date = datetime.fromisoformat(test['date_test'])
+                test_date = parse_date(test['date_test'])
                 ligne_rows.append([
                     format_french_month(test_date),
                     test_date.strftime('%d/%m/%Y'),
@@ -4806,297 +6983,692 @@ async def debug_bilan_partenaire_analysis(
             "traceback": traceback.format_exc()
         }
 
-# Routes - Bilan Partenaire PPT Export (FROM SCRATCH)
-@api_router.get("/export/bilan-partenaire-ppt")
-async def export_bilan_partenaire_ppt(
-    partenaire_id: str = Query(...),
-    date_debut: str = Query(...),
-    date_fin: str = Query(...)
-):
-    """Generate PowerPoint report from scratch with real data"""
-    try:
-        from pptx.util import Inches, Pt
-        from pptx.enum.text import PP_ALIGN
-        from pptx.dml.color import RGBColor
-        
-        # === GET DATA ===
-        partenaire = await db.partenaires.find_one({"id": partenaire_id})
-        if not partenaire:
-            raise HTTPException(status_code=404, detail="Partenaire not found")
+def render_bilan_partenaire_ppt(partner_name: str, period_label: str, programmes: list) -> bytes:
+    """
+    Rendu python-pptx du bilan partenaire, exécuté dans le pool de rendu.
+    programmes : liste triée de {nom, tests_site, tests_ligne} (tests du plus récent au plus ancien).
+    """
+    from pptx.util import Inches, Pt
+    from pptx.enum.text import PP_ALIGN
+    from pptx.dml.color import RGBColor
+    
+    # === CREATE PRESENTATION FROM SCRATCH ===
+    prs = Presentation()
+    prs.slide_width = Inches(10)
+    prs.slide_height = Inches(7.5)
+    
+    slide_number = 0
+    total_slides = len(programmes) * 3  # 3 slides per programme
+    
+    # === GENERATE SLIDES FOR EACH PROGRAMME ===
+    for programme in programmes:
+        program_name = programme.get('nom', '')
         
-        partner_name = partenaire.get('nom', '')
+        # Tests de CE programme, lus par l'étape async
+        tests_site = programme['tests_site']
+        tests_ligne = programme['tests_ligne']
         
-        # Get programmes
-        programme_ids = partenaire.get('programmes_ids', [])
-        programmes = await db.programmes.find({"id": {"$in": programme_ids}}).to_list(length=None)
-        programmes = sorted(programmes, key=lambda p: p['nom'])
+        # === CALCULATE STATISTICS FOR THIS PROGRAMME ===
+        total_tests_site = len(tests_site)
+        tests_site_reussis = len([t for t in tests_site if t.get('application_remise', False)])
+        pct_site = round((tests_site_reussis / total_tests_site * 100), 1) if total_tests_site > 0 else 0
         
-        if not programmes:
-            raise HTTPException(status_code=404, detail="No programmes found")
+        total_tests_ligne = len(tests_ligne)
+        tests_ligne_reussis = len([t for t in tests_ligne if t.get('application_offre', False)])
+        pct_ligne = round((tests_ligne_reussis / total_tests_ligne * 100), 1) if total_tests_ligne > 0 else 0
         
-        # Parse dates
-        date_debut_obj = datetime.fromisoformat(date_debut).replace(tzinfo=timezone.utc)
-        date_fin_obj = datetime.fromisoformat(date_fin).replace(tzinfo=timezone.utc, hour=23, minute=59, second=59)
+        delais = []
+        for t in tests_ligne:
+            if t.get('delai_attente'):
+                try:
+                    parts = t['delai_attente'].split(':')
+                    if len(parts) == 2:
+                        delais.append(int(parts[0]) * 60 + int(parts[1]))
+                except:
+                    pass
+        avg_delai = sum(delais) / len(delais) if delais else 0
+        avg_delai_str = f"{int(avg_delai // 60):02d}:{int(avg_delai % 60):02d}"
         
-        # Generate period label
-        if date_debut_obj.year == date_fin_obj.year and date_debut_obj.month == date_fin_obj.month:
-            period_label = f"{format_french_month(date_debut_obj)} {date_debut_obj.year}"
-        elif date_debut_obj.year == date_fin_obj.year:
-            period_label = f"{format_french_month(date_debut_obj)} - {format_french_month(date_fin_obj)} {date_debut_obj.year}"
+        accueils = [t.get('evaluation_accueil', '') for t in tests_ligne if t.get('evaluation_accueil')]
+        accueil_counts = {}
+        for acc in accueils:
+            accueil_counts[acc] = accueil_counts.get(acc, 0) + 1
+        commentaire_accueil = max(accueil_counts, key=accueil_counts.get) if accueil_counts else "—"
+        
+        # === SLIDE 1: VUE D'ENSEMBLE (FOR THIS PROGRAMME) ===
+        slide_number += 1
+        slide_layout = prs.slide_layouts[6]
+        slide1 = prs.slides.add_slide(slide_layout)
+    
+        # Title
+        title_box = slide1.shapes.add_textbox(Inches(0.5), Inches(0.5), Inches(9), Inches(1))
+        title_frame = title_box.text_frame
+        title_frame.text = f"Blind test – {partner_name} x {program_name}"
+        title_para = title_frame.paragraphs[0]
+        title_para.font.size = Pt(32)
+        title_para.font.bold = True
+        title_para.font.color.rgb = RGBColor(0, 0, 128)
+    
+        # Subtitle - Period
+        subtitle_box = slide1.shapes.add_textbox(Inches(0.5), Inches(1.5), Inches(9), Inches(0.5))
+        subtitle_frame = subtitle_box.text_frame
+        subtitle_frame.text = period_label
+        subtitle_para = subtitle_frame.paragraphs[0]
+        subtitle_para.font.size = Pt(20)
+        subtitle_para.font.color.rgb = RGBColor(100, 100, 100)
+    
+        # Statistics boxes
+        y_pos = 2.5
+    
+        # Tests Sites
+        box1 = slide1.shapes.add_textbox(Inches(1), Inches(y_pos), Inches(3.5), Inches(1.5))
+        tf1 = box1.text_frame
+        tf1.text = f"Tests Sites\n\n{pct_site}% de réussite\n({tests_site_reussis}/{total_tests_site} tests)"
+        for para in tf1.paragraphs:
+            para.font.size = Pt(16)
+            para.alignment = PP_ALIGN.CENTER
+    
+        # Tests Lignes
+        box2 = slide1.shapes.add_textbox(Inches(5.5), Inches(y_pos), Inches(3.5), Inches(1.5))
+        tf2 = box2.text_frame
+        tf2.text = f"Tests Ligne\n\n{pct_ligne}% de réussite\n({tests_ligne_reussis}/{total_tests_ligne} tests)"
+        for para in tf2.paragraphs:
+            para.font.size = Pt(16)
+            para.alignment = PP_ALIGN.CENTER
+    
+        # Additional stats
+        box3 = slide1.shapes.add_textbox(Inches(1), Inches(y_pos + 2), Inches(3.5), Inches(1.5))
+        tf3 = box3.text_frame
+        tf3.text = f"Temps d'attente moyen\n\n{avg_delai_str}"
+        for para in tf3.paragraphs:
+            para.font.size = Pt(16)
+            para.alignment = PP_ALIGN.CENTER
+    
+        box4 = slide1.shapes.add_textbox(Inches(5.5), Inches(y_pos + 2), Inches(3.5), Inches(1.5))
+        tf4 = box4.text_frame
+        tf4.text = f"Accueil\n\n{commentaire_accueil}"
+        for para in tf4.paragraphs:
+            para.font.size = Pt(16)
+            para.alignment = PP_ALIGN.CENTER
+        
+        # Footer slide 1
+        footer = slide1.shapes.add_textbox(Inches(0.5), Inches(7), Inches(9), Inches(0.3))
+        footer.text_frame.text = f"Bilan du {datetime.now(timezone.utc).strftime('%d/%m/%Y')} - Page {slide_number}/{total_slides}"
+        footer.text_frame.paragraphs[0].font.size = Pt(10)
+        footer.text_frame.paragraphs[0].font.color.rgb = RGBColor(128, 128, 128)
+        
+        # === SLIDE 2: TESTS SITES (FOR THIS PROGRAMME) ===
+        slide_number += 1
+        slide2 = prs.slides.add_slide(slide_layout)
+        
+        # Title
+        title2 = slide2.shapes.add_textbox(Inches(0.5), Inches(0.5), Inches(9), Inches(0.7))
+        title2.text_frame.text = f"Tests Sites – {partner_name} x {program_name}"
+        title2.text_frame.paragraphs[0].font.size = Pt(24)
+        title2.text_frame.paragraphs[0].font.bold = True
+        
+        # Table
+        if tests_site:
+            rows = min(len(tests_site) + 1, 15)  # Max 14 tests + header
+            cols = 7
+            table = slide2.shapes.add_table(rows, cols, Inches(0.5), Inches(1.5), Inches(9), Inches(5)).table
+        
+            # Header
+            headers = ['Date', 'URL', 'Prix Public', 'Prix Remisé', 'Remise', 'OK?', 'Naming']
+            for i, header in enumerate(headers):
+                cell = table.cell(0, i)
+                cell.text = header
+                cell.text_frame.paragraphs[0].font.bold = True
+                cell.text_frame.paragraphs[0].font.size = Pt(11)
+                cell.fill.solid()
+                cell.fill.fore_color.rgb = RGBColor(200, 200, 200)
+        
+            # Data rows
+            for idx, test in enumerate(tests_site[:14]):
+                if idx + 1 >= rows:
+                    break
+                try:
+                    test_date = parse_date(test['date_test'])
+                    table.cell(idx + 1, 0).text = test_date.strftime('%d/%m/%Y')
+                    table.cell(idx + 1, 1).text = test.get('url', 'N/A')[:30]
+                    table.cell(idx + 1, 2).text = f"{test.get('prix_public', 0):.2f} €"
+                    table.cell(idx + 1, 3).text = f"{test.get('prix_remise', 0):.2f} €"
+                    table.cell(idx + 1, 4).text = f"{test.get('pct_remise_calcule', 0):.1f}%"
+                    table.cell(idx + 1, 5).text = '✓' if test.get('application_remise') else '✗'
+                    table.cell(idx + 1, 6).text = test.get('naming_constate', '')[:20]
+                
+                    # Font size
+                    for col in range(cols):
+                        table.cell(idx + 1, col).text_frame.paragraphs[0].font.size = Pt(9)
+                except Exception as e:
+                    logging.error(f"Error adding test site row: {str(e)}")
         else:
-            period_label = f"{format_french_month(date_debut_obj)} {date_debut_obj.year} - {format_french_month(date_fin_obj)} {date_fin_obj.year}"
-        
-        # === CREATE PRESENTATION FROM SCRATCH ===
-        prs = Presentation()
-        prs.slide_width = Inches(10)
-        prs.slide_height = Inches(7.5)
-        
-        slide_number = 0
-        total_slides = len(programmes) * 3  # 3 slides per programme
-        
-        # === GENERATE SLIDES FOR EACH PROGRAMME ===
-        for programme in programmes:
-            program_name = programme.get('nom', '')
-            
-            # Get tests data for THIS programme
-            tests_site = await db.tests_site.find({
-                "programme_id": programme['id'],
-                "partenaire_id": partenaire_id,
-                "date_test": {"$gte": date_debut_obj.isoformat(), "$lt": date_fin_obj.isoformat()}
-            }).sort("date_test", -1).to_list(length=None)
-            
-            tests_ligne = await db.tests_ligne.find({
-                "programme_id": programme['id'],
-                "partenaire_id": partenaire_id,
-                "date_test": {"$gte": date_debut_obj.isoformat(), "$lt": date_fin_obj.isoformat()}
-            }).sort("date_test", -1).to_list(length=None)
-            
-            # === CALCULATE STATISTICS FOR THIS PROGRAMME ===
-            total_tests_site = len(tests_site)
-            tests_site_reussis = len([t for t in tests_site if t.get('application_remise', False)])
-            pct_site = round((tests_site_reussis / total_tests_site * 100), 1) if total_tests_site > 0 else 0
-            
-            total_tests_ligne = len(tests_ligne)
-            tests_ligne_reussis = len([t for t in tests_ligne if t.get('application_offre', False)])
-            pct_ligne = round((tests_ligne_reussis / total_tests_ligne * 100), 1) if total_tests_ligne > 0 else 0
-            
-            delais = []
-            for t in tests_ligne:
-                if t.get('delai_attente'):
-                    try:
-                        parts = t['delai_attente'].split(':')
-                        if len(parts) == 2:
-                            delais.append(int(parts[0]) * 60 + int(parts[1]))
-                    except:
-                        pass
-            avg_delai = sum(delais) / len(delais) if delais else 0
-            avg_delai_str = f"{int(avg_delai // 60):02d}:{int(avg_delai % 60):02d}"
-            
-            accueils = [t.get('evaluation_accueil', '') for t in tests_ligne if t.get('evaluation_accueil')]
-            accueil_counts = {}
-            for acc in accueils:
-                accueil_counts[acc] = accueil_counts.get(acc, 0) + 1
-            commentaire_accueil = max(accueil_counts, key=accueil_counts.get) if accueil_counts else "—"
+            no_data = slide2.shapes.add_textbox(Inches(2), Inches(3), Inches(6), Inches(1))
+            no_data.text_frame.text = "Aucun test site disponible pour cette période"
+            no_data.text_frame.paragraphs[0].font.size = Pt(18)
+            no_data.text_frame.paragraphs[0].alignment = PP_ALIGN.CENTER
+        
+        # Footer slide 2
+        footer2 = slide2.shapes.add_textbox(Inches(0.5), Inches(7), Inches(9), Inches(0.3))
+        footer2.text_frame.text = f"Bilan du {datetime.now(timezone.utc).strftime('%d/%m/%Y')} - Page {slide_number}/{total_slides}"
+        footer2.text_frame.paragraphs[0].font.size = Pt(10)
+        footer2.text_frame.paragraphs[0].font.color.rgb = RGBColor(128, 128, 128)
+        
+        # === SLIDE 3: TESTS LIGNE (FOR THIS PROGRAMME) ===
+        slide_number += 1
+        slide3 = prs.slides.add_slide(slide_layout)
+        
+        # Title
+        title3 = slide3.shapes.add_textbox(Inches(0.5), Inches(0.5), Inches(9), Inches(0.7))
+        title3.text_frame.text = f"Tests Ligne – {partner_name} x {program_name}"
+        title3.text_frame.paragraphs[0].font.size = Pt(24)
+        title3.text_frame.paragraphs[0].font.bold = True
+        
+        # Table
+        if tests_ligne:
+            rows = min(len(tests_ligne) + 1, 15)
+            cols = 7
+            table = slide3.shapes.add_table(rows, cols, Inches(0.5), Inches(1.5), Inches(9), Inches(5)).table
             
-            # === SLIDE 1: VUE D'ENSEMBLE (FOR THIS PROGRAMME) ===
-            slide_number += 1
-            slide_layout = prs.slide_layouts[6]
-            slide1 = prs.slides.add_slide(slide_layout)
-        
-            # Title
-            title_box = slide1.shapes.add_textbox(Inches(0.5), Inches(0.5), Inches(9), Inches(1))
-            title_frame = title_box.text_frame
-            title_frame.text = f"Blind test – {partner_name} x {program_name}"
-            title_para = title_frame.paragraphs[0]
-            title_para.font.size = Pt(32)
-            title_para.font.bold = True
-            title_para.font.color.rgb = RGBColor(0, 0, 128)
-        
-            # Subtitle - Period
-            subtitle_box = slide1.shapes.add_textbox(Inches(0.5), Inches(1.5), Inches(9), Inches(0.5))
-            subtitle_frame = subtitle_box.text_frame
-            subtitle_frame.text = period_label
-            subtitle_para = subtitle_frame.paragraphs[0]
-            subtitle_para.font.size = Pt(20)
-            subtitle_para.font.color.rgb = RGBColor(100, 100, 100)
-        
-            # Statistics boxes
-            y_pos = 2.5
-        
-            # Tests Sites
-            box1 = slide1.shapes.add_textbox(Inches(1), Inches(y_pos), Inches(3.5), Inches(1.5))
-            tf1 = box1.text_frame
-            tf1.text = f"Tests Sites\n\n{pct_site}% de réussite\n({tests_site_reussis}/{total_tests_site} tests)"
-            for para in tf1.paragraphs:
-                para.font.size = Pt(16)
-                para.alignment = PP_ALIGN.CENTER
-        
-            # Tests Lignes
-            box2 = slide1.shapes.add_textbox(Inches(5.5), Inches(y_pos), Inches(3.5), Inches(1.5))
-            tf2 = box2.text_frame
-            tf2.text = f"Tests Ligne\n\n{pct_ligne}% de réussite\n({tests_ligne_reussis}/{total_tests_ligne} tests)"
-            for para in tf2.paragraphs:
-                para.font.size = Pt(16)
-                para.alignment = PP_ALIGN.CENTER
-        
-            # Additional stats
-            box3 = slide1.shapes.add_textbox(Inches(1), Inches(y_pos + 2), Inches(3.5), Inches(1.5))
-            tf3 = box3.text_frame
-            tf3.text = f"Temps d'attente moyen\n\n{avg_delai_str}"
-            for para in tf3.paragraphs:
-                para.font.size = Pt(16)
-                para.alignment = PP_ALIGN.CENTER
-        
-            box4 = slide1.shapes.add_textbox(Inches(5.5), Inches(y_pos + 2), Inches(3.5), Inches(1.5))
-            tf4 = box4.text_frame
-            tf4.text = f"Accueil\n\n{commentaire_accueil}"
-            for para in tf4.paragraphs:
-                para.font.size = Pt(16)
-                para.alignment = PP_ALIGN.CENTER
+            # Header
+            headers = ['Date', 'Téléphone', 'Délai', 'Msg. Vocale', 'Décroche', 'Accueil', 'OK?']
+            for i, header in enumerate(headers):
+                cell = table.cell(0, i)
+                cell.text = header
+                cell.text_frame.paragraphs[0].font.bold = True
+                cell.text_frame.paragraphs[0].font.size = Pt(11)
+                cell.fill.solid()
+                cell.fill.fore_color.rgb = RGBColor(200, 200, 200)
             
-            # Footer slide 1
-            footer = slide1.shapes.add_textbox(Inches(0.5), Inches(7), Inches(9), Inches(0.3))
-            footer.text_frame.text = f"Bilan du {datetime.now(timezone.utc).strftime('%d/%m/%Y')} - Page {slide_number}/{total_slides}"
-            footer.text_frame.paragraphs[0].font.size = Pt(10)
-            footer.text_frame.paragraphs[0].font.color.rgb = RGBColor(128, 128, 128)
-            
-            # === SLIDE 2: TESTS SITES (FOR THIS PROGRAMME) ===
-            slide_number += 1
-            slide2 = prs.slides.add_slide(slide_layout)
-            
-            # Title
-            title2 = slide2.shapes.add_textbox(Inches(0.5), Inches(0.5), Inches(9), Inches(0.7))
-            title2.text_frame.text = f"Tests Sites – {partner_name} x {program_name}"
-            title2.text_frame.paragraphs[0].font.size = Pt(24)
-            title2.text_frame.paragraphs[0].font.bold = True
-            
-            # Table
-            if tests_site:
-                rows = min(len(tests_site) + 1, 15)  # Max 14 tests + header
-                cols = 7
-                table = slide2.shapes.add_table(rows, cols, Inches(0.5), Inches(1.5), Inches(9), Inches(5)).table
-            
-                # Header
-                headers = ['Date', 'URL', 'Prix Public', 'Prix Remisé', 'Remise', 'OK?', 'Naming']
-                for i, header in enumerate(headers):
-                    cell = table.cell(0, i)
-                    cell.text = header
-                    cell.text_frame.paragraphs[0].font.bold = True
-                    cell.text_frame.paragraphs[0].font.size = Pt(11)
-                    cell.fill.solid()
-                    cell.fill.fore_color.rgb = RGBColor(200, 200, 200)
-            
-                # Data rows
-                for idx, test in enumerate(tests_site[:14]):
-                    if idx + 1 >= rows:
-                        break
-                    try:
-                        test_date = datetime.fromisoformat(test['date_test'])
-                        table.cell(idx + 1, 0).text = test_date.strftime('%d/%m/%Y')
-                        table.cell(idx + 1, 1).text = test.get('url', 'N/A')[:30]
-                        table.cell(idx + 1, 2).text = f"{test.get('prix_public', 0):.2f} €"
-                        table.cell(idx + 1, 3).text = f"{test.get('prix_remise', 0):.2f} €"
-                        table.cell(idx + 1, 4).text = f"{test.get('pct_remise_calcule', 0):.1f}%"
-                        table.cell(idx + 1, 5).text = '✓' if test.get('application_remise') else '✗'
-                        table.cell(idx + 1, 6).text = test.get('naming_constate', '')[:20]
+            # Data rows
+            for idx, test in enumerate(tests_ligne[:14]):
+                if idx + 1 >= rows:
+                    break
+                try:
+                    test_date = parse_date(test['date_test'])
+                    table.cell(idx + 1, 0).text = test_date.strftime('%d/%m/%Y')
+                    table.cell(idx + 1, 1).text = test.get('numero_telephone', 'N/A')[:15]
+                    table.cell(idx + 1, 2).text = test.get('delai_attente', 'N/A')
+                    table.cell(idx + 1, 3).text = '✓' if test.get('messagerie_vocale_dediee') else '✗'
+                    table.cell(idx + 1, 4).text = '✓' if test.get('decroche_dedie') else '✗'
+                    table.cell(idx + 1, 5).text = test.get('evaluation_accueil', 'N/A')[:15]
+                    table.cell(idx + 1, 6).text = '✓' if test.get('application_offre') else '✗'
                     
-                        # Font size
-                        for col in range(cols):
-                            table.cell(idx + 1, col).text_frame.paragraphs[0].font.size = Pt(9)
-                    except Exception as e:
-                        logging.error(f"Error adding test site row: {str(e)}")
-            else:
-                no_data = slide2.shapes.add_textbox(Inches(2), Inches(3), Inches(6), Inches(1))
-                no_data.text_frame.text = "Aucun test site disponible pour cette période"
-                no_data.text_frame.paragraphs[0].font.size = Pt(18)
-                no_data.text_frame.paragraphs[0].alignment = PP_ALIGN.CENTER
-            
-            # Footer slide 2
-            footer2 = slide2.shapes.add_textbox(Inches(0.5), Inches(7), Inches(9), Inches(0.3))
-            footer2.text_frame.text = f"Bilan du {datetime.now(timezone.utc).strftime('%d/%m/%Y')} - Page {slide_number}/{total_slides}"
-            footer2.text_frame.paragraphs[0].font.size = Pt(10)
-            footer2.text_frame.paragraphs[0].font.color.rgb = RGBColor(128, 128, 128)
-            
-            # === SLIDE 3: TESTS LIGNE (FOR THIS PROGRAMME) ===
-            slide_number += 1
-            slide3 = prs.slides.add_slide(slide_layout)
-            
-            # Title
-            title3 = slide3.shapes.add_textbox(Inches(0.5), Inches(0.5), Inches(9), Inches(0.7))
-            title3.text_frame.text = f"Tests Ligne – {partner_name} x {program_name}"
-            title3.text_frame.paragraphs[0].font.size = Pt(24)
-            title3.text_frame.paragraphs[0].font.bold = True
-            
-            # Table
-            if tests_ligne:
-                rows = min(len(tests_ligne) + 1, 15)
-                cols = 7
-                table = slide3.shapes.add_table(rows, cols, Inches(0.5), Inches(1.5), Inches(9), Inches(5)).table
-                
-                # Header
-                headers = ['Date', 'Téléphone', 'Délai', 'Msg. Vocale', 'Décroche', 'Accueil', 'OK?']
-                for i, header in enumerate(headers):
-                    cell = table.cell(0, i)
-                    cell.text = header
-                    cell.text_frame.paragraphs[0].font.bold = True
-                    cell.text_frame.paragraphs[0].font.size = Pt(11)
-                    cell.fill.solid()
-                    cell.fill.fore_color.rgb = RGBColor(200, 200, 200)
-                
-                # Data rows
-                for idx, test in enumerate(tests_ligne[:14]):
-                    if idx + 1 >= rows:
-                        break
-                    try:
-                        test_date = datetime.fromisoformat(test['date_test'])
-                        table.cell(idx + 1, 0).text = test_date.strftime('%d/%m/%Y')
-                        table.cell(idx + 1, 1).text = test.get('numero_telephone', 'N/A')[:15]
-                        table.cell(idx + 1, 2).text = test.get('delai_attente', 'N/A')
-                        table.cell(idx + 1, 3).text = '✓' if test.get('messagerie_vocale_dediee') else '✗'
-                        table.cell(idx + 1, 4).text = '✓' if test.get('decroche_dedie') else '✗'
-                        table.cell(idx + 1, 5).text = test.get('evaluation_accueil', 'N/A')[:15]
-                        table.cell(idx + 1, 6).text = '✓' if test.get('application_offre') else '✗'
-                        
-                        # Font size
-                        for col in range(cols):
-                            table.cell(idx + 1, col).text_frame.paragraphs[0].font.size = Pt(9)
-                    except Exception as e:
-                        logging.error(f"Error adding test ligne row: {str(e)}")
-            else:
-                no_data = slide3.shapes.add_textbox(Inches(2), Inches(3), Inches(6), Inches(1))
-                no_data.text_frame.text = "Aucun test ligne disponible pour cette période"
-                no_data.text_frame.paragraphs[0].font.size = Pt(18)
-                no_data.text_frame.paragraphs[0].alignment = PP_ALIGN.CENTER
-            
-            # Footer slide 3
-            footer3 = slide3.shapes.add_textbox(Inches(0.5), Inches(7), Inches(9), Inches(0.3))
-            footer3.text_frame.text = f"Bilan du {datetime.now(timezone.utc).strftime('%d/%m/%Y')} - Page {slide_number}/{total_slides}"
-            footer3.text_frame.paragraphs[0].font.size = Pt(10)
-            footer3.text_frame.paragraphs[0].font.color.rgb = RGBColor(128, 128, 128)
-        
-        # END OF LOOP - All programmes processed
-        
-        # === SAVE PPT ===
-        output = io.BytesIO()
-        prs.save(output)
-        output.seek(0)
+                    # Font size
+                    for col in range(cols):
+                        table.cell(idx + 1, col).text_frame.paragraphs[0].font.size = Pt(9)
+                except Exception as e:
+                    logging.error(f"Error adding test ligne row: {str(e)}")
+        else:
+            no_data = slide3.shapes.add_textbox(Inches(2), Inches(3), Inches(6), Inches(1))
+            no_data.text_frame.text = "Aucun test ligne disponible pour cette période"
+            no_data.text_frame.paragraphs[0].font.size = Pt(18)
+            no_data.text_frame.paragraphs[0].alignment = PP_ALIGN.CENTER
         
-        filename = f"Bilan_{partner_name}_{period_label}.pptx".replace(' ', '_').replace('/', '_')
+        # Footer slide 3
+        footer3 = slide3.shapes.add_textbox(Inches(0.5), Inches(7), Inches(9), Inches(0.3))
+        footer3.text_frame.text = f"Bilan du {datetime.now(timezone.utc).strftime('%d/%m/%Y')} - Page {slide_number}/{total_slides}"
+        footer3.text_frame.paragraphs[0].font.size = Pt(10)
+        footer3.text_frame.paragraphs[0].font.color.rgb = RGBColor(128, 128, 128)
+    
+    # END OF LOOP - All programmes processed
+    
+    # === SAVE PPT ===
+    output = io.BytesIO()
+    prs.save(output)
+    return output.getvalue()
+
+# Routes - Bilan Partenaire PPT Export (FROM SCRATCH)
+PPT_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.presentationml.presentation"
+
+async def build_bilan_partenaire_ppt(partenaire_id: str, date_debut: str, date_fin: str, progress=None) -> RenderedReport:
+    """Bilan PowerPoint d'un partenaire : 3 slides par programme"""
+    # === GET DATA ===
+    partenaire = await partenaires_cache.get(partenaire_id)
+    if not partenaire:
+        raise HTTPException(status_code=404, detail="Partenaire not found")
+    
+    partner_name = partenaire.get('nom', '')
+    
+    # Get programmes
+    programme_ids = partenaire.get('programmes_ids', [])
+    programmes_map = await programmes_cache.get_map()
+    programmes = [programmes_map[pid] for pid in programme_ids if pid in programmes_map]
+    programmes = sorted(programmes, key=lambda p: p['nom'])
+    
+    if not programmes:
+        raise HTTPException(status_code=404, detail="No programmes found")
+    
+    # Parse dates
+    date_debut_obj = datetime.fromisoformat(date_debut).replace(tzinfo=timezone.utc)
+    date_fin_obj = datetime.fromisoformat(date_fin).replace(tzinfo=timezone.utc, hour=23, minute=59, second=59)
+    
+    # Generate period label
+    if date_debut_obj.year == date_fin_obj.year and date_debut_obj.month == date_fin_obj.month:
+        period_label = f"{format_french_month(date_debut_obj)} {date_debut_obj.year}"
+    elif date_debut_obj.year == date_fin_obj.year:
+        period_label = f"{format_french_month(date_debut_obj)} - {format_french_month(date_fin_obj)} {date_debut_obj.year}"
+    else:
+        period_label = f"{format_french_month(date_debut_obj)} {date_debut_obj.year} - {format_french_month(date_fin_obj)} {date_fin_obj.year}"
+    
+    # === GET TESTS DATA FOR EACH PROGRAMME ===
+    programmes_data = []
+    for index, programme in enumerate(programmes):
+        if progress:
+            await progress(10 + 50 * index // len(programmes), f"Lecture des tests ({programme.get('nom', '')})")
+        tests_site = await db.tests_site.find(add_date_range({
+            "programme_id": programme['id'],
+            "partenaire_id": partenaire_id
+        }, "tests_site", "date_test", gte=date_debut_obj, lt=date_fin_obj), {"_id": 0}).sort("date_test", -1).to_list(length=None)
         
-        logging.info(f"PPT Generated for {len(programmes)} programmes: {total_slides} slides total")
+        tests_ligne = await db.tests_ligne.find(add_date_range({
+            "programme_id": programme['id'],
+            "partenaire_id": partenaire_id
+        }, "tests_ligne", "date_test", gte=date_debut_obj, lt=date_fin_obj), {"_id": 0}).sort("date_test", -1).to_list(length=None)
         
-        return StreamingResponse(
-            output,
-            media_type="application/vnd.openxmlformats-officedocument.presentationml.presentation",
-            headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+        programmes_data.append({
+            "nom": programme.get('nom', ''),
+            "tests_site": tests_site,
+            "tests_ligne": tests_ligne
+        })
+    
+    # === RENDER PPT (pool de rendu) ===
+    if progress:
+        await progress(60, "Génération de la présentation")
+    content = await render_pool.run(render_bilan_partenaire_ppt, partner_name, period_label, programmes_data)
+    
+    filename = f"Bilan_{partner_name}_{period_label}.pptx".replace(' ', '_').replace('/', '_')
+    
+    logging.info(f"PPT Generated for {len(programmes)} programmes: {len(programmes) * 3} slides total")
+    
+    return RenderedReport(filename, PPT_MEDIA_TYPE, content=content)
+
+async def bilan_partenaire_ppt_version(partenaire_id: str, date_debut: str, date_fin: str) -> str:
+    """Version des données d'un bilan PowerPoint : tests du partenaire sur la période, noms affichés, jour du bilan"""
+    date_debut_obj = datetime.fromisoformat(date_debut).replace(tzinfo=timezone.utc)
+    date_fin_obj = datetime.fromisoformat(date_fin).replace(tzinfo=timezone.utc, hour=23, minute=59, second=59)
+    return await data_version(
+        [
+            (collection_name, add_date_range({"partenaire_id": partenaire_id}, collection_name, "date_test", gte=date_debut_obj, lt=date_fin_obj))
+            for collection_name in ("tests_site", "tests_ligne")
+        ],
+        refs=[await partenaires_cache.get(partenaire_id), await programmes_cache.noms(), generation_day()]  # "Bilan du <jour>"
+    )
+
+@api_router.get("/export/bilan-partenaire-ppt")
+async def export_bilan_partenaire_ppt(
+    request: Request,
+    partenaire_id: str = Query(...),
+    date_debut: str = Query(...),
+    date_fin: str = Query(...)
+):
+    """Generate PowerPoint report from scratch with real data"""
+    try:
+        return await serve_cached_report(
+            request,
+            "bilan-partenaire-ppt",
+            {"partenaire_id": partenaire_id, "date_debut": date_debut, "date_fin": date_fin},
+            await bilan_partenaire_ppt_version(partenaire_id, date_debut, date_fin),
+            lambda: build_bilan_partenaire_ppt(partenaire_id, date_debut, date_fin),
+            lambda filename: {"Content-Disposition": f'attachment; filename="{filename}"'}
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Error generating PPT: {str(e)}")
         import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
+# =====================
+# EXPORT JOBS - Exports longs hors de la requête HTTP
+# =====================
+# Un bilan PPT ou Excel sur un programme entier peut dépasser le timeout du proxy.
+# POST /export-jobs enregistre une demande dans export_jobs et rend la main ; des workers
+# de fond réclament les jobs (bail renouvelé par un heartbeat, repris si le worker meurt),
+# appellent le même exporteur que la route synchrone et stockent le fichier dans le
+# bucket GridFS "exports". Le client suit l'avancement puis télécharge le fichier.
+# Les jobs et leurs fichiers sont supprimés après EXPORT_JOBS_TTL_HOURS. La limite par
+# utilisateur repose sur des créneaux (active_slot, index unique) libérés à la fin du job.
+
+EXPORT_JOBS_WORKERS = int(os.getenv('EXPORT_JOBS_WORKERS', '2'))
+EXPORT_JOBS_PER_USER = int(os.getenv('EXPORT_JOBS_PER_USER', '2'))  # jobs en attente ou en cours par utilisateur
+EXPORT_JOBS_TTL = timedelta(hours=float(os.getenv('EXPORT_JOBS_TTL_HOURS', '24')))
+EXPORT_JOBS_MAX_ATTEMPTS = 2
+EXPORT_JOBS_POLL_INTERVAL = 10.0
+EXPORT_JOBS_LEASE = timedelta(minutes=10)
+EXPORT_JOBS_HEARTBEAT = 60.0  # secondes entre deux renouvellements du bail
+EXPORT_JOBS_CLEANUP_INTERVAL = 900.0  # secondes
+
+exports_fs = motor.motor_asyncio.AsyncIOMotorGridFSBucket(db, bucket_name="exports")
+export_jobs_wakeup = asyncio.Event()
+
+class ExportJobType(str, Enum):
+    bilan_partenaire_ppt = "bilan-partenaire-ppt"
+    bilan_site_excel = "bilan-site-excel"
+    bilan_ligne_excel = "bilan-ligne-excel"
+
+class ExportJobRequest(BaseModel):
+    type: ExportJobType
+    partenaire_id: Optional[str] = None
+    programme_id: Optional[str] = None
+    date_debut: str
+    date_fin: str
+
+    @model_validator(mode='after')
+    def check_cible(self):
+        if self.type == ExportJobType.bilan_partenaire_ppt and not self.partenaire_id:
+            raise ValueError("partenaire_id requis pour le bilan PowerPoint")
+        if not self.partenaire_id and not self.programme_id:
+            raise ValueError("partenaire_id ou programme_id requis")
+        return self
+
+async def build_export(job_type: str, params: dict, progress=None) -> RenderedReport:
+    """Exporteur correspondant au type de job (mêmes fonctions que les routes synchrones)"""
+    if job_type == ExportJobType.bilan_partenaire_ppt.value:
+        return await build_bilan_partenaire_ppt(params["partenaire_id"], params["date_debut"], params["date_fin"], progress)
+    type_test = "site" if job_type == ExportJobType.bilan_site_excel.value else "ligne"
+    return await build_bilan_excel(
+        type_test, params.get("partenaire_id"), params.get("programme_id"),
+        params["date_debut"], params["date_fin"], progress
+    )
+
+async def _claim_export_job() -> Optional[dict]:
+    """Réclame le plus ancien job en attente (ou dont le worker a perdu son bail)"""
+    now = datetime.now(timezone.utc)
+    return await db.export_jobs.find_one_and_update(
+        {"attempts": {"$lt": EXPORT_JOBS_MAX_ATTEMPTS}, "$or": [
+            {"status": "pending"},
+            {"status": "running", "locked_until": {"$lt": now}},
+        ]},
+        {
+            "$set": {"status": "running", "claim_id": str(uuid.uuid4()), "locked_by": WORKER_ID,
+                     "locked_until": now + EXPORT_JOBS_LEASE, "started_at": now},
+            "$inc": {"attempts": 1}
+        },
+        sort=[("created_at", ASCENDING)],
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+
+async def run_export_job(job: dict):
+    """Génère le fichier d'un job réclamé et le stocke dans GridFS"""
+    claim = {"id": job["id"], "claim_id": job["claim_id"]}
+    
+    async def progress(pourcentage: int, etape: str):
+        await db.export_jobs.update_one(claim, {"$set": {
+            "progress": pourcentage,
+            "etape": etape,
+            "locked_until": datetime.now(timezone.utc) + EXPORT_JOBS_LEASE
+        }})
+    
+    async def heartbeat():
+        # Bail prolongé pendant l'attente du pool de rendu et le rendu lui-même,
+        # qui n'appellent pas progress() : le job n'est pas repris par un autre worker
+        while True:
+            await asyncio.sleep(EXPORT_JOBS_HEARTBEAT)
+            try:
+                await db.export_jobs.update_one(claim, {"$set": {
+                    "locked_until": datetime.now(timezone.utc) + EXPORT_JOBS_LEASE
+                }})
+            except Exception as e:
+                logger.warning(f"Export job {job['id']} : renouvellement du bail en échec : {e}")
+    
+    heartbeat_task = asyncio.create_task(heartbeat())
+    report = None
+    try:
+        report = await build_export(job["type"], job["params"], progress)
+        await progress(90, "Enregistrement du fichier")
+        with report.open() as source:
+            file_id = await exports_fs.upload_from_stream(
+                report.filename,
+                source,
+                metadata={"job_id": job["id"], "user_id": job["user_id"], "content_type": report.media_type}
+            )
+        size = (await db["exports.files"].find_one({"_id": file_id}, {"length": 1}) or {}).get("length", 0)
+        now = datetime.now(timezone.utc)
+        result = await db.export_jobs.update_one(claim, {"$set": {
+            "status": "done",
+            "progress": 100,
+            "etape": "Terminé",
+            "file_id": file_id,
+            "filename": report.filename,
+            "media_type": report.media_type,
+            "size": size,
+            "finished_at": now,
+            "expires_at": now + EXPORT_JOBS_TTL
+        }, "$unset": {"active_slot": ""}})
+        if result.matched_count == 0:
+            # Job repris ou supprimé entre-temps : le fichier n'est rattaché à rien
+            await exports_fs.delete(file_id)
+    except Exception as e:
+        detail = e.detail if isinstance(e, HTTPException) else str(e)
+        logger.error(f"Export job {job['id']} ({job['type']}) en échec : {detail}")
+        await db.export_jobs.update_one(claim, {"$set": {
+            "status": "failed",
+            "error": detail,
+            "finished_at": datetime.now(timezone.utc)
+        }, "$unset": {"active_slot": ""}})
+    finally:
+        heartbeat_task.cancel()
+        if report:
+            report.cleanup()
+
+async def export_jobs_worker():
+    """Tâche de fond : enchaîne les jobs dus, sinon attend un réveil ou le prochain sondage"""
+    while True:
+        try:
+            job = await _claim_export_job()
+            if job:
+                await run_export_job(job)
+                continue
+        except Exception as e:
+            logger.error(f"Erreur worker export_jobs : {e}")
+        export_jobs_wakeup.clear()
+        try:
+            await asyncio.wait_for(export_jobs_wakeup.wait(), timeout=EXPORT_JOBS_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+async def cleanup_export_jobs() -> int:
+    """Supprime les jobs expirés et leurs fichiers ; clôt les jobs abandonnés après le dernier essai"""
+    now = datetime.now(timezone.utc)
+    await db.export_jobs.update_many(
+        {"status": "running", "locked_until": {"$lt": now}, "attempts": {"$gte": EXPORT_JOBS_MAX_ATTEMPTS}},
+        {"$set": {"status": "failed", "error": "Génération interrompue", "finished_at": now}, "$unset": {"active_slot": ""}}
+    )
+    expires = await db.export_jobs.find({"expires_at": {"$lt": now}}, {"_id": 0, "id": 1, "file_id": 1}).to_list(length=None)
+    for job in expires:
+        if job.get("file_id"):
+            try:
+                await exports_fs.delete(job["file_id"])
+            except gridfs.errors.NoFile:
+                pass
+    if expires:
+        await db.export_jobs.delete_many({"id": {"$in": [job["id"] for job in expires]}})
+    return len(expires)
+
+async def export_jobs_cleanup_worker():
+    """Tâche de fond : purge périodique des exports expirés, par un seul worker à la fois"""
+    while True:
+        try:
+            if await acquire_job_lease("export_jobs_cleanup", timedelta(seconds=EXPORT_JOBS_CLEANUP_INTERVAL)):
+                supprimes = await cleanup_export_jobs()
+                if supprimes:
+                    logger.info(f"Export jobs : {supprimes} job(s) expiré(s) supprimé(s)")
+        except Exception as e:
+            logger.error(f"Erreur purge des export jobs : {e}")
+        await asyncio.sleep(EXPORT_JOBS_CLEANUP_INTERVAL)
+
+async def export_jobs_depth() -> dict:
+    """Nombre de jobs d'export par statut"""
+    pipeline = [{"$group": {"_id": "$status", "count": {"$sum": 1}}}]
+    depth = {"pending": 0, "running": 0, "done": 0, "failed": 0}
+    async for row in db.export_jobs.aggregate(pipeline):
+        depth[row["_id"]] = row["count"]
+    return depth
+
+def _export_job_public(job: dict) -> dict:
+    public = {k: v for k, v in job.items() if k not in ("_id", "claim_id", "locked_by", "locked_until", "file_id", "active_slot")}
+    if job.get("status") == "done":
+        public["download_url"] = f"/api/export-jobs/{job['id']}/download"
+    return public
+
+async def _get_export_job(job_id: str, current_user: User) -> dict:
+    job = await db.export_jobs.find_one({"id": job_id}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Export introuvable ou expiré")
+    if job["user_id"] != current_user.id and current_user.role not in [UserRole.admin, UserRole.super_admin]:
+        raise HTTPException(status_code=403, detail="Accès refusé à cet export")
+    return job
+
+@api_router.post("/export-jobs", status_code=202)
+async def create_export_job(request: ExportJobRequest, current_user: User = Depends(get_current_active_user)):
+    """Planifie un export long ; renvoie l'identifiant du job à suivre"""
+    now = datetime.now(timezone.utc)
+    job = {
+        "id": str(uuid.uuid4()),
+        "user_id": current_user.id,
+        "type": request.type.value,
+        "params": request.model_dump(exclude={"type"}),
+        "status": "pending",
+        "progress": 0,
+        "etape": "En attente",
+        "attempts": 0,
+        "created_at": now,
+        "expires_at": now + EXPORT_JOBS_TTL
+    }
+    # Un créneau libre parmi EXPORT_JOBS_PER_USER : l'index unique sur active_slot rend la
+    # limite atomique, même pour des demandes simultanées
+    for slot in range(EXPORT_JOBS_PER_USER):
+        job["active_slot"] = f"{current_user.id}:{slot}"
+        try:
+            await db.export_jobs.insert_one(job)
+            break
+        except DuplicateKeyError:
+            job.pop("_id", None)
+    else:
+        raise HTTPException(status_code=429, detail=f"{EXPORT_JOBS_PER_USER} export(s) déjà en cours, attendez leur fin avant d'en lancer un autre")
+    export_jobs_wakeup.set()
+    return _export_job_public(job)
+
+@api_router.get("/export-jobs/{job_id}")
+async def get_export_job(job_id: str, current_user: User = Depends(get_current_active_user)):
+    """Statut et avancement d'un export"""
+    return _export_job_public(await _get_export_job(job_id, current_user))
+
+@api_router.get("/export-jobs/{job_id}/download")
+async def download_export_job(job_id: str, current_user: User = Depends(get_current_active_user)):
+    """Télécharge le fichier d'un export terminé, lu par morceaux depuis GridFS"""
+    job = await _get_export_job(job_id, current_user)
+    if job["status"] != "done":
+        raise HTTPException(status_code=409, detail="Export pas encore terminé")
+    try:
+        grid_out = await exports_fs.open_download_stream(job["file_id"])
+    except gridfs.errors.NoFile:
+        raise HTTPException(status_code=404, detail="Fichier d'export introuvable ou expiré")
+    
+    return StreamingResponse(
+        iter_gridfs_chunks(grid_out),
+        media_type=job["media_type"],
+        headers={
+            "Content-Disposition": f"attachment; filename={job['filename']}",
+            "Content-Length": str(job["size"])
+        }
+    )
+
+# =====================
+# MONITORING - Métriques internes
+# =====================
+
+@api_router.get("/monitoring/metrics")
+async def get_monitoring_metrics(current_user: User = Depends(get_current_active_user)):
+    """Métriques de fonctionnement du backend (Admin ou Super Admin)"""
+    if current_user.role not in [UserRole.admin, UserRole.super_admin]:
+        raise HTTPException(status_code=403, detail="Accès réservé aux administrateurs")
+
+    return {
+        "reference_cache": [cache.stats() for cache in REFERENCE_CACHES],
+        "auth_user_cache": auth_user_cache.stats(),
+        "auth_latency": {operation: histogram.stats() for operation, histogram in auth_latency.items()},
+        "smtp": smtp_mailer.stats(),
+        "render_pool": render_pool.stats(),
+        "side_effects_queue": side_effects_queue.stats(),
+        "notification_stream": notification_broker.stats(),
+        "notification_counters": notification_counters_state,
+        "email_outbox": {
+            "depth": await email_outbox_depth(),
+            **email_outbox_stats.stats()
+        },
+        "export_jobs": await export_jobs_depth(),
+        "report_cache": await report_cache_usage(),
+        "date_migration": {
+            "status": date_migration_state["status"],
+            "collections_migrees": sorted(collections_dates_migrees),
+            "collections_incompletes": date_migration_state["incomplete"],
+            "collections": {
+                nom: {k: v for k, v in etat.items() if k != "last_id"}
+                for nom, etat in date_migration_state["collections"].items()
+            }
+        }
+    }
+
+@api_router.get("/monitoring/indexes")
+async def get_monitoring_indexes(current_user: User = Depends(get_current_active_user)):
+    """Écarts au registre d'index et index utilisé par chaque forme de requête critique,
+    d'après explain (Admin ou Super Admin)"""
+    if current_user.role not in [UserRole.admin, UserRole.super_admin]:
+        raise HTTPException(status_code=403, detail="Accès réservé aux administrateurs")
+
+    return {
+        "registry": await index_registry_status(),
+        "query_shapes": await explain_query_shapes()
+    }
+
+@api_router.post("/monitoring/indexes/apply")
+async def apply_monitoring_indexes(current_user: User = Depends(get_current_active_user)):
+    """Créer les index manquants et reconstruire ceux qui diffèrent du registre (Admin ou Super Admin)"""
+    if current_user.role not in [UserRole.admin, UserRole.super_admin]:
+        raise HTTPException(status_code=403, detail="Accès réservé aux administrateurs")
+
+    return {
+        "ensure_indexes": await ensure_indexes(),
+        "registry": await index_registry_status()
+    }
+
+@api_router.get("/monitoring/retention")
+async def get_monitoring_retention(current_user: User = Depends(get_current_active_user)):
+    """Politiques de rétention, tailles des collections et des archives, documents archivés (Admin ou Super Admin)"""
+    if current_user.role not in [UserRole.admin, UserRole.super_admin]:
+        raise HTTPException(status_code=403, detail="Accès réservé aux administrateurs")
+
+    noms = await db.list_collection_names()
+    collections = {}
+    for collection_name, policy in RETENTION_POLICIES.items():
+        archives = sorted(nom for nom in noms if nom.startswith(f"{collection_name}_archive_"))
+        collections[collection_name] = {
+            "retention_jours": policy["jours"],
+            "champ_date": policy["champ"],
+            **await collection_size(collection_name),
+            "archives": [await collection_size(nom) for nom in archives],
+            **retention_state["collections"].get(collection_name, {})
+        }
+    return {
+        "last_run": retention_state["last_run"],
+        "running": retention_state["running"],
+        "collections": collections
+    }
+
+@api_router.post("/monitoring/retention/run")
+async def run_monitoring_retention(current_user: User = Depends(get_current_active_user)):
+    """Lancer immédiatement l'archivage de rétention (Super Admin)"""
+    if current_user.role != UserRole.super_admin:
+        raise HTTPException(status_code=403, detail="Accès réservé au super administrateur")
+    if retention_state["running"] or not await acquire_job_lease("retention", RETENTION_LEASE):
+        raise HTTPException(status_code=409, detail="Archivage déjà en cours sur un autre worker")
+    return {"archived": await run_retention()}
+
 # Duplicate function removed - keeping only the first implementation
 
 # Include the router in the main app
@@ -5115,7 +7687,19 @@ app.add_middleware(
 
 # GZip compression pour réduire la taille des réponses (gain ~60%)
 from fastapi.middleware.gzip import GZipMiddleware
-app.add_middleware(GZipMiddleware, minimum_size=1000)
+
+class GZipSaufFluxMiddleware(GZipMiddleware):
+    """GZip sauf pour les flux SSE : le tampon de compression retiendrait les événements"""
+
+    FLUX_SSE = {"/api/notifications/stream"}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] in self.FLUX_SSE:
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+app.add_middleware(GZipSaufFluxMiddleware, minimum_size=1000)
 
 # Configure logging
 logging.basicConfig(
@@ -5133,6 +7717,8 @@ async def startup_db_client():
             {"$set": {"role": "super_admin"}}
         )
         if result.modified_count > 0:
+            users_cache.invalidate()
+            auth_user_cache.invalidate()
             logger.info("Migration: mkoob@qwertys.fr mis à jour en super_admin")
         else:
             logger.info("Migration: mkoob@qwertys.fr déjà super_admin ou non trouvé")
@@ -5141,4 +7727,12 @@ async def startup_db_client():
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    # Laisser les effets de bord en cours se terminer avant de couper Mongo
+    try:
+        await side_effects_queue.join(timeout=10)
+    except asyncio.TimeoutError:
+        logger.warning("Arrêt : des tâches de fond n'ont pas pu se terminer")
+    side_effects_queue.close()
+    render_pool.close()
+    smtp_mailer.close()
     client.close()
\ No newline at end of file
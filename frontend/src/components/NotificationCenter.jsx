@@ -73,11 +73,60 @@ const NotificationCenter = () => {
     navigate(`/alertes?alerte=${notification.alerte_id}`);
   };
 
-  // Charger au montage et toutes les 30 secondes
+  // Flux temps réel (SSE) : compteur initial puis nouvelles notifications poussées par le serveur
   useEffect(() => {
-    fetchUnreadCount();
-    const interval = setInterval(fetchUnreadCount, 30000);
-    return () => clearInterval(interval);
+    let source = null;
+    let pollInterval = null;
+    let retryTimeout = null;
+
+    // Repli sur le polling ; l'appel API gère aussi un jeton expiré (retour au login)
+    const startPolling = () => {
+      if (pollInterval) return;
+      fetchUnreadCount();
+      pollInterval = setInterval(fetchUnreadCount, 30000);
+    };
+
+    const stopPolling = () => {
+      clearInterval(pollInterval);
+      pollInterval = null;
+    };
+
+    const connect = () => {
+      const token = localStorage.getItem('token');
+      if (!token || typeof EventSource === 'undefined') {
+        // Navigateur sans EventSource : repli sur le polling
+        startPolling();
+        return;
+      }
+
+      source = new EventSource(
+        `${api.defaults.baseURL}/notifications/stream?token=${encodeURIComponent(token)}`
+      );
+      source.addEventListener('unread_count', (event) => {
+        stopPolling();
+        setUnreadCount(JSON.parse(event.data).count);
+      });
+      source.addEventListener('notification', (event) => {
+        const notification = JSON.parse(event.data);
+        setUnreadCount((count) => count + 1);
+        setNotifications((previous) => [notification, ...previous]);
+      });
+      // Jeton expiré ou flux coupé : pas de reconnexion automatique en boucle,
+      // polling puis nouvelle tentative avec le jeton courant
+      source.onerror = () => {
+        source.close();
+        source = null;
+        startPolling();
+        retryTimeout = setTimeout(connect, 60000);
+      };
+    };
+
+    connect();
+    return () => {
+      if (source) source.close();
+      stopPolling();
+      clearTimeout(retryTimeout);
+    };
   }, []);
 
   // Charger les notifications quand on ouvre le panel
@@ -0,0 +1,341 @@
+"""
+Shared in-memory MongoDB / GridFS fakes for the backend unit tests
+- FakeDB: collections created on first access, optional unique fields per collection
+- Filters: equality, $or, $and, $in, $nin, $ne, $exists, $lt, $lte, $gt, $gte
+- Updates: $set, $inc, $unset, $setOnInsert (upsert)
+- Aggregation: $match, $group ($sum, $max), $project
+- FakeGridFSBucket: files collection, chunked downloads in order, NoFile errors
+"""
+
+import copy
+import os
+import sys
+from datetime import datetime, timezone
+
+import gridfs
+import pytest
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+
+import server  # noqa: E402
+
+
+def _valeur(doc, champ):
+    for partie in champ.split("."):
+        if not isinstance(doc, dict) or partie not in doc:
+            return None, False
+        doc = doc[partie]
+    return doc, True
+
+
+def _compare(valeur, operateur, attendu):
+    # Comme Mongo, pas de comparaison entre types différents (date BSON et chaîne ISO)
+    if valeur is None or isinstance(valeur, str) != isinstance(attendu, str):
+        return False
+    if operateur == "$lt":
+        return valeur < attendu
+    if operateur == "$lte":
+        return valeur <= attendu
+    if operateur == "$gt":
+        return valeur > attendu
+    return valeur >= attendu
+
+
+def correspond(doc, filtre):
+    """Vrai si doc satisfait le filtre Mongo (sous-ensemble d'opérateurs utilisé par le serveur)"""
+    for champ, condition in filtre.items():
+        if champ == "$or":
+            if not any(correspond(doc, sous_filtre) for sous_filtre in condition):
+                return False
+            continue
+        if champ == "$and":
+            if not all(correspond(doc, sous_filtre) for sous_filtre in condition):
+                return False
+            continue
+        valeur, present = _valeur(doc, champ)
+        if isinstance(condition, dict) and condition and all(k.startswith("$") for k in condition):
+            for operateur, attendu in condition.items():
+                if operateur == "$in" and valeur not in attendu:
+                    return False
+                if operateur == "$nin" and valeur in attendu:
+                    return False
+                if operateur == "$ne" and valeur == attendu:
+                    return False
+                if operateur == "$exists" and present != bool(attendu):
+                    return False
+                if operateur in ("$lt", "$lte", "$gt", "$gte") and not _compare(valeur, operateur, attendu):
+                    return False
+        elif valeur != condition:
+            return False
+    return True
+
+
+def projeter(doc, projection):
+    """Projection d'inclusion ou d'exclusion, _id inclus sauf {"_id": 0}"""
+    if doc is None or not projection:
+        return doc
+    inclus = [champ for champ, garder in projection.items() if garder and champ != "_id"]
+    if inclus:
+        resultat = {champ: doc[champ] for champ in inclus if champ in doc}
+        if projection.get("_id", 1) and "_id" in doc:
+            resultat["_id"] = doc["_id"]
+        return resultat
+    return {champ: valeur for champ, valeur in doc.items() if projection.get(champ, 1)}
+
+
+def trier(docs, tri):
+    # Tri stable, du critère le moins prioritaire au plus prioritaire
+    for champ, sens in reversed(tri):
+        docs.sort(key=lambda doc: (doc.get(champ) is not None, doc.get(champ)), reverse=sens < 0)
+    return docs
+
+
+class FakeResult:
+    def __init__(self, matched_count=0, deleted_count=0, upserted_id=None):
+        self.matched_count = matched_count
+        self.modified_count = matched_count
+        self.deleted_count = deleted_count
+        self.upserted_id = upserted_id
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, champ, sens=1):
+        trier(self.docs, champ if isinstance(champ, list) else [(champ, sens)])
+        return self
+
+    def batch_size(self, taille):
+        return self
+
+    def limit(self, nombre):
+        if nombre:
+            self.docs = self.docs[:nombre]
+        return self
+
+    async def to_list(self, length=None):
+        return self.docs[:length] if length else self.docs
+
+    def __aiter__(self):
+        self._iter = iter(self.docs)
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._iter)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class FakeCollection:
+    def __init__(self, name, unique=()):
+        self.name = name
+        self.docs = []
+        self.unique = unique
+
+    def _verifier_unique(self, doc, ignore=None):
+        for champ in ("_id", *self.unique):
+            if champ in doc and any(d is not ignore and d.get(champ) == doc[champ] for d in self.docs):
+                raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: {champ}")
+
+    def _appliquer(self, doc, update, insertion=False):
+        modifie = copy.deepcopy(doc)
+        for champ, valeur in update.get("$set", {}).items():
+            modifie[champ] = valeur
+        for champ, valeur in update.get("$inc", {}).items():
+            modifie[champ] = modifie.get(champ, 0) + valeur
+        for champ in update.get("$unset", {}):
+            modifie.pop(champ, None)
+        if insertion:
+            modifie.update(update.get("$setOnInsert", {}))
+        self._verifier_unique(modifie, ignore=doc)
+        doc.clear()
+        doc.update(modifie)
+
+    def _upsert(self, filtre, update):
+        doc = {champ: valeur for champ, valeur in filtre.items() if not champ.startswith("$") and not isinstance(valeur, dict)}
+        doc["_id"] = ObjectId()
+        self._appliquer(doc, update, insertion=True)
+        self.docs.append(doc)
+        return doc
+
+    async def insert_one(self, doc):
+        # Comme pymongo, _id est posé sur le document avant l'envoi
+        doc.setdefault("_id", ObjectId())
+        self._verifier_unique(doc)
+        self.docs.append(copy.deepcopy(doc))
+        return FakeResult()
+
+    async def insert_many(self, docs, ordered=True):
+        for doc in docs:
+            await self.insert_one(doc)
+
+    async def find_one(self, filtre=None, projection=None, sort=None):
+        docs = self.find(filtre).docs
+        if sort:
+            trier(docs, sort)
+        return projeter(docs[0], projection) if docs else None
+
+    def find(self, filtre=None, projection=None):
+        return FakeCursor([projeter(copy.deepcopy(doc), projection) for doc in self.docs if correspond(doc, filtre or {})])
+
+    async def find_one_and_update(self, filtre, update, sort=None, projection=None, upsert=False, return_document=False):
+        candidats = [doc for doc in self.docs if correspond(doc, filtre)]
+        if sort:
+            trier(candidats, sort)
+        if not candidats:
+            if upsert:
+                doc = self._upsert(filtre, update)
+                return projeter(copy.deepcopy(doc), projection) if return_document else None
+            return None
+        avant = copy.deepcopy(candidats[0])
+        self._appliquer(candidats[0], update)
+        return projeter(copy.deepcopy(candidats[0]) if return_document else avant, projection)
+
+    async def update_one(self, filtre, update, upsert=False):
+        for doc in self.docs:
+            if correspond(doc, filtre):
+                self._appliquer(doc, update)
+                return FakeResult(1)
+        if upsert:
+            return FakeResult(0, upserted_id=self._upsert(filtre, update)["_id"])
+        return FakeResult(0)
+
+    async def update_many(self, filtre, update):
+        docs = [doc for doc in self.docs if correspond(doc, filtre)]
+        for doc in docs:
+            self._appliquer(doc, update)
+        return FakeResult(len(docs))
+
+    async def delete_one(self, filtre):
+        for doc in self.docs:
+            if correspond(doc, filtre):
+                self.docs.remove(doc)
+                return FakeResult(deleted_count=1)
+        return FakeResult()
+
+    async def delete_many(self, filtre):
+        restants = [doc for doc in self.docs if not correspond(doc, filtre)]
+        supprimes = len(self.docs) - len(restants)
+        self.docs = restants
+        return FakeResult(deleted_count=supprimes)
+
+    async def count_documents(self, filtre):
+        return len(self.find(filtre).docs)
+
+    async def distinct(self, champ, filtre=None):
+        valeurs = []
+        for doc in self.find(filtre or {}).docs:
+            if champ in doc and doc[champ] not in valeurs:
+                valeurs.append(doc[champ])
+        return valeurs
+
+    def aggregate(self, pipeline):
+        docs = copy.deepcopy(self.docs)
+        for etape in pipeline:
+            if "$match" in etape:
+                docs = [doc for doc in docs if correspond(doc, etape["$match"])]
+            elif "$group" in etape:
+                docs = _grouper(docs, etape["$group"])
+            elif "$project" in etape:
+                docs = [projeter(doc, etape["$project"]) for doc in docs]
+            else:
+                raise NotImplementedError(f"Étape d'agrégation non gérée : {etape}")
+        return FakeCursor(docs)
+
+
+def _expression(doc, expression):
+    if isinstance(expression, str) and expression.startswith("$"):
+        return _valeur(doc, expression[1:])[0]
+    return expression
+
+
+def _grouper(docs, groupe):
+    groupes = {}
+    for doc in docs:
+        cle = _expression(doc, groupe["_id"])
+        resultat = groupes.setdefault(repr(cle), {"_id": cle})
+        for champ, accumulateur in groupe.items():
+            if champ == "_id":
+                continue
+            (operateur, expression), = accumulateur.items()
+            valeur = _expression(doc, expression)
+            if operateur == "$sum":
+                resultat[champ] = resultat.get(champ, 0) + (valeur or 0)
+            elif operateur == "$max":
+                if valeur is not None and (resultat.get(champ) is None or valeur > resultat[champ]):
+                    resultat[champ] = valeur
+                resultat.setdefault(champ, None)
+            else:
+                raise NotImplementedError(f"Accumulateur non géré : {operateur}")
+    return list(groupes.values())
+
+
+class FakeDB:
+    """Base en mémoire ; unique = {collection: (champs uniques...)}"""
+
+    def __init__(self, unique=None):
+        self._unique = unique or {}
+        self.collections = {}
+
+    def __getitem__(self, nom):
+        if nom not in self.collections:
+            self.collections[nom] = FakeCollection(nom, self._unique.get(nom, ()))
+        return self.collections[nom]
+
+    def __getattr__(self, nom):
+        if nom.startswith("_"):
+            raise AttributeError(nom)
+        return self[nom]
+
+
+class FakeGridOut:
+    def __init__(self, content, chunk_size=4):
+        self._chunks = [content[i:i + chunk_size] for i in range(0, len(content), chunk_size)]
+
+    async def readchunk(self):
+        return self._chunks.pop(0) if self._chunks else b""
+
+
+class FakeGridFSBucket:
+    """Bucket GridFS : métadonnées dans la collection <bucket>.files, contenus en mémoire"""
+
+    def __init__(self, files):
+        self.files = files
+        self.contents = {}
+
+    async def upload_from_stream(self, filename, source, metadata=None):
+        file_id = ObjectId()
+        self.contents[file_id] = source.read()
+        await self.files.insert_one({
+            "_id": file_id, "filename": filename, "metadata": metadata,
+            "length": len(self.contents[file_id]), "uploadDate": datetime.now(timezone.utc)
+        })
+        return file_id
+
+    async def open_download_stream(self, file_id):
+        if file_id not in self.contents:
+            raise gridfs.errors.NoFile(file_id)
+        return FakeGridOut(self.contents[file_id])
+
+    async def delete(self, file_id):
+        await self.files.delete_many({"_id": file_id})
+        if self.contents.pop(file_id, None) is None:
+            raise gridfs.errors.NoFile(file_id)
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    """Remplace server.db et les buckets GridFS des exports et du cache de rapports"""
+    fake_db = FakeDB(unique={
+        "export_jobs": ("id", "active_slot"),
+        "report_cache": ("key",),
+    })
+    monkeypatch.setattr(server, "db", fake_db)
+    monkeypatch.setattr(server, "exports_fs", FakeGridFSBucket(fake_db["exports.files"]))
+    monkeypatch.setattr(server, "report_cache_fs", FakeGridFSBucket(fake_db["report_cache.files"]))
+    return fake_db
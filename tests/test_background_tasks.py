@@ -0,0 +1,119 @@
+"""
+Test suite for the in-process side-effects queue (BackgroundTaskQueue)
+- Alerte side effects run after create_alerte_groupee returns
+- Failing tasks are retried, then given up
+- Idempotency keys prevent a side effect from being scheduled twice
+"""
+
+import asyncio
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+
+import server  # noqa: E402
+
+
+@pytest.fixture
+def task_queue(monkeypatch):
+    task_queue = server.BackgroundTaskQueue("test", workers=2, max_attempts=3, backoff=0)
+    monkeypatch.setattr(server, "side_effects_queue", task_queue)
+    yield task_queue
+    task_queue.close()
+
+
+def test_alerte_side_effects_run_after_request_returns(task_queue, fake_db, monkeypatch):
+    release = asyncio.Event()
+    done = []
+
+    async def slow_email_draft(alerte_id):
+        await release.wait()
+        done.append(("email_draft", alerte_id))
+
+    async def slow_notifications(alerte_id, programme_id, partenaire_id, description):
+        await release.wait()
+        done.append(("notifications", alerte_id, programme_id, description))
+
+    monkeypatch.setattr(server, "create_email_draft_for_alerte", slow_email_draft)
+    monkeypatch.setattr(server, "create_notifications_for_chefs_projet", slow_notifications)
+
+    async def scenario():
+        await server.create_alerte_groupee(
+            "test-1", server.TypeTest.TS, ["Remise non appliquée"], "prog-1", "part-1", "user-1"
+        )
+        # L'alerte est enregistrée, les effets de bord ne sont pas encore faits
+        assert len(fake_db.alertes.docs) == 1
+        assert done == []
+        release.set()
+        await task_queue.join(timeout=5)
+
+    asyncio.run(scenario())
+
+    alerte_id = fake_db.alertes.docs[0]["id"]
+    assert ("email_draft", alerte_id) in done
+    assert ("notifications", alerte_id, "prog-1", "1 anomalie détectée: Remise non appliquée") in done
+    assert task_queue.stats()["completed"] == 2
+
+
+def test_failing_task_is_retried():
+    calls = []
+
+    async def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise RuntimeError("Mongo indisponible")
+
+    async def scenario(task_queue):
+        task_queue.enqueue("flaky", flaky)
+        await task_queue.join(timeout=5)
+
+    task_queue = server.BackgroundTaskQueue("test", workers=1, max_attempts=3, backoff=0)
+    asyncio.run(scenario(task_queue))
+
+    assert len(calls) == 3
+    stats = task_queue.stats()
+    assert stats["completed"] == 1
+    assert stats["retried"] == 2
+    assert stats["failed"] == 0
+
+
+def test_task_given_up_after_max_attempts():
+    async def broken():
+        raise RuntimeError("toujours en échec")
+
+    async def scenario(task_queue):
+        task_queue.enqueue("broken", broken)
+        await task_queue.join(timeout=5)
+        # Une clé abandonnée peut être replanifiée
+        assert task_queue.enqueue("broken", broken) is True
+        await task_queue.join(timeout=5)
+
+    task_queue = server.BackgroundTaskQueue("test", workers=1, max_attempts=2, backoff=0)
+    asyncio.run(scenario(task_queue))
+
+    assert task_queue.stats()["failed"] == 2
+    assert task_queue.stats()["completed"] == 0
+
+
+def test_idempotency_key_deduplicates():
+    calls = []
+
+    async def side_effect(value):
+        calls.append(value)
+
+    async def scenario(task_queue):
+        assert task_queue.enqueue("email_draft:a1", side_effect, 1) is True
+        assert task_queue.enqueue("email_draft:a1", side_effect, 1) is False
+        await task_queue.join(timeout=5)
+        # Déjà traitée avec succès : toujours ignorée
+        assert task_queue.enqueue("email_draft:a1", side_effect, 1) is False
+        await task_queue.join(timeout=5)
+
+    task_queue = server.BackgroundTaskQueue("test", workers=2, max_attempts=3, backoff=0)
+    asyncio.run(scenario(task_queue))
+
+    assert calls == [1]
+    assert task_queue.stats()["duplicates"] == 2
@@ -0,0 +1,100 @@
+"""
+Test suite for the grouped bilan Excel workbooks (build_bilan_excel)
+- One sheet per group, in group id order, read from a cursor sorted by group
+- Merged title row, header row, column widths and bilan_* named styles
+- French month labels, independent of the process locale
+"""
+
+import asyncio
+import os
+import sys
+from datetime import datetime, timezone
+
+import pytest
+from openpyxl import load_workbook
+
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+
+import server  # noqa: E402
+
+
+@pytest.fixture
+def bilan_db(fake_db, monkeypatch):
+    monkeypatch.setattr(server, "programmes_cache", server.ReferenceCache("programmes"))
+    monkeypatch.setattr(server, "partenaires_cache", server.ReferenceCache("partenaires"))
+    render_pool = server.RenderPool(workers=1, max_queue=2)
+    monkeypatch.setattr(server, "render_pool", render_pool)
+    fake_db.partenaires.docs = [{"id": "part-1", "nom": "Boulanger"}]
+    # Noms dans l'ordre inverse des identifiants : les feuilles suivent les identifiants
+    fake_db.programmes.docs = [{"id": "prog-a", "nom": "Zeta"}, {"id": "prog-b", "nom": "Alpha"}]
+    yield fake_db
+    render_pool.close()
+
+
+def _test(test_id, programme_id, jour, **champs):
+    return {"id": test_id, "partenaire_id": "part-1", "programme_id": programme_id,
+            "date_test": datetime(2026, 2, jour, 10, tzinfo=timezone.utc), **champs}
+
+
+def _build(type_test):
+    report = asyncio.run(server.build_bilan_excel(type_test, "part-1", None, "2026-02-01", "2026-02-28"))
+    assert report.filename == "export_boulanger_février-2026.xlsx"
+    return report.path
+
+
+def test_site_workbook_sheets_layout_and_styles(bilan_db):
+    bilan_db.tests_site.docs = [
+        _test("t3", "prog-b", 20, commentaire="B", application_remise=True, prix_public=100, prix_remise=80),
+        _test("t2", "prog-a", 12, commentaire="A2"),
+        _test("t1", "prog-a", 5, commentaire="A1", cumul_codes=True),
+        # Hors période ou sans groupe : absents du classeur
+        _test("t4", "prog-a", 1, commentaire="Janvier") | {"date_test": datetime(2026, 1, 31, tzinfo=timezone.utc)},
+        _test("t5", "", 10, commentaire="Sans programme"),
+    ]
+    path = _build("site")
+    try:
+        wb = load_workbook(path)
+    finally:
+        os.remove(path)
+
+    assert wb.sheetnames == ["Boulanger - Zeta", "Boulanger - Alpha"]
+    ws = wb["Boulanger - Zeta"]
+    assert [str(plage) for plage in ws.merged_cells.ranges] == ["A1:I1"]
+    assert ws["A1"].value == "TESTS SITE – Boulanger – Zeta"
+    assert [c.value for c in ws[2]] == server.BILAN_EXCEL_FORMATS["site"]["headers"]
+    # Tests du groupe dans l'ordre des dates
+    assert [row[2] for row in ws.iter_rows(min_row=3, values_only=True)] == ["A1", "A2"]
+    assert [c.value for c in ws[3]][:2] == ["Février-2026", "05/02/2026"]
+    assert ws["H3"].value == "Oui"
+    for col_letter, width in server.BILAN_EXCEL_FORMATS["site"]["column_widths"].items():
+        assert ws.column_dimensions[col_letter].width == width
+
+    assert {"bilan_titre", "bilan_entete", "bilan_cellule"} <= set(wb.named_styles)
+    assert ws["A1"].style == "bilan_titre"
+    assert ws["A2"].style == "bilan_entete"
+    assert ws["A3"].style == "bilan_cellule"
+    assert ws["A2"].fill.start_color.rgb.endswith("C00000")
+
+    alpha = wb["Boulanger - Alpha"]
+    assert [c.value for c in alpha[3]][2:6] == ["B", "Oui", "100€ vs 80€", "0%"]
+
+
+def test_ligne_workbook_has_ten_columns(bilan_db):
+    bilan_db.tests_ligne.docs = [
+        _test("l2", "prog-b", 3, numero_telephone="0102030405", application_offre=True),
+        _test("l1", "prog-a", 8, numero_telephone="0607080910"),
+    ]
+    path = _build("ligne")
+    try:
+        wb = load_workbook(path)
+    finally:
+        os.remove(path)
+
+    assert wb.sheetnames == ["Boulanger - Zeta", "Boulanger - Alpha"]
+    ws = wb["Boulanger - Alpha"]
+    assert [str(plage) for plage in ws.merged_cells.ranges] == ["A1:J1"]
+    assert ws["A1"].value == "TESTS LIGNE – Boulanger – Alpha"
+    assert [c.value for c in ws[3]][:3] == ["Février-2026", "03/02/2026", "0102030405"]
+    assert ws["I3"].value == "Oui"
+    assert ws.column_dimensions["J"].width == server.BILAN_EXCEL_FORMATS["ligne"]["column_widths"]["J"]
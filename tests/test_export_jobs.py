@@ -0,0 +1,186 @@
+"""
+Test suite for the asynchronous export jobs (export_jobs + GridFS bucket "exports")
+- Jobs are claimed oldest first, reclaimed when their lease expires, within the attempt limit
+- Progress, heartbeat and the stored file of a finished job
+- Download of a finished job, cleanup of expired and abandoned jobs
+- Per-user limit enforced through unique active slots (429)
+"""
+
+import asyncio
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+
+import server  # noqa: E402
+
+
+class FakeUser:
+    def __init__(self, user_id, role=server.UserRole.chef_projet):
+        self.id = user_id
+        self.role = role
+
+
+def _request(**params):
+    return server.ExportJobRequest(
+        type="bilan-site-excel", programme_id="prog-1", date_debut="2026-01-01", date_fin="2026-01-31", **params
+    )
+
+
+def test_claim_oldest_pending_then_reclaim_after_lease(fake_db):
+    now = datetime.now(timezone.utc)
+    fake_db.export_jobs.docs = [
+        {"id": "recent", "status": "pending", "attempts": 0, "created_at": now},
+        {"id": "ancien", "status": "pending", "attempts": 0, "created_at": now - timedelta(minutes=5)},
+    ]
+
+    async def scenario():
+        job = await server._claim_export_job()
+        assert job["id"] == "ancien"
+        assert job["status"] == "running" and job["attempts"] == 1
+        assert (await server._claim_export_job())["id"] == "recent"
+        # Aucun job dû : les deux sont sous bail
+        assert await server._claim_export_job() is None
+
+        # Bail expiré (worker arrêté) : le job est repris avec une nouvelle tentative
+        fake_db.export_jobs.docs[1]["locked_until"] = now - timedelta(seconds=1)
+        repris = await server._claim_export_job()
+        assert repris["id"] == "ancien"
+        assert repris["attempts"] == 2
+        assert repris["claim_id"] != job["claim_id"]
+
+        # Nombre maximal de tentatives atteint : plus jamais réclamé
+        fake_db.export_jobs.docs[1]["locked_until"] = now - timedelta(seconds=1)
+        assert await server._claim_export_job() is None
+
+    asyncio.run(scenario())
+
+
+def test_run_job_reports_progress_and_stores_file(fake_db, monkeypatch):
+    etapes = []
+
+    async def fake_build_export(job_type, params, progress=None):
+        await progress(10, "Lecture des tests")
+        etapes.append(dict(fake_db.export_jobs.docs[0]))
+        return server.RenderedReport("bilan.xlsx", "application/xlsx", content=b"contenu du bilan")
+
+    monkeypatch.setattr(server, "build_export", fake_build_export)
+
+    async def scenario():
+        cree = await server.create_export_job(_request(), FakeUser("u1"))
+        assert cree["status"] == "pending" and "active_slot" not in cree
+        job = await server._claim_export_job()
+        await server.run_export_job(job)
+
+        statut = await server.get_export_job(cree["id"], FakeUser("u1"))
+        assert statut["status"] == "done"
+        assert statut["progress"] == 100
+        assert statut["size"] == len(b"contenu du bilan")
+        assert statut["download_url"] == f"/api/export-jobs/{cree['id']}/download"
+
+        response = await server.download_export_job(cree["id"], FakeUser("u1"))
+        contenu = b"".join([chunk async for chunk in response.body_iterator])
+        assert contenu == b"contenu du bilan"
+        assert response.headers["content-length"] == str(len(contenu))
+
+        with pytest.raises(server.HTTPException) as exc_info:
+            await server.get_export_job(cree["id"], FakeUser("u2"))
+        assert exc_info.value.status_code == 403
+
+    asyncio.run(scenario())
+
+    assert etapes[0]["progress"] == 10
+    assert etapes[0]["etape"] == "Lecture des tests"
+    assert "active_slot" not in fake_db.export_jobs.docs[0]
+
+
+def test_heartbeat_extends_lease_during_long_render(fake_db, monkeypatch):
+    monkeypatch.setattr(server, "EXPORT_JOBS_HEARTBEAT", 0.01)
+    baux = []
+
+    async def slow_build_export(job_type, params, progress=None):
+        # Rendu long sans appel à progress() (attente du pool de rendu)
+        for _ in range(5):
+            baux.append(fake_db.export_jobs.docs[0]["locked_until"])
+            await asyncio.sleep(0.02)
+        return server.RenderedReport("bilan.xlsx", "application/xlsx", content=b"x")
+
+    monkeypatch.setattr(server, "build_export", slow_build_export)
+
+    async def scenario():
+        await server.create_export_job(_request(), FakeUser("u1"))
+        await server.run_export_job(await server._claim_export_job())
+
+    asyncio.run(scenario())
+
+    assert baux[-1] > baux[0]
+    assert fake_db.export_jobs.docs[0]["status"] == "done"
+
+
+def test_failed_job_and_download_before_done(fake_db, monkeypatch):
+    async def broken_build_export(job_type, params, progress=None):
+        raise server.HTTPException(status_code=404, detail="Aucun test site trouvé pour cette période")
+
+    monkeypatch.setattr(server, "build_export", broken_build_export)
+
+    async def scenario():
+        cree = await server.create_export_job(_request(), FakeUser("u1"))
+        with pytest.raises(server.HTTPException) as exc_info:
+            await server.download_export_job(cree["id"], FakeUser("u1"))
+        assert exc_info.value.status_code == 409
+
+        await server.run_export_job(await server._claim_export_job())
+        statut = await server.get_export_job(cree["id"], FakeUser("u1"))
+        assert statut["status"] == "failed"
+        assert statut["error"] == "Aucun test site trouvé pour cette période"
+
+    asyncio.run(scenario())
+
+
+def test_per_user_limit_is_atomic(fake_db, monkeypatch):
+    monkeypatch.setattr(server, "EXPORT_JOBS_PER_USER", 2)
+
+    async def scenario():
+        resultats = await asyncio.gather(
+            *(server.create_export_job(_request(), FakeUser("u1")) for _ in range(4)),
+            return_exceptions=True
+        )
+        refus = [r for r in resultats if isinstance(r, server.HTTPException)]
+        assert len(refus) == 2
+        assert all(r.status_code == 429 for r in refus)
+        # Les créneaux sont propres à chaque utilisateur
+        await server.create_export_job(_request(), FakeUser("u2"))
+
+        # Un job terminé libère son créneau
+        job = fake_db.export_jobs.docs[0]
+        await fake_db.export_jobs.update_one({"id": job["id"]}, {"$set": {"status": "done"}, "$unset": {"active_slot": ""}})
+        await server.create_export_job(_request(), FakeUser("u1"))
+
+    asyncio.run(scenario())
+
+    assert len(fake_db.export_jobs.docs) == 4
+
+
+def test_cleanup_expired_and_abandoned_jobs(fake_db):
+    now = datetime.now(timezone.utc)
+    fake_db.export_jobs.docs = [
+        {"id": "expire", "status": "done", "file_id": "file-old", "expires_at": now - timedelta(hours=1)},
+        {"id": "abandonne", "status": "running", "attempts": server.EXPORT_JOBS_MAX_ATTEMPTS, "active_slot": "u1:0",
+         "locked_until": now - timedelta(minutes=1), "expires_at": now + timedelta(hours=1)},
+        {"id": "en-cours", "status": "running", "attempts": 1, "active_slot": "u1:1",
+         "locked_until": now + timedelta(minutes=5), "expires_at": now + timedelta(hours=1)},
+    ]
+    server.exports_fs.contents["file-old"] = b"ancien"
+
+    assert asyncio.run(server.cleanup_export_jobs()) == 1
+
+    jobs = {job["id"]: job for job in fake_db.export_jobs.docs}
+    assert "expire" not in jobs
+    assert "file-old" not in server.exports_fs.contents
+    assert jobs["abandonne"]["status"] == "failed"
+    assert "active_slot" not in jobs["abandonne"]
+    assert jobs["en-cours"]["status"] == "running"
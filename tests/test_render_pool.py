@@ -0,0 +1,144 @@
+"""
+Test suite for the report render process pool (RenderPool)
+- Pure render functions run in a separate process
+- Renders beyond the worker count wait in a measured queue
+- A full queue is rejected with a 503
+"""
+
+import asyncio
+import os
+import sys
+
+import pytest
+from openpyxl import load_workbook
+
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+
+import server  # noqa: E402
+
+
+def bilan_rows(feuilles):
+    rows = server.BilanRowsFile()
+    for sheet_name, title_text, lignes in feuilles:
+        rows.feuille(sheet_name, title_text)
+        for valeurs in lignes:
+            rows.ligne(valeurs)
+    rows.close()
+    return rows
+
+
+@pytest.fixture
+def render_pool():
+    render_pool = server.RenderPool(workers=1, max_queue=1)
+    yield render_pool
+    render_pool.close()
+
+
+def test_excel_rendered_in_worker_process(render_pool, tmp_path):
+    path = str(tmp_path / "bilan.xlsx")
+    rows = bilan_rows([("Part - Prog", "TESTS SITE – Part – Prog", [["Janvier-2026", "15/01/2026"]])])
+
+    asyncio.run(render_pool.run(server.render_bilan_excel, path, rows.path, ["MOIS", "DATE EXACTE"], {"A": 18}))
+    rows.cleanup()
+
+    ws = load_workbook(path)["Part - Prog"]
+    assert ws["A1"].value == "TESTS SITE – Part – Prog"
+    assert [c.value for c in ws[3]] == ["Janvier-2026", "15/01/2026"]
+    assert render_pool.stats()["completed"] == 1
+
+
+def test_queue_depth_and_rejection(render_pool, tmp_path):
+    rows = bilan_rows([("Feuille", "Titre", [[i] for i in range(2000)])])
+
+    async def scenario():
+        renders = [
+            asyncio.create_task(render_pool.run(server.render_bilan_excel, str(tmp_path / f"{i}.xlsx"), rows.path, ["N"], {}))
+            for i in range(2)
+        ]
+        await asyncio.sleep(0)
+        stats = render_pool.stats()
+        assert stats["running"] == 1
+        assert stats["queued"] == 1
+        # File pleine : refus immédiat plutôt qu'une attente illimitée
+        with pytest.raises(server.HTTPException) as exc_info:
+            await render_pool.run(server.render_bilan_excel, str(tmp_path / "x.xlsx"), rows.path, ["N"], {})
+        assert exc_info.value.status_code == 503
+        await asyncio.gather(*renders)
+
+    asyncio.run(scenario())
+    rows.cleanup()
+
+    stats = render_pool.stats()
+    assert stats["completed"] == 2
+    assert stats["rejected"] == 1
+    assert stats["max_queued"] == 1
+
+
+def test_cancelled_render_keeps_its_slot_until_done(render_pool, tmp_path):
+    rows = bilan_rows([("Feuille", "Titre", [[i] for i in range(20000)])])
+    path = str(tmp_path / "annule.xlsx")
+    abandons = []
+
+    async def scenario():
+        render = asyncio.create_task(render_pool.run(
+            server.render_bilan_excel, path, rows.path, ["N"], {}, on_abandon=lambda: abandons.append(1)
+        ))
+        await asyncio.sleep(0.1)
+        render.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await render
+        # Client déconnecté : le process rend toujours, le créneau reste occupé
+        assert render_pool.stats()["running"] == 1
+        assert abandons == []
+        # Le rendu suivant attend dans la file mesurée, bornée par max_queue
+        suivant = asyncio.create_task(render_pool.run(server.render_bilan_excel, str(tmp_path / "b.xlsx"), rows.path, ["N"], {}))
+        await asyncio.sleep(0)
+        assert render_pool.stats()["queued"] == 1
+        await suivant
+
+    asyncio.run(scenario())
+    rows.cleanup()
+
+    assert abandons == [1]
+    assert render_pool.stats()["completed"] == 2
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def __aiter__(self):
+        self._iter = iter(self.docs)
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._iter)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+def test_cancelled_bilan_removes_temp_files_after_render(render_pool, tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "render_pool", render_pool)
+    monkeypatch.setattr(server.tempfile, "tempdir", str(tmp_path))
+    tests = [{"partenaire_id": "p1", "n": i} for i in range(20000)]
+
+    async def scenario():
+        export = asyncio.create_task(server.write_bilan_excel(
+            FakeCursor(tests), "partenaire_id", lambda group_id: ("Feuille", "Titre"), ["N"], {}, lambda test: [test["n"]]
+        ))
+        while render_pool.stats()["running"] == 0:
+            await asyncio.sleep(0.01)
+        export.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await export
+        # Le process écrit encore dans le classeur : fichiers conservés jusqu'à la fin du rendu
+        assert len(list(tmp_path.iterdir())) == 2
+        while render_pool.stats()["running"]:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0)
+
+    asyncio.run(scenario())
+
+    assert list(tmp_path.iterdir()) == []
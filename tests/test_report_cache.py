@@ -0,0 +1,160 @@
+"""
+Test suite for the generated report cache keys and conditional GETs
+- Cache keys only depend on the exporter, its parameters and the data version
+- If-None-Match handling (lists, weak validators, wildcard)
+- serve_cached_report: miss then hit, 304, fallback when the GridFS file is gone
+- data_version changes when a test is updated; orphan GridFS files are swept
+"""
+
+import asyncio
+import io
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+
+import server  # noqa: E402
+
+
+class FakeRequest:
+    def __init__(self, if_none_match=None):
+        self.headers = {"if-none-match": if_none_match} if if_none_match else {}
+
+
+@pytest.fixture(autouse=True)
+def report_cache_state(monkeypatch):
+    monkeypatch.setattr(server, "report_cache_state", dict.fromkeys(server.report_cache_state, 0))
+
+
+async def body(response):
+    return b"".join([chunk async for chunk in response.body_iterator])
+
+
+def test_cache_key_is_stable_and_version_sensitive():
+    params = {"partenaire_id": "p1", "date_debut": "2026-01-01", "date_fin": "2026-01-31"}
+    key = server.report_cache_key("bilan-partenaire-ppt", params, "v1")
+
+    # Ordre des paramètres sans effet
+    assert key == server.report_cache_key("bilan-partenaire-ppt", dict(reversed(list(params.items()))), "v1")
+    assert key != server.report_cache_key("bilan-partenaire-ppt", params, "v2")
+    assert key != server.report_cache_key("bilan-site-excel", params, "v1")
+
+
+def test_etag_matches():
+    etag = '"abc"'
+
+    assert server._etag_matches('"abc"', etag)
+    assert server._etag_matches('W/"abc"', etag)
+    assert server._etag_matches('"xyz", "abc"', etag)
+    assert server._etag_matches('*', etag)
+    assert not server._etag_matches('"xyz"', etag)
+    assert not server._etag_matches(None, etag)
+
+
+def test_serve_cached_report_miss_hit_and_not_modified(fake_db):
+    rendus = []
+
+    async def build():
+        rendus.append(1)
+        return server.RenderedReport("bilan.pptx", server.PPT_MEDIA_TYPE, content=b"contenu du bilan")
+
+    def headers_for(filename):
+        return {"Content-Disposition": f'attachment; filename="{filename}"'}
+
+    async def serve(request):
+        return await server.serve_cached_report(request, "bilan-partenaire-ppt", {"partenaire_id": "p1"}, "v1", build, headers_for)
+
+    async def scenario():
+        premiere = await serve(FakeRequest())
+        assert await body(premiere) == b"contenu du bilan"
+        assert premiere.headers["content-length"] == str(len(b"contenu du bilan"))
+        assert premiere.headers["content-disposition"] == 'attachment; filename="bilan.pptx"'
+        etag = premiere.headers["etag"]
+
+        seconde = await serve(FakeRequest())
+        assert await body(seconde) == b"contenu du bilan"
+        assert seconde.headers["etag"] == etag
+
+        inchange = await serve(FakeRequest(if_none_match=etag))
+        assert inchange.status_code == 304
+
+    asyncio.run(scenario())
+
+    assert len(rendus) == 1
+    assert server.report_cache_state["misses"] == 1
+    assert server.report_cache_state["hits"] == 1
+    assert server.report_cache_state["not_modified"] == 1
+    assert fake_db.report_cache.docs[0]["hits"] == 1
+
+
+def test_serve_cached_report_rebuilds_when_file_is_gone(fake_db):
+    rendus = []
+
+    async def build():
+        rendus.append(1)
+        return server.RenderedReport("rapport.pdf", "application/pdf", content=f"rendu {len(rendus)}".encode())
+
+    async def serve():
+        response = await server.serve_cached_report(FakeRequest(), "incident-report-pdf", {"test_id": "t1"}, "v1", build, lambda f: {})
+        return await body(response)
+
+    async def scenario():
+        assert await serve() == b"rendu 1"
+        # Fichier GridFS supprimé hors du cache : l'entrée est abandonnée et le rapport régénéré
+        server.report_cache_fs.contents.clear()
+        assert await serve() == b"rendu 2"
+        assert await serve() == b"rendu 2"
+
+    asyncio.run(scenario())
+
+    assert len(rendus) == 2
+    assert len(fake_db.report_cache.docs) == 1
+
+
+def test_data_version_changes_when_a_test_is_updated(fake_db):
+    creation = datetime(2026, 1, 10, tzinfo=timezone.utc)
+    fake_db.tests_site.docs = [{"id": "t1", "created_at": creation}, {"id": "t2", "created_at": creation}]
+    sources = [("tests_site", {"id": "t1"}), ("alertes", {"test_id": "t1"})]
+
+    async def scenario():
+        avant = await server.data_version(sources, refs=["Programme", "Partenaire"])
+        assert avant == await server.data_version(sources, refs=["Programme", "Partenaire"])
+
+        # Modification d'un autre test : sans effet
+        await fake_db.tests_site.update_one({"id": "t2"}, {"$set": {"updated_at": creation + timedelta(days=1)}})
+        assert await server.data_version(sources, refs=["Programme", "Partenaire"]) == avant
+
+        await fake_db.tests_site.update_one({"id": "t1"}, {"$set": {"updated_at": creation + timedelta(days=1)}})
+        apres = await server.data_version(sources, refs=["Programme", "Partenaire"])
+        assert apres != avant
+
+        # Nouvelle alerte sur le test, puis référence affichée renommée
+        await fake_db.alertes.insert_one({"id": "a1", "test_id": "t1", "created_at": creation})
+        assert await server.data_version(sources, refs=["Programme", "Partenaire"]) != apres
+        assert await server.data_version(sources, refs=["Programme renommé", "Partenaire"]) != apres
+
+    asyncio.run(scenario())
+
+
+def test_orphan_gridfs_files_are_swept(fake_db):
+    async def scenario():
+        with_entry = await server.report_cache_fs.upload_from_stream("a.pdf", io.BytesIO(b"a"))
+        orphan = await server.report_cache_fs.upload_from_stream("b.pdf", io.BytesIO(b"b"))
+        recent_orphan = await server.report_cache_fs.upload_from_stream("c.pdf", io.BytesIO(b"c"))
+        await fake_db.report_cache.insert_one({"key": "k1", "file_id": with_entry})
+        ancien = datetime.now(timezone.utc) - server.REPORT_CACHE_ORPHAN_GRACE - timedelta(minutes=1)
+        for doc in fake_db["report_cache.files"].docs:
+            if doc["_id"] != recent_orphan:
+                doc["uploadDate"] = ancien
+
+        assert await server.sweep_report_cache_orphans() == 1
+        # Upload récent : peut-être en attente de son entrée, conservé
+        assert set(server.report_cache_fs.contents) == {with_entry, recent_orphan}
+        assert orphan not in server.report_cache_fs.contents
+
+    asyncio.run(scenario())
+
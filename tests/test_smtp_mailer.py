@@ -0,0 +1,177 @@
+"""
+Test suite for the pooled SMTP mailer (SMTPMailer) against a local fake SMTP server
+- One authenticated session is reused across messages
+- A session dropped by the server is transparently reopened
+- Sending runs outside the asyncio event loop
+"""
+
+import asyncio
+import os
+import socketserver
+import sys
+import threading
+import time
+
+import pytest
+
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+
+import server  # noqa: E402
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    """Minimal ESMTP dialogue: EHLO, AUTH, MAIL, RCPT, DATA, RSET, NOOP, QUIT"""
+
+    def reply(self, line):
+        self.wfile.write((line + "\r\n").encode())
+
+    def handle(self):
+        fake = self.server
+        with fake.lock:
+            fake.connections += 1
+        self.reply("220 fake.smtp ESMTP ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            verb = line.decode().strip().split(" ", 1)[0].upper()
+            if verb == "EHLO":
+                self.wfile.write(b"250-fake.smtp\r\n250-AUTH PLAIN LOGIN\r\n250 8BITMIME\r\n")
+            elif verb == "AUTH":
+                with fake.lock:
+                    fake.logins += 1
+                self.reply("235 2.7.0 Authentication successful")
+            elif verb in ("HELO", "MAIL", "RCPT", "RSET", "NOOP"):
+                self.reply("250 OK")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                data = []
+                while True:
+                    data_line = self.rfile.readline()
+                    if data_line in (b".\r\n", b""):
+                        break
+                    data.append(data_line)
+                time.sleep(fake.delay)
+                with fake.lock:
+                    fake.messages.append(b"".join(data).decode())
+                self.reply("250 OK queued")
+                if fake.drop_after_message:
+                    return
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeSMTPHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.logins = 0
+        self.messages = []
+        self.delay = 0.0
+        self.drop_after_message = False
+
+
+@pytest.fixture
+def fake_smtp():
+    fake = FakeSMTPServer()
+    thread = threading.Thread(target=fake.serve_forever, daemon=True)
+    thread.start()
+    yield fake
+    fake.shutdown()
+    fake.server_close()
+
+
+@pytest.fixture
+def mailer(fake_smtp):
+    mailer = server.SMTPMailer(
+        host="127.0.0.1",
+        port=fake_smtp.server_address[1],
+        user="automatisation@example.com",
+        password="secret",
+        starttls=False,
+        pool_size=1
+    )
+    yield mailer
+    mailer.close()
+
+
+def build_message(index):
+    return server.build_email_message(
+        "automatisation@example.com", f"partenaire{index}@example.com", f"Sujet {index}", "Corps", "Signature"
+    )
+
+
+def test_reuses_authenticated_session(fake_smtp, mailer):
+    async def send_all():
+        for i in range(3):
+            await mailer.send(build_message(i))
+
+    asyncio.run(send_all())
+
+    assert len(fake_smtp.messages) == 3
+    assert fake_smtp.connections == 1
+    assert fake_smtp.logins == 1
+    assert mailer.stats()["sessions_reused"] == 2
+    assert "Signature" in fake_smtp.messages[0]
+
+
+def test_reopens_session_dropped_by_server(fake_smtp, mailer):
+    fake_smtp.drop_after_message = True
+
+    async def send_all():
+        await mailer.send(build_message(1))
+        await mailer.send(build_message(2))
+
+    asyncio.run(send_all())
+
+    assert len(fake_smtp.messages) == 2
+    assert fake_smtp.connections == 2
+    assert mailer.stats()["errors"] == 0
+
+
+def test_send_does_not_block_event_loop(fake_smtp, mailer):
+    fake_smtp.delay = 0.3
+
+    async def scenario():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker_task = asyncio.create_task(ticker())
+        await mailer.send(build_message(1))
+        ticker_task.cancel()
+        return ticks
+
+    ticks = asyncio.run(scenario())
+
+    assert len(fake_smtp.messages) == 1
+    assert ticks >= 10
+
+
+def test_send_email_smtp_uses_pooled_mailer(fake_smtp, mailer, monkeypatch):
+    monkeypatch.setattr(server, "smtp_mailer", mailer)
+
+    result = asyncio.run(server.send_email_smtp("partenaire@example.com", "Sujet", "Corps"))
+
+    assert result["status"] == "success"
+    assert len(fake_smtp.messages) == 1
+
+
+def test_send_email_smtp_without_password(monkeypatch):
+    monkeypatch.setattr(server, "smtp_mailer", server.SMTPMailer(password=""))
+
+    result = asyncio.run(server.send_email_smtp("partenaire@example.com", "Sujet", "Corps"))
+
+    assert result == {"status": "error", "message": "SMTP configuration not available"}